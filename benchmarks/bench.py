@@ -0,0 +1,156 @@
+"""
+Benchmarks for pulling and pushing images, run against the in-process fake registry from ``tests/fake_registry.py``,
+so they do not need network access. Run from the repository root with:
+
+    python -m benchmarks.bench
+    python -m benchmarks.bench --scenario large-layers --latency 0.02 --bandwidth 50M
+
+For each scenario, the throughput, the peak memory (RSS) of the client and the number of requests per endpoint are
+reported. The client runs in a separate process with its own empty cache, so that the memory used by the fake registry
+does not count, and so that every run starts cold.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+from crpy.common import format_size, parse_size
+from crpy.registry import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_CONCURRENCY
+from tests.fake_registry import FakeRegistry, FakeRegistryConfig
+
+
+@dataclass
+class Scenario:
+    n_layers: int
+    layer_size: int
+
+
+SCENARIOS = {
+    "many-layers": Scenario(n_layers=50, layer_size=512 * 1024),
+    "large-layers": Scenario(n_layers=2, layer_size=128 * 1024 * 1024),
+}
+
+
+def _client(operation: str, url: str, home: str, archive: str, max_concurrency: int, chunk_size: int, queue):
+    # imported here, so that the client process reads the cache from its own home directory
+    os.environ["HOME"] = home
+    from crpy.registry import RegistryInfo
+
+    async def _run():
+        async with RegistryInfo.from_url(url) as ri:
+            if operation == "pull":
+                await ri.pull(archive, max_concurrency=max_concurrency)
+            else:
+                await ri.push(archive, chunk_size=chunk_size, max_concurrency=max_concurrency)
+
+    # the logs are not part of the benchmark
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stderr.fileno())
+    start = time.perf_counter()
+    asyncio.run(_run())
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, _peak_rss()))
+
+
+def _peak_rss() -> int:
+    # ru_maxrss survives exec on linux, so it would include the memory of the parent process at the time of the fork.
+    # VmHWM is reset on exec, so it only measures this process.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _run_client(operation: str, url: str, archive: str, args: argparse.Namespace) -> tuple:
+    with tempfile.TemporaryDirectory() as home:
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        process = context.Process(
+            target=_client, args=(operation, url, home, archive, args.jobs, args.chunk_size, queue)
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"{operation} failed with exit code {process.exitcode}")
+        return queue.get()
+
+
+async def run_scenario(name: str, scenario: Scenario, args: argparse.Namespace, workdir: str) -> list:
+    config = FakeRegistryConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate,
+        redirect_blobs=args.redirect_blobs,
+    )
+    results = []
+    async with FakeRegistry(config) as registry:
+        registry.add_image("bench/image", "latest", n_layers=scenario.n_layers, layer_size=scenario.layer_size)
+        image_size = sum(len(blob) for blob in registry.blobs.values())
+        archive = os.path.join(workdir, f"{name}.tar")
+        for operation, url in (
+            ("pull", f"http://{registry.url}/bench/image:latest"),
+            ("push", f"http://{registry.url}/bench/pushed:latest"),
+        ):
+            if operation == "push":
+                # blobs must not exist in the registry, otherwise the push skips them
+                registry.blobs.clear()
+            registry.requests.clear()
+            elapsed, peak_rss = await asyncio.to_thread(_run_client, operation, url, archive, args)
+            results.append(
+                {
+                    "scenario": name,
+                    "operation": operation,
+                    "layers": scenario.n_layers,
+                    "size": image_size,
+                    "seconds": round(elapsed, 3),
+                    "throughput": image_size / elapsed,
+                    "peak_rss": peak_rss,
+                    "requests": {f"{method} {endpoint}": n for (method, endpoint), n in registry.requests.items()},
+                }
+            )
+    return results
+
+
+def main(*args):
+    parser = argparse.ArgumentParser(description="Benchmarks crpy against a local fake registry.")
+    parser.add_argument("--scenario", "-s", action="append", choices=list(SCENARIOS), help="Scenarios to run.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency in seconds added to each request.")
+    parser.add_argument("--bandwidth", type=parse_size, default=None, help="Bandwidth of the registry, like 50M.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests that fail with 503.")
+    parser.add_argument("--redirect-blobs", action="store_true", help="Redirects blob downloads to a fake CDN.")
+    parser.add_argument("--jobs", "-j", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Blobs transferred at once.")
+    parser.add_argument("--chunk-size", type=parse_size, default=DEFAULT_CHUNK_SIZE, help="Upload chunk size.")
+    parser.add_argument("--json", action="store_true", help="Prints the results as JSON.")
+    arguments = parser.parse_args(args if args else None)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in arguments.scenario or list(SCENARIOS):
+            results.extend(asyncio.run(run_scenario(name, SCENARIOS[name], arguments, workdir)))
+
+    if arguments.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(
+            f"{result['scenario']:>14} {result['operation']:<5} {format_size(result['size']):>10} "
+            f"in {result['seconds']:>7.2f}s  {format_size(result['throughput']):>10}/s  "
+            f"peak RSS {format_size(result['peak_rss']):>10}  "
+            f"requests {sum(result['requests'].values())} {result['requests']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,248 @@
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import re
+import time
 from base64 import b64encode
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl
 
-from crpy.common import UnauthorizedError, _request
+from crpy.common import HTTPClient, UnauthorizedError, _request
 
+# tokens are refreshed this many seconds before they expire, so that they do not expire in the middle of a request
+TOKEN_REFRESH_MARGIN = 30
+# lifetime of a token when the token server does not provide one, as defined by the token authentication spec
+DEFAULT_TOKEN_EXPIRES_IN = 60
 
-async def get_token(
-    url: str,
+
+@dataclass
+class Token:
+    """
+    Bearer token returned by the token server of a registry, along with the challenge it was requested for. The
+    ``identity`` is a hash of the credentials used to request the token, so that tokens from different users are never
+    mixed up.
+    """
+
+    token: str
+    realm: str
+    service: Optional[str] = None
+    scope: Optional[str] = None
+    expires_at: float = 0.0
+    registry: Optional[str] = None
+    identity: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, Optional[str], Optional[str], Optional[str]]:
+        return self.realm, self.service, self.scope, self.identity
+
+    @property
+    def www_authenticate(self) -> str:
+        """Rebuilds the challenge that produced this token, so that it can be requested again."""
+        header = f'Bearer realm="{self.realm}"'
+        if self.service is not None:
+            header += f',service="{self.service}"'
+        if self.scope is not None:
+            header += f',scope="{self.scope}"'
+        return header
+
+    def is_fresh(self, margin: float = TOKEN_REFRESH_MARGIN) -> bool:
+        return time.time() < self.expires_at - margin
+
+
+class TokenCache:
+    """
+    Cache of bearer tokens, keyed by realm, service, scope and identity. Tokens are dropped once they are about to
+    expire, so they are refreshed before the registry rejects them. A single cache is shared by all ``RegistryInfo``
+    objects by default, so new objects do not need to authenticate again.
+
+    If a ``path`` is set, the tokens are also stored on disk (readable only by the current user), so that consecutive
+    command line calls can skip authentication.
+    """
+
+    def __init__(self, path: Optional[pathlib.Path] = None):
+        self.path = path
+        self._tokens: Dict[tuple, Token] = {}
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded or self.path is None:
+            return
+        self._loaded = True
+        try:
+            entries = json.loads(pathlib.Path(self.path).read_text())
+        except (OSError, ValueError):
+            return
+        for entry in entries:
+            token = Token(**entry)
+            if token.is_fresh():
+                self._tokens.setdefault(token.key, token)
+
+    def _save(self):
+        if self.path is None:
+            return
+        path = pathlib.Path(self.path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump([asdict(token) for token in self._tokens.values() if token.is_fresh()], f)
+        os.replace(tmp_path, path)
+
+    def get(self, www_auth: str, identity: Optional[str] = None) -> Optional[Token]:
+        """Returns a fresh token for the given ``WWW-Authenticate`` challenge, if any."""
+        self._load()
+        challenge = parse_auth_header(www_auth)
+        token = self._tokens.get((challenge["realm"], challenge.get("service"), challenge.get("scope"), identity))
+        return token if token is not None and token.is_fresh() else None
+
+    def find(self, registry: str, repository: str, identity: Optional[str] = None) -> Optional[Token]:
+        """
+        Returns a fresh token for a repository, without knowing the challenge. This allows attaching the token to the
+        first request, skipping the ``401`` round trip.
+        """
+        self._load()
+        candidates = [
+            token
+            for token in self._tokens.values()
+            if token.registry == registry
+            and token.identity == identity
+            and token.is_fresh()
+            and any(scope.startswith(f"repository:{repository}:") for scope in (token.scope or "").split(" "))
+        ]
+        return max(candidates, key=lambda token: token.expires_at, default=None)
+
+    def lookup(self, token: str) -> Optional[Token]:
+        """Returns the cache entry for a raw token string, if any."""
+        self._load()
+        return next((entry for entry in self._tokens.values() if entry.token == token), None)
+
+    def add(self, token: Token):
+        self._load()
+        self._tokens[token.key] = token
+        self._save()
+
+    def invalidate(self, token: str):
+        """Removes a token that was rejected by the registry."""
+        self._load()
+        keys = [key for key, entry in self._tokens.items() if entry.token == token]
+        for key in keys:
+            self._tokens.pop(key)
+        if keys:
+            self._save()
+
+    def clear(self):
+        self._tokens.clear()
+        self._save()
+
+
+# token cache shared by all registries, unless a different one is provided
+default_token_cache = TokenCache()
+
+
+def get_identity(username: str = None, password: str = None, b64_token: str = None) -> Optional[str]:
+    """Returns a hash identifying the credentials used to request a token, or None for anonymous requests."""
+    if username and password:
+        b64_token = b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+    if not b64_token:
+        return None
+    return hashlib.sha256(b64_token.encode()).hexdigest()[:16]
+
+
+def _basic_auth_headers(username: str = None, password: str = None, b64_token: str = None) -> dict:
+    # get the credentials here.
+    # I'll use the simple auth since it mostly works
+    if username and password:
+        b64_token = b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
+    if b64_token:
+        return {"Authorization": f"Basic {b64_token}"}
+    return {}
+
+
+def _parse_issued_at(issued_at: Optional[str]) -> Optional[float]:
+    if not issued_at:
+        return None
+    # python's isoformat parser does not handle the "Z" suffix or nanoseconds, which token servers commonly return
+    issued_at = re.sub(r"(\.\d{6})\d+", r"\1", issued_at.replace("Z", "+00:00"))
+    try:
+        return datetime.datetime.fromisoformat(issued_at).timestamp()
+    except ValueError:
+        return None
+
+
+async def fetch_token(
+    www_auth: str,
     username: str = None,
     password: str = None,
     b64_token: str = None,
     aiohttp_kwargs: dict = None,
-):
-    # get the credentials here.
-    # I'll use the simple auth since it mostly works
-    headers = {}
-    if username and password:
-        token = b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
-        headers = {"Authorization": f"Basic {token}"}
-    elif b64_token:
-        headers = {"Authorization": f"Basic {b64_token}"}
-    token_req = await _request(url, headers=headers, method="get", aiohttp_kwargs=aiohttp_kwargs)
+    client: Optional[HTTPClient] = None,
+) -> Token:
+    """
+    Requests a token from the token server referenced by a ``WWW-Authenticate`` challenge. The expiry of the token is
+    computed from the ``expires_in`` and ``issued_at`` fields of the response.
+    """
+    headers = _basic_auth_headers(username, password, b64_token)
+    url = get_url_from_auth_header(www_auth)
+    now = time.time()
+    token_req = await _request(url, headers=headers, method="get", aiohttp_kwargs=aiohttp_kwargs, client=client)
     if token_req.status in (401, 403):
         raise UnauthorizedError(f"Could not authenticate at registry {url}")
     req_json = token_req.json()
     if "token" in req_json:
-        return req_json["token"]
+        token = req_json["token"]
     elif "access_token" in req_json:
-        return req_json["access_token"]
+        token = req_json["access_token"]
     else:
         raise ValueError(f"Authentication is required and it was not provided: {req_json}")
+    # a clock in the future on the token server would make the token look valid for longer than it is
+    issued_at = min(_parse_issued_at(req_json.get("issued_at")) or now, now)
+    challenge = parse_auth_header(www_auth)
+    return Token(
+        token=token,
+        realm=challenge["realm"],
+        service=challenge.get("service"),
+        scope=challenge.get("scope"),
+        expires_at=issued_at + int(req_json.get("expires_in") or DEFAULT_TOKEN_EXPIRES_IN),
+        identity=get_identity(username, password, b64_token),
+    )
+
+
+async def get_token(
+    url: str,
+    username: str = None,
+    password: str = None,
+    b64_token: str = None,
+    aiohttp_kwargs: dict = None,
+    client: Optional[HTTPClient] = None,
+    token_cache: Optional[TokenCache] = None,
+) -> str:
+    """
+    Requests a token from a token server url, as built by ``get_url_from_auth_header()``, and returns the raw token.
+    See ``fetch_token()``, which also tells when the token expires. If a ``token_cache`` is given, a fresh token from
+    the cache is returned instead, and new tokens are added to it.
+    """
+    realm, _, query = url.partition("?")
+    params = dict(parse_qsl(query))
+    www_auth = Token("", realm, params.get("service"), params.get("scope")).www_authenticate
+    if token_cache is not None:
+        cached = token_cache.get(www_auth, get_identity(username, password, b64_token))
+        if cached is not None:
+            return cached.token
+    token = await fetch_token(www_auth, username, password, b64_token, aiohttp_kwargs=aiohttp_kwargs, client=client)
+    if token_cache is not None:
+        token_cache.add(token)
+    return token.token
+
+
+def parse_auth_header(h: str) -> Dict[str, str]:
+    """
+    >>> parse_auth_header('Bearer realm="https://auth.docker.io/token",service="registry.docker.io",scope="repository:library/nginx:pull"')
+    {'realm': 'https://auth.docker.io/token', 'service': 'registry.docker.io', 'scope': 'repository:library/nginx:pull'}
+    """
+    assert h.startswith("Bearer ")
+    return dict(re.findall(r'(\w+)="([^"]*)"', h))
 
 
 def get_url_from_auth_header(h: str):
@@ -1,12 +1,22 @@
+import asyncio
+import contextlib
+import datetime
 import enum
 import hashlib
 import io
 import json
+import pathlib
+import re
+import time
 from dataclasses import dataclass
-from typing import Optional, Union
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import parse_qsl, urljoin, urlparse
 
 import aiohttp
 
+from crpy.metrics import Metrics
+from crpy.retry import RetryPolicy
+
 
 @dataclass
 class Response:
@@ -18,6 +28,176 @@ class Response:
         return json.loads(self.data)
 
 
+# statuses of redirects that are followed explicitly, see ``_follow_redirects()``
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+
+class SignedUrlCache:
+    """
+    Signed urls that registries redirected blob downloads to, kept until shortly before they expire. Retries and
+    resumed downloads of the same blob then go straight to the storage, without asking the registry again. Urls
+    without a known expiry are not cached.
+
+    :param margin: time in seconds before the expiry of an url after which it is not used anymore.
+    """
+
+    def __init__(self, margin: float = 10):
+        self.margin = margin
+        self._urls: Dict[str, Tuple[str, float]] = {}
+
+    def get(self, url: str) -> Optional[str]:
+        entry = self._urls.get(url)
+        if entry is None:
+            return None
+        location, expires_at = entry
+        if expires_at - self.margin <= time.time():
+            self._urls.pop(url, None)
+            return None
+        return location
+
+    def add(self, url: str, location: str):
+        expires_at = _signed_url_expiry(location)
+        if expires_at is not None:
+            self._urls[url] = (location, expires_at)
+
+    def invalidate(self, url: str):
+        self._urls.pop(url, None)
+
+
+class HTTPClient:
+    """
+    Long-lived, connection-pooled HTTP client. A single instance keeps its sockets alive between calls, so consecutive
+    requests to the same registry reuse the same TCP and TLS connections instead of doing a new handshake each time.
+    The underlying ``aiohttp.ClientSession`` is created lazily on the first request, since it must be bound to the
+    running event loop. Use it as an async context manager (or call ``close()``) to release the connections. A client
+    that is never closed releases them once it is garbage collected:
+
+    >>> async with HTTPClient() as client:
+    ...     response = await _request("https://index.docker.io/v2/", method="get", client=client)
+
+    :param limit: total number of simultaneous connections.
+    :param limit_per_host: number of simultaneous connections to the same host.
+    :param ttl_dns_cache: time in seconds that resolved DNS entries are cached.
+    :param keepalive_timeout: time in seconds that idle connections are kept open for reuse.
+    :param metrics: collects the requests and bytes transferred by this client, see ``crpy.metrics``.
+    :param retry: how transient errors are retried, see ``crpy.retry``. By default, requests are attempted 5 times.
+
+    Blob downloads that registries redirect to a CDN or object storage use a separate session (and connection pool) for
+    each redirected host, and the signed urls are kept in ``signed_urls`` until they expire.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: float = 30,
+        metrics: Optional[Metrics] = None,
+        retry: Optional[RetryPolicy] = None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.metrics = metrics
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.signed_urls = SignedUrlCache()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._redirect_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        trace_configs = [self.metrics.trace_config()] if self.metrics is not None else None
+        return aiohttp.ClientSession(connector=connector, trust_env=True, trace_configs=trace_configs)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self._new_session()
+        return self._session
+
+    def redirect_session(self, url: str) -> aiohttp.ClientSession:
+        """
+        Returns the session for a host that blobs are redirected to. Each host has a connection pool of its own, so
+        that connections to the CDN are kept alive for the next blob and do not count against the registry limits.
+        """
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        session = self._redirect_sessions.get(origin)
+        if session is None or session.closed:
+            session = self._redirect_sessions[origin] = self._new_session()
+        return session
+
+    def _on_retry(self, reason: str):
+        if self.metrics is not None:
+            self.metrics.inc("crpy_retries_total", operation="request")
+
+    async def close(self):
+        await _close_sessions(self._open_sessions())
+        self._session = None
+        self._redirect_sessions.clear()
+
+    def _open_sessions(self) -> List[aiohttp.ClientSession]:
+        sessions = [self._session, *self._redirect_sessions.values()]
+        return [session for session in sessions if session is not None and not session.closed]
+
+    def __del__(self, _get_running_loop=asyncio.get_running_loop):
+        # unclosed clients are often only collected when the interpreter exits, while its modules are being cleared, so
+        # the functions used here are bound in advance
+        sessions = self._open_sessions()
+        if not sessions:
+            return
+        try:
+            loop = _get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            task = loop.create_task(_close_sessions(sessions))
+            # the loop only keeps a weak reference to its tasks
+            _closing_tasks.add(task)
+            task.add_done_callback(_closing_tasks.discard)
+            return
+        for session in sessions:
+            # once the loop is closed, there is nothing left to wait for, so closing completes in a single step
+            closing = session.close()
+            try:
+                closing.send(None)
+            except StopIteration:
+                continue
+            closing.close()
+
+    async def __aenter__(self) -> "HTTPClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+# sessions of clients that were garbage collected without being closed, see HTTPClient.__del__
+_closing_tasks: Set[asyncio.Task] = set()
+
+
+async def _close_sessions(sessions: List[aiohttp.ClientSession]):
+    for session in sessions:
+        await session.close()
+
+
+@contextlib.asynccontextmanager
+async def _client_or_temporary(client: Optional[HTTPClient]) -> AsyncIterator[HTTPClient]:
+    # when no client is provided, fall back to a short-lived one that is closed right after the request
+    if client is not None:
+        yield client
+    else:
+        async with HTTPClient() as temporary_client:
+            yield temporary_client
+
+
 async def _request(
     url,
     headers: dict = None,
@@ -25,41 +205,281 @@ async def _request(
     data: Union[dict, bytes] = None,
     method: str = "post",
     aiohttp_kwargs: dict = None,
+    client: Optional[HTTPClient] = None,
+    idempotent: Optional[bool] = None,
 ) -> Response:
     aiohttp_kwargs = aiohttp_kwargs or {}
     try:
-        async with aiohttp.ClientSession(trust_env=True) as session:
-            method_fn = getattr(session, method)
-            async with method_fn(url, headers=headers, params=params, data=data, **aiohttp_kwargs) as response:
-                return Response(response.status, await response.read(), dict(response.headers))
-    except aiohttp.ClientConnectionError as e:
+        async with _client_or_temporary(client) as http_client:
+
+            async def _send() -> Response:
+                method_fn = getattr(http_client.session, method)
+                async with method_fn(url, headers=headers, params=params, data=data, **aiohttp_kwargs) as response:
+                    return Response(response.status, await response.read(), dict(response.headers))
+
+            return await http_client.retry.call(
+                method,
+                _send,
+                data=data,
+                on_retry=http_client._on_retry,
+                is_error=_is_transient_error,
+                idempotent=idempotent,
+            )
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
         raise HTTPConnectionError(str(e))
 
 
-async def _stream(url, headers: dict = None, aiohttp_kwargs: dict = None):
+@contextlib.asynccontextmanager
+async def _open_stream(
+    url, headers: dict = None, aiohttp_kwargs: dict = None, client: Optional[HTTPClient] = None
+) -> AsyncIterator[aiohttp.ClientResponse]:
+    """
+    Opens a GET request whose body can be consumed incrementally, from ``response.content``. Error statuses are raised
+    before the body is read, so that the caller can authenticate and retry the request. Transient errors are only
+    retried until the response arrives, since the body cannot be replayed once the caller started consuming it.
+    Redirects are followed explicitly, see ``_follow_redirects()``.
+    """
     aiohttp_kwargs = aiohttp_kwargs or {}
-    async with aiohttp.ClientSession(trust_env=True) as session:
-        async with session.get(url, headers=headers, **aiohttp_kwargs) as response:
-            async for data, _ in response.content.iter_chunks():
-                yield data
+    try:
+        async with _client_or_temporary(client) as http_client:
+            response = await _follow_redirects(http_client, url, headers or {}, aiohttp_kwargs)
+            async with response:
+                if response.status == 401:
+                    raise UnauthorizedError(
+                        f"Unauthorized request to {url}", www_authenticate=response.headers.get("WWW-Authenticate")
+                    )
+                if response.status >= 400:
+                    raise HTTPResponseError(
+                        f"Request to {url} failed with status {response.status}: {await response.text()}",
+                        status=response.status,
+                        headers=dict(response.headers),
+                    )
+                yield response
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+        # payload errors are raised when the connection drops in the middle of the body
+        raise HTTPConnectionError(str(e))
 
 
-def compute_sha256(file: Union[str, io.BytesIO, bytes], use_prefix: bool = True):
-    # If input is a string, consider it a filename
-    if isinstance(file, str):
+async def _follow_redirects(
+    http_client: HTTPClient, url: str, headers: dict, aiohttp_kwargs: dict
+) -> aiohttp.ClientResponse:
+    """
+    Sends a GET request, following redirects explicitly. Registries like Docker Hub, ECR and GCR redirect blob
+    downloads to a CDN or object storage, with a signed url that is the credential for the download. Hence, once a
+    redirect leaves the origin (scheme, host and port) of the registry:
+
+    - the ``Authorization`` header of the registry is not sent to the redirected url anymore;
+    - the signed url is cached until it expires, so that retries and resumed downloads skip the registry;
+    - each redirected host gets its own connection pool, see ``HTTPClient.redirect_session()``.
+
+    Redirects within the registry itself keep the header, since the registry still needs the token to answer them.
+    """
+    # the token of the registry must not leak to the storage, the signed url is all it needs
+    storage_headers = {key: value for key, value in headers.items() if key.lower() != "authorization"}
+    location = http_client.signed_urls.get(url)
+    if location is not None:
+        if http_client.metrics is not None:
+            http_client.metrics.inc("crpy_signed_url_hits_total")
+        try:
+            response = await _get(
+                http_client, http_client.redirect_session(location), location, storage_headers, aiohttp_kwargs
+            )
+            # a range past the end of the blob is a valid answer for resumed downloads
+            if response.status < 400 or response.status == 416:
+                return response
+            response.close()
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            pass
+        # the url expired or was revoked, so the registry is asked for a new one
+        http_client.signed_urls.invalidate(url)
+    session, target = http_client.session, url
+    for _ in range(MAX_REDIRECTS):
+        response = await _get(http_client, session, target, headers, {**aiohttp_kwargs, "allow_redirects": False})
+        if response.status not in REDIRECT_STATUSES or "Location" not in response.headers:
+            return response
+        target = urljoin(target, response.headers["Location"])
+        # the body is read, so that the connection can be reused
+        async with response:
+            await response.read()
+        if headers is storage_headers or _origin(target) != _origin(url):
+            headers = storage_headers
+            session = http_client.redirect_session(target)
+            http_client.signed_urls.add(url, target)
+    raise HTTPConnectionError(f"Too many redirects while downloading {url}")
+
+
+def _origin(url: str) -> Tuple[str, Optional[str], Optional[int]]:
+    """
+    Returns the scheme, host and port of a url, with the default port of the scheme when the url has none.
+
+    >>> _origin("https://registry.example.com/v2/") == _origin("https://REGISTRY.example.com:443/v2/x")
+    True
+    >>> _origin("https://registry.example.com/v2/") == _origin("https://registry.example.com:5000/v2/")
+    False
+    """
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.hostname, parsed.port or {"http": 80, "https": 443}.get(parsed.scheme)
+
+
+async def _get(
+    http_client: HTTPClient, session: aiohttp.ClientSession, url: str, headers: dict, aiohttp_kwargs: dict
+) -> aiohttp.ClientResponse:
+    return await http_client.retry.call(
+        "GET",
+        lambda: _hedged_get(http_client, session, url, headers=headers, **aiohttp_kwargs),
+        on_retry=http_client._on_retry,
+        is_error=_is_transient_error,
+        discard=lambda r: r.close(),
+    )
+
+
+async def _hedged_get(
+    http_client: HTTPClient, session: aiohttp.ClientSession, url: str, **kwargs
+) -> aiohttp.ClientResponse:
+    """
+    Sends a GET request. If the client has ``hedge_after`` set and the response takes longer than that to arrive, the
+    same request is sent a second time, and the first response to arrive is used. The other request is cancelled.
+    """
+    hedge_after = http_client.retry.hedge_after
+    if hedge_after is None:
+        return await session.get(url, **kwargs)
+    tasks = [asyncio.ensure_future(session.get(url, **kwargs))]
+    winner, error = None, None
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            if http_client.metrics is not None:
+                http_client.metrics.inc("crpy_hedged_requests_total")
+            tasks.append(asyncio.ensure_future(session.get(url, **kwargs)))
+            pending.add(tasks[-1])
+        while True:
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task
+                else:
+                    # both responses arrived at the same time
+                    task.result().close()
+            if winner is not None or not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    if winner is None:
+        raise error
+    return winner.result()
+
+
+def _signed_url_expiry(url: str) -> Optional[float]:
+    """
+    Returns when a signed url expires, as a unix timestamp, from the query parameters used by S3 (``X-Amz-Date`` and
+    ``X-Amz-Expires``, or ``Expires``), Google Cloud Storage (``X-Goog-Date`` and ``X-Goog-Expires``), CloudFront
+    (``Expires``) and Azure (``se``). Returns None if the url does not say when it expires.
+
+    >>> _signed_url_expiry("https://bucket.s3.amazonaws.com/data?X-Amz-Date=20240101T000000Z&X-Amz-Expires=1200")
+    1704068400.0
+    >>> _signed_url_expiry("https://d1.cloudfront.net/data?Expires=1700000000&Signature=abc")
+    1700000000.0
+    >>> _signed_url_expiry("https://account.blob.core.windows.net/data?se=2024-01-01T00%3A20%3A00Z&sig=abc")
+    1704068400.0
+    >>> _signed_url_expiry("https://registry.example.com/data") is None
+    True
+    """
+    query = {key.lower(): value for key, value in parse_qsl(urlparse(url).query)}
+    try:
+        for prefix in ("x-amz-", "x-goog-"):
+            if f"{prefix}date" in query and f"{prefix}expires" in query:
+                signed_at = datetime.datetime.strptime(query[f"{prefix}date"], "%Y%m%dT%H%M%SZ")
+                signed_at = signed_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+                return signed_at + float(query[f"{prefix}expires"])
+        if "expires" in query:
+            return float(query["expires"])
+        if "se" in query:
+            return datetime.datetime.fromisoformat(query["se"].replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        pass
+    return None
+
+
+def _is_transient_error(e: BaseException) -> bool:
+    return isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+async def _stream(url, headers: dict = None, aiohttp_kwargs: dict = None, client: Optional[HTTPClient] = None):
+    async with _open_stream(url, headers, aiohttp_kwargs=aiohttp_kwargs, client=client) as response:
+        async for data, _ in response.content.iter_chunks():
+            yield data
+
+
+def compute_sha256(file: Union[str, pathlib.Path, io.BytesIO, bytes], use_prefix: bool = True):
+    sha256_hash = hashlib.sha256()
+    # If input is a string or path, consider it a filename and hash it in chunks
+    if isinstance(file, (str, pathlib.Path)):
         with open(file, "rb") as f:
-            content = f.read()
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256_hash.update(chunk)
     # If input is BytesIO, get value directly
     elif isinstance(file, io.BytesIO):
-        content = file.getvalue()
+        sha256_hash.update(file.getvalue())
     elif isinstance(file, bytes):
-        content = file
+        sha256_hash.update(file)
     else:
         raise TypeError("Invalid input type.")
 
     # Compute the sha256 hash
-    sha256_hash = hashlib.sha256(content).hexdigest()
-    return f"sha256:{sha256_hash}" if use_prefix else sha256_hash
+    return f"sha256:{sha256_hash.hexdigest()}" if use_prefix else sha256_hash.hexdigest()
+
+
+def compute_sha256_from_file(file_obj: BinaryIO, chunk_size: int = 1024 * 1024) -> Tuple[str, int]:
+    """
+    Computes the sha256 digest and the size of a binary file-like object, reading it in chunks from its current
+    position until the end.
+
+    :return: tuple with the prefixed digest and the number of bytes read.
+    """
+    sha256_hash = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: file_obj.read(chunk_size), b""):
+        sha256_hash.update(chunk)
+        size += len(chunk)
+    return f"sha256:{sha256_hash.hexdigest()}", size
+
+
+_size_units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: Union[str, int]) -> int:
+    """
+    Parses a human-readable size in bytes, using binary units.
+
+    >>> parse_size("512M")
+    536870912
+    >>> parse_size("10GB")
+    10737418240
+    """
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", size.upper().replace("IB", "B"))
+    if not match:
+        raise ValueError(f"Invalid size '{size}'. Use a number of bytes, optionally followed by K, M, G or T.")
+    return int(float(match.group(1)) * _size_units[match.group(2)])
+
+
+def format_size(size: int) -> str:
+    """
+    Formats a number of bytes as a human-readable size.
+
+    >>> format_size(536870912)
+    '512.0 MB'
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
 
 
 class Platform(enum.Enum):
@@ -108,8 +528,21 @@ class BaseCrpyError(Exception):
 
 
 class UnauthorizedError(BaseCrpyError):
-    pass
+    def __init__(self, message: str = "", www_authenticate: Optional[str] = None):
+        super().__init__(message)
+        self.www_authenticate = www_authenticate
 
 
 class HTTPConnectionError(BaseCrpyError):
     pass
+
+
+class HTTPResponseError(HTTPConnectionError):
+    def __init__(self, message: str = "", status: Optional[int] = None, headers: Optional[dict] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class DigestMismatchError(BaseCrpyError):
+    pass
@@ -0,0 +1,481 @@
+"""
+Compression of layers. Registries store layers compressed, while the archives of ``docker load`` contain them as plain
+tar-files, named after the digest of the uncompressed content (the ``diff_id`` listed in the ``rootfs`` of the image
+config). Layers are decompressed while they are downloaded, in a worker thread, so that pulling an image does not need a
+second pass over each layer:
+
+>>> async with LayerDecompressor("sha256:<diff_id>", "gzip") as decompressor:
+...     async for chunk in response.content.iter_any():
+...         await decompressor.feed(chunk)
+...     layer_path = await decompressor.finish()
+
+zstd layers can only be decompressed when the optional ``zstandard`` package is installed.
+
+The members of a layer can be read the same way with ``LayerTarReader``, which stops as soon as it has found what
+it was looking for, so the rest of the layer is never downloaded.
+
+The other way around, uncompressed layers (as written by ``docker save``) are compressed while they are pushed, by
+``ParallelCompressor``.
+"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import pathlib
+import queue
+import struct
+import tarfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO, Callable, Deque, Optional
+
+from crpy.common import BaseCrpyError
+from crpy.storage import LayerWriter
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# size of the chunks read from files in the cache
+READ_CHUNK_SIZE = 1024 * 1024
+# number of chunks the download can be ahead of the decompression before it waits
+MAX_PENDING_CHUNKS = 64
+# compression level of pushed layers, the default of gzip
+DEFAULT_COMPRESSION_LEVEL = 6
+# size of the blocks compressed in parallel, the same as pigz
+COMPRESSION_BLOCK_SIZE = 128 * 1024
+
+# each block is compressed with the end of the previous one as dictionary, 32 KiB being the window of deflate
+_DICTIONARY_SIZE = 32 * 1024
+# gzip header without file name and modification time, so that the output only depends on the content
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+_MAGIC_NUMBERS = {b"\x1f\x8b": "gzip", b"\x28\xb5\x2f\xfd": "zstd"}
+
+# sentinels sent to the worker thread along with the chunks
+_END = object()
+_RESTART = object()
+
+_DECOMPRESSION_ERRORS = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+
+
+class DecompressionError(BaseCrpyError):
+    pass
+
+
+def layer_compression(media_type: Optional[str]) -> Optional[str]:
+    """
+    Returns the compression of a layer from its media type: "gzip", "zstd" or None for uncompressed layers.
+
+    >>> layer_compression("application/vnd.docker.image.rootfs.diff.tar.gzip")
+    'gzip'
+    >>> layer_compression("application/vnd.oci.image.layer.v1.tar+zstd")
+    'zstd'
+    >>> layer_compression("application/vnd.oci.image.layer.v1.tar") is None
+    True
+    """
+    if media_type is None or media_type.endswith("gzip"):
+        # layers without a media type come from docker, which always compresses them with gzip
+        return "gzip"
+    if media_type.endswith("zstd"):
+        return "zstd"
+    return None
+
+
+def detect_compression(data: bytes) -> Optional[str]:
+    """
+    Returns the compression of a blob from its first bytes: "gzip", "zstd" or None if it is not compressed.
+
+    >>> detect_compression(b"\\x1f\\x8b\\x08\\x00")
+    'gzip'
+    >>> detect_compression(b"etc/")
+    """
+    return next((compression for magic, compression in _MAGIC_NUMBERS.items() if data.startswith(magic)), None)
+
+
+def can_decompress(compression: Optional[str]) -> bool:
+    """Tells if layers with the given compression can be decompressed, see ``layer_compression()``."""
+    return compression == "gzip" or (compression == "zstd" and zstandard is not None)
+
+
+class StreamDecompressor:
+    """
+    Decompresses a stream of compressed chunks incrementally. Streams made of several concatenated gzip members or
+    zstd frames are decompressed as a whole, like ``gzip -d`` does.
+
+    >>> import gzip
+    >>> decompressor = StreamDecompressor("gzip")
+    >>> decompressor.decompress(gzip.compress(b"hello ") + gzip.compress(b"world")) + decompressor.flush()
+    b'hello world'
+    """
+
+    def __init__(self, compression: str = "gzip"):
+        if not can_decompress(compression):
+            raise DecompressionError(f"Cannot decompress {compression} layers, is the zstandard package installed?")
+        self.compression = compression
+        self._decompressor = self._new_decompressor()
+
+    def _new_decompressor(self):
+        if self.compression == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        # 16 + MAX_WBITS only accepts gzip headers, and not raw zlib streams
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        try:
+            while data:
+                output.append(self._decompressor.decompress(data))
+                if not self._decompressor.eof:
+                    break
+                # the member ended, anything after it is the next member
+                data = self._decompressor.unused_data
+                if not data.strip(b"\0"):
+                    # some tools pad the stream with zeros after the last member
+                    break
+                self._decompressor = self._new_decompressor()
+        except _DECOMPRESSION_ERRORS as e:
+            raise DecompressionError(f"Invalid {self.compression} stream: {e}")
+        return b"".join(output)
+
+    def flush(self) -> bytes:
+        """Returns the remaining output, once all the input was given. Fails if the stream was cut short."""
+        if not self._decompressor.eof:
+            raise DecompressionError(f"The {self.compression} stream ended before it was complete")
+        return b""
+
+
+class LayerDecompressor:
+    """
+    Decompresses a layer into the cache in a worker thread, while the compressed blob is still being downloaded. The
+    compressed chunks are handed over with ``feed()`` and the uncompressed tar is written with a ``LayerWriter`` under
+    its diff_id, so that its digest is computed along the way and verified by ``finish()``. Neither the decompression
+    nor the hashing run on the event loop, and the download only waits for the worker thread when it is more than
+    ``max_pending`` chunks ahead.
+
+    If the context exits before ``finish()``, for example because the download failed, the uncompressed content is
+    discarded.
+    """
+
+    def __init__(
+        self,
+        diff_id: str,
+        compression: str = "gzip",
+        repository: Optional[str] = None,
+        max_pending: int = MAX_PENDING_CHUNKS,
+    ):
+        self.diff_id = diff_id
+        self.compression = compression
+        self.repository = repository
+        self._queue = queue.Queue(max_pending)
+        self._aborted = threading.Event()
+        self._ended = False
+        self._done: Optional[asyncio.Future] = None
+
+    async def __aenter__(self) -> "LayerDecompressor":
+        loop = asyncio.get_running_loop()
+        self._done = loop.create_future()
+        # a thread of its own rather than the default executor, since it can wait for chunks as long as the download
+        # lasts, and the executor is also used to hand the chunks over
+        thread = threading.Thread(target=self._run, args=(loop,), name=f"decompress-{self.diff_id}", daemon=True)
+        thread.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._done.done():
+            self._aborted.set()
+            try:
+                # wakes the worker up, if it is waiting for a chunk
+                self._queue.put_nowait(_END)
+            except queue.Full:
+                pass
+            # the worker reports the abort as an error, which is expected here
+            self._done.add_done_callback(lambda future: future.exception())
+
+    async def feed(self, chunk: bytes):
+        """Hands the next chunk of the compressed blob over to the worker thread."""
+        if self._done.done():
+            # the worker failed, so the download can stop right away
+            self._done.result()
+        await self._put(chunk)
+
+    async def feed_file(self, path: pathlib.Path, size: Optional[int] = None):
+        """Feeds the first ``size`` bytes of a file, such as the part of the blob downloaded by an earlier attempt."""
+        with open(path, "rb") as f:
+            while size is None or size > 0:
+                chunk = await asyncio.to_thread(f.read, READ_CHUNK_SIZE if size is None else min(READ_CHUNK_SIZE, size))
+                if not chunk:
+                    break
+                if size is not None:
+                    size -= len(chunk)
+                await self.feed(chunk)
+
+    async def restart(self):
+        """Drops everything fed so far, when the download of the compressed blob starts over."""
+        await self._put(_RESTART)
+
+    async def finish(self) -> pathlib.Path:
+        """Waits for the worker to decompress the remaining chunks and returns the path of the uncompressed layer."""
+        await self._put(_END)
+        return await self._done
+
+    async def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(self._queue.put, item)
+
+    def _run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            result = self._decompress()
+        except BaseException as e:
+            # keeps taking chunks until the end, so that the download never waits for a worker that is gone
+            while not (self._ended or self._aborted.is_set()):
+                self._ended = self._queue.get() is _END
+            _resolve(loop, self._done, exception=e)
+        else:
+            _resolve(loop, self._done, result=result)
+
+    def _decompress(self) -> pathlib.Path:
+        with LayerWriter(self.diff_id, self.repository) as writer:
+            try:
+                # the state of the decompressor cannot be stored, so it always starts from the beginning
+                writer.truncate()
+                decompressor = StreamDecompressor(self.compression)
+                while True:
+                    item = self._queue.get()
+                    if self._aborted.is_set():
+                        raise DecompressionError(f"Decompression of {self.diff_id} was aborted")
+                    if item is _END:
+                        self._ended = True
+                        break
+                    if item is _RESTART:
+                        writer.truncate()
+                        decompressor = StreamDecompressor(self.compression)
+                        continue
+                    writer.write(decompressor.decompress(item))
+                writer.write(decompressor.flush())
+            except BaseException:
+                writer.discard()
+                raise
+            return writer.commit()
+
+
+class LayerTarReader:
+    """
+    Reads the members of a layer in a worker thread, while the compressed blob is still being downloaded. The chunks
+    handed over with ``feed()`` are decompressed and parsed by ``tarfile`` in streaming mode, so that the layer is never
+    held in memory, nor written to disk. Each member is passed to ``on_member`` along with a file object for its content
+    (or None if it is not a regular file), which can only be read during the call.
+
+    ``on_member`` returns True once it has everything it needs. The reading then stops, and ``done`` tells the download
+    that the rest of the blob is not needed.
+
+    >>> async with LayerTarReader(lambda member, f: member.name == "etc/os-release") as reader:
+    ...     async for chunk in response.content.iter_any():
+    ...         await reader.feed(chunk)
+    ...         if reader.done:
+    ...             break
+    ...     await reader.finish()
+    """
+
+    def __init__(
+        self,
+        on_member: Callable[[tarfile.TarInfo, Optional[BinaryIO]], bool],
+        compression: Optional[str] = "gzip",
+        name: str = "layer",
+        max_pending: int = MAX_PENDING_CHUNKS,
+    ):
+        self.on_member = on_member
+        self.compression = compression
+        self.name = name
+        self._queue = queue.Queue(max_pending)
+        self._aborted = threading.Event()
+        self._ended = False
+        self._done: Optional[asyncio.Future] = None
+
+    @property
+    def done(self) -> bool:
+        """Tells if the reading is over, because ``on_member`` found everything or because the worker failed."""
+        return self._done is not None and self._done.done()
+
+    async def __aenter__(self) -> "LayerTarReader":
+        loop = asyncio.get_running_loop()
+        self._done = loop.create_future()
+        thread = threading.Thread(target=self._run, args=(loop,), name=f"untar-{self.name}", daemon=True)
+        thread.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._done.done() or not self._ended:
+            self._aborted.set()
+            try:
+                self._queue.put_nowait(_END)
+            except queue.Full:
+                pass
+            self._done.add_done_callback(lambda future: future.exception())
+
+    async def feed(self, chunk: bytes):
+        """Hands the next chunk of the compressed blob over to the worker thread."""
+        if self._done.done():
+            # raises the error of the worker, if any, and otherwise drops the chunks nobody needs
+            self._done.result()
+            return
+        await self._put(chunk)
+
+    async def finish(self):
+        """Waits for the worker to read the remaining chunks, once the whole blob was fed or ``done`` is set."""
+        await self._put(_END)
+        await self._done
+
+    async def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(self._queue.put, item)
+
+    def _run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            self._read()
+        except BaseException as e:
+            _resolve(loop, self._done, exception=e)
+        else:
+            _resolve(loop, self._done)
+        # keeps taking chunks until the end, so that the download never waits for a worker that is gone
+        while not (self._ended or self._aborted.is_set()):
+            self._ended = self._queue.get() is _END
+
+    def _read(self):
+        stream = _QueueStream(self._queue, self.compression, self._aborted, self.name)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    if self.on_member(member, tar.extractfile(member) if member.isreg() else None):
+                        return
+        except tarfile.ReadError as e:
+            raise DecompressionError(f"Layer {self.name} is not a valid tar-file: {e}") from None
+        finally:
+            self._ended = stream.ended
+
+
+class _QueueStream:
+    """Minimal file object over the chunks of a ``queue.Queue``, decompressing them, for ``tarfile`` in stream mode."""
+
+    def __init__(self, chunks: queue.Queue, compression: Optional[str], aborted: threading.Event, name: str):
+        self._chunks = chunks
+        self._decompressor = StreamDecompressor(compression) if compression is not None else None
+        self._aborted = aborted
+        self._name = name
+        self._buffer = bytearray()
+        self.ended = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.ended and (size < 0 or len(self._buffer) < size):
+            item = self._chunks.get()
+            if self._aborted.is_set():
+                raise DecompressionError(f"Reading of layer {self._name} was aborted")
+            if item is _END:
+                self.ended = True
+                if self._decompressor is not None:
+                    self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(item) if self._decompressor is not None else item
+        size = len(self._buffer) if size < 0 else size
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, result=None, exception=None):
+    def _set():
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    try:
+        loop.call_soon_threadsafe(_set)
+    except RuntimeError:
+        # the event loop was closed, so nobody is waiting for the result anymore
+        pass
+
+
+class ParallelCompressor:
+    """
+    Compresses a stream with gzip in blocks that are compressed in parallel by a pool of threads, like pigz does. Each
+    block is compressed on its own, with the end of the previous block as dictionary, and the compressed blocks are
+    joined into a single gzip member that any gzip decoder reads. zlib releases the GIL while it compresses, so the
+    blocks are compressed at the same time. The output only depends on the content, the level and the block size, so
+    compressing the same layer again gives the same digest.
+
+    The digest of the uncompressed content is computed along the way, and is available in ``diff_id`` once the stream
+    is exhausted:
+
+    >>> compressor = ParallelCompressor()
+    >>> async for chunk in compressor.compress(open("layer.tar", "rb")):
+    ...     upload(chunk)
+    >>> compressor.diff_id
+    'sha256:...'
+    """
+
+    def __init__(
+        self,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        block_size: int = COMPRESSION_BLOCK_SIZE,
+        workers: Optional[int] = None,
+    ):
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._crc = 0
+
+    @property
+    def diff_id(self) -> str:
+        return f"sha256:{self._hash.hexdigest()}"
+
+    def _update(self, block: bytes):
+        self._hash.update(block)
+        self._crc = zlib.crc32(block, self._crc)
+        self.size += len(block)
+
+    async def compress(self, f: BinaryIO) -> AsyncIterator[bytes]:
+        """Reads the file in blocks and yields the compressed stream, in order."""
+        loop = asyncio.get_running_loop()
+        pending: Deque[asyncio.Future] = collections.deque()
+        # the blocks are compressed by any thread of the pool, but hashed in order by a single one
+        with ThreadPoolExecutor(self.workers, "compress") as pool, ThreadPoolExecutor(1, "compress-hash") as hasher:
+            yield _GZIP_HEADER
+            block, dictionary = await asyncio.to_thread(f.read, self.block_size), b""
+            while True:
+                # the last block has to be known, since it is the one that ends the deflate stream
+                next_block = await asyncio.to_thread(f.read, self.block_size)
+                last = not next_block
+                pending.append(loop.run_in_executor(pool, _deflate_block, block, dictionary, self.level, last))
+                hashed = loop.run_in_executor(hasher, self._update, block)
+                dictionary = block[-_DICTIONARY_SIZE:]
+                # only a few blocks are compressed ahead, so that memory usage does not depend on the layer size
+                while len(pending) > 2 * self.workers:
+                    yield await pending.popleft()
+                if last:
+                    break
+                block = next_block
+            while pending:
+                yield await pending.popleft()
+            await hashed
+        yield struct.pack("<II", self._crc, self.size & 0xFFFFFFFF)
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    """
+    Compresses a block into raw deflate data. Blocks other than the last end with a sync flush, which aligns them to a
+    byte boundary without ending the stream, so that the next block can simply be appended.
+    """
+    kwargs = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
@@ -2,13 +2,21 @@ import io
 import json
 import os
 import pathlib
+import shutil
 import tarfile
-import tempfile
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 from crpy.common import compute_sha256
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# ioctl to clone a file on copy-on-write file systems, from linux/fs.h
+_FICLONE = 0x40049409
+
 INPUT_TYPES = Union[bytes, pathlib.Path, str, io.StringIO, dict, None]
 
 
@@ -41,6 +49,20 @@ class Blob:
     def as_dict(self):
         return json.loads(self.as_bytes())
 
+    def open(self) -> BinaryIO:
+        """Opens the blob for reading, without loading files from disk into memory."""
+        if self.path:
+            return open(self.path, "rb")
+        else:
+            return io.BytesIO(self.content)
+
+    @property
+    def size(self) -> int:
+        if self.path:
+            return self.path.stat().st_size
+        else:
+            return len(self.content)
+
     def sha256_sum(self):
         file = self.path if self.path is not None else self.content
         if not self.digest:
@@ -86,32 +108,167 @@ class Image:
     def layers(self, layers: List[INPUT_TYPES]):
         self._layers = [Blob.from_any(layer) for layer in layers]
 
-    def to_disk(self, filename: pathlib.Path, tags: List[str] = None):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            web_manifest = self.manifest.as_dict()
-            config_filename = f'{web_manifest["config"]["digest"].split(":")[1]}.json'
-            with open(f"{temp_dir}/{config_filename}", "wb") as outfile:
-                outfile.write(self.config.as_bytes())
-
-            layer_path_l = []
-            for layer in self.layers:
-                layer_bytes = layer.as_bytes()
-                layer_folder = layer.sha256_sum()
-                path = layer_folder + "/layer.tar"
-                os.makedirs(f"{temp_dir}/{layer_folder}", exist_ok=True)
-                with open(f"{temp_dir}/{path}", "wb") as f:
-                    f.write(layer_bytes)
-                layer_path_l.append(path)
-
-            manifest = [{"Config": config_filename, "RepoTags": tags or [], "Layers": layer_path_l}]
-            with open(f"{temp_dir}/manifest.json", "w") as outfile:
-                json.dump(manifest, outfile)
-
-            if isinstance(filename, io.BytesIO):
-                output_kwargs = {"fileobj": filename, "mode": "w"}
-            else:
-                output_kwargs = {"name": filename, "mode": "w"}
-            with tarfile.open(**output_kwargs) as tar_out:
-                os.chdir(temp_dir)
-                tar_out.add(".")
-                os.chdir("..")
+    def to_disk(self, filename: Union[str, pathlib.Path, BinaryIO], tags: List[str] = None):
+        """
+        Writes the image as a tar-file compatible with ``docker load``. The tar headers are written directly to the
+        output and each member is streamed from its source (cache file or in-memory content), so nothing is staged in a
+        temporary directory.
+
+        :param filename: path or file-like object to write the tar-file to.
+        :param tags: list of tags to be assigned to the image when loaded.
+        """
+        images_to_disk(filename, [(self, tags or [])])
+
+    def to_oci_layout(self, directory: Union[str, pathlib.Path], tags: List[str] = None):
+        """
+        Writes the image as an OCI image layout directory. See ``images_to_oci_layout()``.
+
+        :param directory: directory to write the layout to. It is created if it does not exist.
+        :param tags: list of tags to be assigned to the image, stored as reference names in the ``index.json``.
+        """
+        images_to_oci_layout(directory, [(self, tags or [])])
+
+
+def images_to_disk(filename: Union[str, pathlib.Path, BinaryIO], images: List[Tuple[Image, List[str]]]):
+    """
+    Writes several images to a single tar-file compatible with ``docker load``, such as the images of each platform of a
+    multi-platform image. Each image gets its own entry in the ``manifest.json``, and layers shared between images are
+    only stored once.
+
+    :param filename: path or file-like object to write the tar-file to.
+    :param images: list of images, along with the tags to be assigned to each of them when loaded.
+    """
+    entries = []
+    for image, tags in images:
+        web_manifest = image.manifest.as_dict()
+        config_filename = f'{web_manifest["config"]["digest"].split(":")[1]}.json'
+        layer_path_l = [f"{layer.sha256_sum()}/layer.tar" for layer in image.layers]
+        entries.append({"Config": config_filename, "RepoTags": tags, "Layers": layer_path_l})
+
+    if isinstance(filename, (str, pathlib.Path)):
+        output_kwargs = {"name": filename, "mode": "w"}
+    else:
+        output_kwargs = {"fileobj": filename, "mode": "w"}
+    with tarfile.open(**output_kwargs) as tar_out:
+        _add_directory(tar_out, ".")
+        written = set()
+        for (image, _), entry in zip(images, entries):
+            if entry["Config"] not in written:
+                written.add(entry["Config"])
+                _add_blob(tar_out, f"./{entry['Config']}", image.config)
+            for layer, path in zip(image.layers, entry["Layers"]):
+                # images can reference the same layer more than once, but it only needs to be stored once
+                if path in written:
+                    continue
+                written.add(path)
+                _add_directory(tar_out, f"./{path.split('/')[0]}")
+                _add_blob(tar_out, f"./{path}", layer)
+        _add_blob(tar_out, "./manifest.json", Blob.from_any(json.dumps(entries).encode()))
+
+
+def images_to_oci_layout(directory: Union[str, pathlib.Path], images: List[Tuple[Image, List[str]]]):
+    """
+    Writes several images to an OCI image layout directory (``oci-layout``, ``index.json`` and ``blobs/sha256/``), as
+    described in https://github.com/opencontainers/image-spec/blob/main/image-layout.md.
+
+    Blobs stored on disk (i.e. in the layer cache) are hardlinked into the layout when possible, or reflinked on file
+    systems that support it, so writing a cached image takes no time and no extra disk space. They are only copied as
+    a last resort, for example when the layout is on another file system. Blobs already in the layout are kept, so an
+    existing layout can be updated with new images.
+
+    :param directory: directory to write the layout to. It is created if it does not exist.
+    :param images: list of images, along with the tags to be assigned to each of them.
+    """
+    directory = pathlib.Path(directory)
+    blobs_dir = directory / "blobs" / "sha256"
+    blobs_dir.mkdir(parents=True, exist_ok=True)
+    index_file = directory / "index.json"
+    if index_file.is_file():
+        index = json.loads(index_file.read_text())
+    else:
+        index = {"schemaVersion": 2, "mediaType": "application/vnd.oci.image.index.v1+json", "manifests": []}
+
+    for image, tags in images:
+        for blob in [image.config, *image.layers]:
+            _write_oci_blob(blobs_dir, blob)
+        manifest = image.manifest.as_dict()
+        manifest_digest = image.manifest.sha256_sum()
+        _write_oci_blob(blobs_dir, image.manifest)
+        config = image.config.as_dict()
+        platform = {key: config[key] for key in ("os", "architecture", "variant") if config.get(key)}
+        descriptor = {
+            "mediaType": manifest.get("mediaType", "application/vnd.oci.image.manifest.v1+json"),
+            "digest": f"sha256:{manifest_digest}",
+            "size": image.manifest.size,
+        }
+        if "os" in platform and "architecture" in platform:
+            descriptor["platform"] = platform
+        # each tag is a separate entry, as a manifest can only have one reference name. Entries for the same tag are
+        # replaced, so that pulling a tag again into the same layout points it to the new image.
+        for name in [_reference_name(tag) for tag in tags]:
+            index["manifests"] = [m for m in index["manifests"] if _annotated_name(m) != name]
+            index["manifests"].append({**descriptor, "annotations": {"org.opencontainers.image.ref.name": name}})
+        if not tags and descriptor["digest"] not in [m["digest"] for m in index["manifests"]]:
+            index["manifests"].append(descriptor)
+
+    (directory / "oci-layout").write_text(json.dumps({"imageLayoutVersion": "1.0.0"}))
+    index_file.write_text(json.dumps(index, indent=2))
+
+
+def _reference_name(tag: str) -> str:
+    """
+    >>> _reference_name("localhost:5000/library/alpine:3.18")
+    '3.18'
+    """
+    name = tag.rsplit("/", 1)[-1]
+    return name.split(":", 1)[1] if ":" in name else "latest"
+
+
+def _annotated_name(descriptor: dict) -> Optional[str]:
+    return descriptor.get("annotations", {}).get("org.opencontainers.image.ref.name")
+
+
+def _write_oci_blob(blobs_dir: pathlib.Path, blob: Blob):
+    target = blobs_dir / blob.sha256_sum()
+    if target.exists():
+        return
+    if blob.path is not None:
+        link_or_copy(blob.path, target)
+    else:
+        target.write_bytes(blob.content)
+
+
+def link_or_copy(source: Union[str, pathlib.Path], target: Union[str, pathlib.Path]):
+    """
+    Makes ``target`` a copy of ``source`` without duplicating the data, if possible. A hardlink is tried first, then a
+    reflink (copy-on-write clone, supported by btrfs and xfs), then a regular copy.
+    """
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    tmp_target = pathlib.Path(f"{target}.{os.getpid()}.tmp")
+    with open(source, "rb") as src, open(tmp_target, "wb") as dst:
+        try:
+            if fcntl is None:
+                raise OSError("reflinks are not supported on this platform")
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_target, target)
+
+
+def _add_directory(tar: tarfile.TarFile, name: str):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    tar.addfile(info)
+
+
+def _add_blob(tar: tarfile.TarFile, name: str, blob: Blob):
+    info = tarfile.TarInfo(name)
+    info.size = blob.size
+    info.mode = 0o644
+    with blob.open() as f:
+        tar.addfile(info, f)
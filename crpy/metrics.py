@@ -0,0 +1,232 @@
+"""
+Counters and histograms describing what crpy spent its time on: requests by endpoint and status, bytes transferred,
+cache hits and misses, retries and the time spent in each phase of pulls and pushes.
+
+Metrics are collected by the ``HTTPClient`` they are attached to, so a single object aggregates all registries sharing
+that client:
+
+>>> metrics = Metrics()
+>>> async with RegistryInfo.from_url("alpine:latest", client=HTTPClient(metrics=metrics)) as ri:
+...     await ri.pull("alpine.tar")
+>>> metrics.write("/var/lib/node_exporter/crpy.prom")
+
+The output can be written as a Prometheus textfile (for the node exporter textfile collector) or as JSON.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import pathlib
+import re
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Tuple, Union
+from urllib.parse import urlparse
+
+import aiohttp
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_descriptions = {
+    "crpy_requests_total": "HTTP requests made, by endpoint, method and status.",
+    "crpy_request_duration_seconds": "Time until the response headers were received, by endpoint.",
+    "crpy_bytes_received_total": "Bytes received in response bodies, by endpoint.",
+    "crpy_bytes_sent_total": "Bytes sent in request bodies, by endpoint.",
+    "crpy_cache_hits_total": "Blobs served from the local cache.",
+    "crpy_cache_misses_total": "Blobs that had to be downloaded.",
+    "crpy_blobs_skipped_total": "Blobs that were not uploaded because they already existed at the remote.",
+    "crpy_retries_total": "Failed requests and interrupted transfers that were retried, by operation.",
+    "crpy_signed_url_hits_total": "Blob downloads sent straight to a cached, signed url of the blob storage.",
+    "crpy_hedged_requests_total": "Blob downloads that were sent a second time because the response was slow.",
+    "crpy_phase_seconds": "Time spent in each phase of an operation.",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    counts: List[int] = field(default_factory=list)
+    sum: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        if not self.counts:
+            self.counts = [0] * len(self.buckets)
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class Metrics:
+    """Collection of counters and histograms, keyed by metric name and labels."""
+
+    def __init__(self):
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        series = self.counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        self.histograms.setdefault(name, {}).setdefault(_labels(labels), Histogram()).observe(value)
+
+    @contextlib.contextmanager
+    def time(self, phase: str, **labels: str) -> Iterator[None]:
+        """Measures the time spent in a phase, like ``metrics.time("download", operation="pull")``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("crpy_phase_seconds", time.perf_counter() - start, phase=phase, **labels)
+
+    def get(self, name: str, **labels: str) -> float:
+        """Returns the sum of a counter over all series matching the given labels."""
+        return sum(
+            value
+            for key, value in self.counters.get(name, {}).items()
+            if all(dict(key).get(label) == label_value for label, label_value in labels.items())
+        )
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """Returns an aiohttp trace config that records the requests and bytes of a client session."""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            context.start = time.perf_counter()
+
+        async def on_request_chunk_sent(session, context, params: aiohttp.TraceRequestChunkSentParams):
+            self.inc("crpy_bytes_sent_total", len(params.chunk), endpoint=_endpoint(str(params.url)))
+
+        async def on_response_chunk_received(session, context, params: aiohttp.TraceResponseChunkReceivedParams):
+            self.inc("crpy_bytes_received_total", len(params.chunk), endpoint=_endpoint(str(params.url)))
+
+        async def on_request_end(session, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            self._request_done(context, params.method, str(params.url), str(params.response.status))
+
+        async def on_request_exception(session, context, params: aiohttp.TraceRequestExceptionParams):
+            self._request_done(context, params.method, str(params.url), "error")
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def _request_done(self, context: SimpleNamespace, method: str, url: str, status: str):
+        endpoint = _endpoint(url)
+        self.inc("crpy_requests_total", endpoint=endpoint, method=method, status=status)
+        if hasattr(context, "start"):
+            self.observe("crpy_request_duration_seconds", time.perf_counter() - context.start, endpoint=endpoint)
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": {
+                name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                for name, series in self.counters.items()
+            },
+            "histograms": {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(zip(map(str, histogram.buckets), histogram.cumulative_counts())),
+                    }
+                    for key, histogram in series.items()
+                ]
+                for name, series in self.histograms.items()
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """Formats the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, series in self.counters.items():
+            lines += [f"# HELP {name} {_descriptions.get(name, name)}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(key)} {value:g}" for key, value in series.items()]
+        for name, series in self.histograms.items():
+            lines += [f"# HELP {name} {_descriptions.get(name, name)}", f"# TYPE {name} histogram"]
+            for key, histogram in series.items():
+                for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum:g}")
+                lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Union[str, pathlib.Path]):
+        """
+        Writes the metrics to a file, as JSON if the file name ends with ``.json``, otherwise in the Prometheus text
+        format. The file is replaced atomically, so that collectors never read a partially written file.
+        """
+        path = pathlib.Path(path)
+        content = json.dumps(self.to_dict(), indent=2) if path.suffix == ".json" else self.to_prometheus()
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
+
+
+class _NullMetrics(Metrics):
+    """Metrics that discard everything, used when no metrics are collected."""
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        pass
+
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+
+null_metrics = _NullMetrics()
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = ((key, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _endpoint(url: str) -> str:
+    """
+    Classifies a registry url by the API endpoint it belongs to, so that metrics do not have one series per blob.
+
+    >>> _endpoint("https://registry-1.docker.io/v2/library/alpine/blobs/sha256:1234")
+    'blobs'
+    >>> _endpoint("https://registry-1.docker.io/v2/library/alpine/blobs/uploads/5678")
+    'uploads'
+    """
+    path = urlparse(url).path
+    if not path.startswith("/v2/"):
+        # token servers and blob storage (after a redirect) live outside of the registry api
+        return "token" if "token" in path else "external"
+    if path in ("/v2/", "/v2"):
+        return "base"
+    if path.startswith("/v2/_catalog"):
+        return "catalog"
+    match = re.search(r"/(manifests|blobs/uploads|blobs|tags)/", path)
+    if match is None:
+        return "other"
+    return {"blobs/uploads": "uploads"}.get(match.group(1), match.group(1))
@@ -0,0 +1,185 @@
+"""
+Structured progress events for blob transfers. Pass a callback to ``RegistryInfo(progress=...)`` to receive an event
+whenever a blob starts, makes progress, finishes, is served from the cache, is skipped or is retried:
+
+>>> def on_progress(event: ProgressEvent):
+...     if event.kind == ProgressKind.FINISHED:
+...         print(f"{event.digest} took {event.elapsed:.1f}s")
+>>> ri = RegistryInfo.from_url("alpine:latest")
+>>> ri.progress = on_progress
+
+The command line uses ``RichProgress`` to display one progress bar per blob.
+"""
+
+import enum
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+from rich.console import Console
+from rich.progress import (
+    BarColumn,
+    DownloadColumn,
+    Progress,
+    TaskID,
+    TextColumn,
+    TimeRemainingColumn,
+    TransferSpeedColumn,
+)
+
+
+class ProgressKind(enum.Enum):
+    # the transfer of a blob started (or resumed, in which case ``transferred`` is not zero)
+    STARTED = "started"
+    # bytes were transferred, ``delta`` contains how many since the last event
+    PROGRESS = "progress"
+    # the blob was fully transferred and verified
+    FINISHED = "finished"
+    # the blob was found in the local cache, so it was not downloaded
+    CACHED = "cached"
+    # the blob already exists at the remote, so it was not uploaded
+    SKIPPED = "skipped"
+    # the transfer failed and is being retried, ``message`` contains the reason
+    RETRY = "retry"
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    """
+    Progress of the transfer of a single blob.
+
+    :param kind: what happened, see ``ProgressKind``.
+    :param digest: digest of the blob. Looks something like "sha256:1234..."
+    :param operation: "download" or "upload".
+    :param transferred: bytes of the blob transferred so far.
+    :param total: size of the blob in bytes, if known.
+    :param delta: bytes transferred since the previous event for the same blob.
+    :param elapsed: seconds since the transfer of the blob started.
+    :param message: human-readable detail, for example the reason of a retry.
+    """
+
+    kind: ProgressKind
+    digest: str
+    operation: str
+    transferred: int = 0
+    total: Optional[int] = None
+    delta: int = 0
+    elapsed: float = 0.0
+    message: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+class ProgressTracker:
+    """
+    Emits the events for the transfer of a single blob, keeping count of the transferred bytes and the elapsed time.
+    A tracker without callback does nothing, so it can be used unconditionally.
+    """
+
+    def __init__(self, callback: Optional[ProgressCallback], digest: str, operation: str, total: Optional[int] = None):
+        self.callback = callback
+        self.digest = digest
+        self.operation = operation
+        self.total = total
+        self.transferred = 0
+        self._start = time.monotonic()
+
+    def _emit(self, kind: ProgressKind, delta: int = 0, message: Optional[str] = None):
+        if self.callback is None:
+            return
+        self.callback(
+            ProgressEvent(
+                kind=kind,
+                digest=self.digest,
+                operation=self.operation,
+                transferred=self.transferred,
+                total=self.total,
+                delta=delta,
+                elapsed=time.monotonic() - self._start,
+                message=message,
+            )
+        )
+
+    def started(self, transferred: int = 0, total: Optional[int] = None):
+        self.transferred = transferred
+        if total is not None:
+            self.total = total
+        self._emit(ProgressKind.STARTED)
+
+    def advance(self, delta: int):
+        self.transferred += delta
+        self._emit(ProgressKind.PROGRESS, delta=delta)
+
+    def restart(self, transferred: int):
+        """Sets the transferred bytes back, when a transfer resumes from an earlier offset."""
+        self.transferred = transferred
+
+    def finished(self):
+        if self.total is None:
+            self.total = self.transferred
+        self._emit(ProgressKind.FINISHED)
+
+    def cached(self):
+        self._emit(ProgressKind.CACHED)
+
+    def skipped(self):
+        self._emit(ProgressKind.SKIPPED)
+
+    def retry(self, message: str):
+        self._emit(ProgressKind.RETRY, message=message)
+
+
+class RichProgress:
+    """
+    Progress callback that displays one ``rich`` progress bar per blob, with throughput and estimated time remaining.
+    Use it as a context manager, so that the display is started and stopped:
+
+    >>> with RichProgress() as progress:
+    ...     async with RegistryInfo.from_url("alpine:latest", progress=progress) as ri:
+    ...         await ri.pull("alpine.tar")
+    """
+
+    _descriptions = {
+        ProgressKind.STARTED: "{operation}",
+        ProgressKind.PROGRESS: "{operation}",
+        ProgressKind.FINISHED: "[green]Done",
+        ProgressKind.CACHED: "[green]Using cache",
+        ProgressKind.SKIPPED: "[green]Already exists",
+        ProgressKind.RETRY: "[yellow]Retrying",
+    }
+
+    def __init__(self, console: Optional[Console] = None):
+        self.progress = Progress(
+            TextColumn("{task.fields[digest]}"),
+            TextColumn("{task.description:<16}"),
+            BarColumn(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+            TimeRemainingColumn(),
+            console=console or Console(stderr=True),
+        )
+        self._tasks: Dict[Tuple[str, str], TaskID] = {}
+
+    def __enter__(self) -> "RichProgress":
+        self.progress.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.progress.stop()
+
+    def __call__(self, event: ProgressEvent):
+        key = (event.operation, event.digest)
+        description = self._descriptions[event.kind].format(operation=f"{event.operation.capitalize()}ing")
+        if key not in self._tasks:
+            self._tasks[key] = self.progress.add_task(
+                description, total=event.total, completed=event.transferred, digest=event.digest.split(":")[-1][:12]
+            )
+        task = self._tasks[key]
+        if event.kind in (ProgressKind.FINISHED, ProgressKind.CACHED, ProgressKind.SKIPPED):
+            # the bar is filled, so that it is clear that nothing is left to transfer
+            total = event.total or event.transferred or 1
+            self.progress.update(task, description=description, total=total, completed=total)
+        else:
+            self.progress.update(task, description=description, total=event.total, completed=event.transferred)
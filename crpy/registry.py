@@ -1,28 +1,82 @@
-import functools
+import asyncio
+import contextlib
+import hashlib
 import io
 import json
+import os
 import pathlib
 import re
+import shutil
 import sys
 import tarfile
-import tempfile
-from dataclasses import dataclass
-from typing import List, Optional, Union
+import threading
+import weakref
+from dataclasses import dataclass, field
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urljoin
 
+import aiohttp
 from async_lru import alru_cache
 from rich import print as rprint
 
-from crpy.auth import get_token, get_url_from_auth_header
+from crpy.auth import (
+    TokenCache,
+    default_token_cache,
+    fetch_token,
+    get_identity,
+    parse_auth_header,
+)
 from crpy.common import (
+    DigestMismatchError,
+    HTTPClient,
+    HTTPConnectionError,
+    HTTPResponseError,
     Platform,
     Response,
+    UnauthorizedError,
+    _open_stream,
     _request,
-    _stream,
-    compute_sha256,
+    compute_sha256_from_file,
     platform_from_dict,
 )
-from crpy.image import Blob, Image
-from crpy.storage import get_credentials, get_layer_from_cache, save_layer
+from crpy.compression import (
+    MAX_PENDING_CHUNKS,
+    READ_CHUNK_SIZE,
+    DecompressionError,
+    LayerDecompressor,
+    LayerTarReader,
+    ParallelCompressor,
+    StreamDecompressor,
+    can_decompress,
+    detect_compression,
+    layer_compression,
+)
+from crpy.image import Blob, Image, images_to_disk, images_to_oci_layout
+from crpy.metrics import Metrics, _endpoint, null_metrics
+from crpy.progress import ProgressCallback, ProgressTracker
+from crpy.seekable import (
+    ESTARGZ_FOOTER_SIZE,
+    ZSTD_CHUNKED_MANIFEST_POSITION,
+    LayerToc,
+    TocEntry,
+    estargz_toc_offset,
+    normalize_path,
+    read_estargz_toc,
+    resolve_path,
+)
+from crpy.storage import (
+    LayerWriter,
+    get_compressed_layer,
+    get_credentials,
+    get_layer_path,
+    hold_layer,
+    load_manifest,
+    lock_layer,
+    pin_layers,
+    record_compressed_layer,
+    save_manifest,
+    touch_layer,
+)
 
 # taken from https://github.com/davedoesdev/dxf/blob/master/dxf/__init__.py#L24
 _schema1_mimetype = "application/vnd.docker.distribution.manifest.v1+json"
@@ -38,11 +92,27 @@ _ociv1_index_mimetype = "application/vnd.oci.image.index.v1+json"
 # media types
 _media_type_config = "application/vnd.docker.container.image.v1+json"
 _media_type_layer = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+_media_type_layer_uncompressed = "application/vnd.docker.image.rootfs.diff.tar"
+_media_type_layer_zstd = "application/vnd.oci.image.layer.v1.tar+zstd"
+_layer_media_types = {"gzip": _media_type_layer, "zstd": _media_type_layer_zstd, None: _media_type_layer_uncompressed}
+
+# formats in which pulled images can be written
+OUTPUT_FORMATS = ("docker", "oci")
+# default number of blobs transferred at the same time
+DEFAULT_MAX_CONCURRENCY = 4
+# default size of each chunk in a chunked blob upload
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+# how many times in a row a chunked upload is resumed after a failed chunk, before giving up
+UPLOAD_RESUME_ATTEMPTS = 3
+# how many times an interrupted download is resumed with a range request
+DOWNLOAD_RESUME_ATTEMPTS = 3
 
 
 # we redirect all print statements no stderr, so that piping on command line works as expected. You can then pipe the
-# results to jq or similar without interfering with the logging.
-print = functools.partial(rprint, file=sys.stderr)
+# results to jq or similar without interfering with the logging. The stream is looked up on each call, so that progress
+# displays that redirect stderr (like the one of the command line) can keep the log lines above the progress bars.
+def print(*args, **kwargs):
+    rprint(*args, file=sys.stderr, **kwargs)
 
 
 @dataclass
@@ -55,6 +125,12 @@ class RegistryInfo:
     >>> ri = RegistryInfo.from_url("alpine:latest")
     >>> print(await ri.get_config())
 
+    All requests go through a single pooled ``HTTPClient``, so connections to the registry are kept alive and reused
+    between calls. Use the object as an async context manager to close those connections once you are done:
+
+    >>> async with RegistryInfo.from_url("alpine:latest") as ri:
+    ...     print(await ri.get_config())
+
     See https://containers.gitbook.io/build-containers-the-hard-way/ for an in depth explanation of what is going on.
     """
 
@@ -67,6 +143,34 @@ class RegistryInfo:
     # networking options
     proxy: Optional[str] = None
     insecure: bool = False
+    client: Optional[HTTPClient] = field(default=None, compare=False, repr=False)
+    # tokens are shared between all registries by default, so a new object for the same repository can reuse them
+    token_cache: TokenCache = field(default=default_token_cache, compare=False, repr=False)
+    # keeps manifests on disk, so they are only downloaded again when they change on the registry
+    cache_manifests: bool = True
+    # called with a ``ProgressEvent`` as blobs are transferred, see ``crpy.progress``
+    progress: Optional[ProgressCallback] = field(default=None, compare=False, repr=False)
+    _identity: Optional[str] = field(default=None, init=False, compare=False, repr=False)
+    _auth_lock: Optional[asyncio.Lock] = field(default=None, init=False, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.client is None:
+            self.client = HTTPClient()
+
+    async def __aenter__(self) -> "RegistryInfo":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Closes the pooled connections held by the HTTP client."""
+        await self.client.close()
+
+    @property
+    def metrics(self) -> Metrics:
+        """Metrics collected by the HTTP client. If the client does not collect metrics, they are discarded."""
+        return self.client.metrics or null_metrics
 
     @property
     def _headers(self) -> dict:
@@ -84,6 +188,36 @@ class RegistryInfo:
             kwargs["ssl"] = False
         return kwargs
 
+    async def _reauthenticate(self, www_auth: str, stale_token: Optional[str]):
+        # concurrent requests can all get a 401 at the same time, but only the first one needs to fetch a new token
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        async with self._auth_lock:
+            if self.token == stale_token:
+                entry = self.token_cache.lookup(stale_token) if stale_token is not None else None
+                # the token was rejected or is about to expire, so the cached copy must not be used again. A token
+                # issued for another scope, like a pull token on a push, is still valid for the requests of its scope
+                if entry is not None and entry.scope == parse_auth_header(www_auth).get("scope"):
+                    self.token_cache.invalidate(stale_token)
+                await self.auth(www_auth)
+
+    async def _ensure_token(self):
+        """
+        Attaches a cached token to the first request, avoiding the ``401`` round trip, and refreshes the current token
+        shortly before it expires.
+        """
+        if self.token is None:
+            if self.repository:
+                if self._identity is None:
+                    self._identity = get_identity(b64_token=get_credentials(self.registry))
+                cached = self.token_cache.find(self.registry, self.repository, self._identity)
+                if cached is not None:
+                    self.token = cached.token
+            return
+        entry = self.token_cache.lookup(self.token)
+        if entry is not None and not entry.is_fresh():
+            await self._reauthenticate(entry.www_authenticate, self.token)
+
     async def _request_with_auth(
         self,
         url: str,
@@ -92,9 +226,12 @@ class RegistryInfo:
         params: dict = None,
         data: Union[dict, bytes, None] = None,
         headers: dict = None,
+        idempotent: Optional[bool] = None,
     ) -> Response:
         if not headers:
             headers = {}
+        await self._ensure_token()
+        token = self.token
         response = await _request(
             url,
             {**headers, **self._headers},
@@ -102,10 +239,12 @@ class RegistryInfo:
             data=data,
             method=method,
             aiohttp_kwargs=self._aiohttp_kwargs,
+            client=self.client,
+            idempotent=idempotent,
         )
         if response.status == 401:
             www_auth = response.headers["WWW-Authenticate"]
-            await self.auth(www_auth)
+            await self._reauthenticate(www_auth, token)
             response = await _request(
                 url,
                 {**headers, **self._headers},
@@ -113,11 +252,49 @@ class RegistryInfo:
                 data=data,
                 method=method,
                 aiohttp_kwargs=self._aiohttp_kwargs,
+                client=self.client,
+                idempotent=idempotent,
             )
             if response.status == 401:
                 raise ValueError(f"Could not authenticate to registry {self}")
         return response
 
+    @contextlib.asynccontextmanager
+    async def _open_stream_with_auth(self, url: str, headers: dict = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        if not headers:
+            headers = {}
+        await self._ensure_token()
+        token = self.token
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                response = await stack.enter_async_context(
+                    _open_stream(
+                        url, {**headers, **self._headers}, aiohttp_kwargs=self._aiohttp_kwargs, client=self.client
+                    )
+                )
+            except UnauthorizedError as e:
+                if e.www_authenticate is None:
+                    raise
+                await self._reauthenticate(e.www_authenticate, token)
+                response = await stack.enter_async_context(
+                    _open_stream(
+                        url, {**headers, **self._headers}, aiohttp_kwargs=self._aiohttp_kwargs, client=self.client
+                    )
+                )
+            yield response
+
+    async def _stream_with_auth(self, url: str, headers: dict = None) -> AsyncIterator[bytes]:
+        async with self._open_stream_with_auth(url, headers) as response:
+            async for data in self._iter_chunks(response):
+                yield data
+
+    async def _iter_chunks(self, response: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+        # aiohttp only traces bodies that are read at once, so streamed bodies are counted here
+        endpoint = _endpoint(str(response.url))
+        async for data, _ in response.content.iter_chunks():
+            self.metrics.inc("crpy_bytes_received_total", len(data), endpoint=endpoint)
+            yield data
+
     def v2_url(self):
         method = "https" if self.https else "http"
         return f"{method}://{self.registry}/v2"
@@ -145,29 +322,52 @@ class RegistryInfo:
         b64_token: str = None,
         use_config: bool = True,
     ):
+        with self.metrics.time("auth"):
+            return await self._auth(www_auth, username, password, b64_token, use_config)
+
+    async def _auth(self, www_auth: str, username: str, password: str, b64_token: str, use_config: bool) -> str:
         if www_auth is None:
             method = "https" if self.https else "http"
             response = await _request(
-                f"{method}://{self.registry}/v2/", method="get", aiohttp_kwargs=self._aiohttp_kwargs
+                f"{method}://{self.registry}/v2/",
+                method="get",
+                aiohttp_kwargs=self._aiohttp_kwargs,
+                client=self.client,
             )
             www_auth = response.headers["WWW-Authenticate"]
         assert www_auth.startswith('Bearer realm="')
         # check if config contains username and password we can use
         if not b64_token and use_config:
             b64_token = get_credentials(self.registry)
-        # reuse this token in consecutive requests
-        self.token = await get_token(
-            get_url_from_auth_header(www_auth),
+        self._identity = get_identity(username, password, b64_token)
+        # tokens from the cache are only used if the credentials were not explicitly provided, i.e. when logging in
+        cached = None if username and password else self.token_cache.get(www_auth, self._identity)
+        if cached is not None:
+            self.token = cached.token
+            return self.token
+        token = await fetch_token(
+            www_auth,
             username=username,
             password=password,
             b64_token=b64_token,
             aiohttp_kwargs=self._aiohttp_kwargs,
+            client=self.client,
         )
+        token.registry = self.registry
+        self.token_cache.add(token)
+        # reuse this token in consecutive requests
+        self.token = token.token
         print(f"Authenticated at {self}")
         return self.token
 
     @staticmethod
-    def from_url(url: str, proxy: str = None, insecure: bool = False) -> "RegistryInfo":
+    def from_url(
+        url: str,
+        proxy: str = None,
+        insecure: bool = False,
+        client: Optional[HTTPClient] = None,
+        progress: Optional[ProgressCallback] = None,
+    ) -> "RegistryInfo":
         """
         Generates a RegistryInfo object from an url, automatically splitting the url into the dataclass fields.
 
@@ -206,7 +406,16 @@ class RegistryInfo:
                 # library image
                 repository_raw = f"library/{repository_raw}"
         name, tag = (repository_raw.split(":") + ["latest"])[:2]
-        return RegistryInfo(registry, name.strip("/"), tag, scheme == "https", proxy=proxy, insecure=insecure)
+        return RegistryInfo(
+            registry,
+            name.strip("/"),
+            tag,
+            scheme == "https",
+            proxy=proxy,
+            insecure=insecure,
+            client=client,
+            progress=progress,
+        )
 
     @alru_cache
     async def get_manifest(self, fat: bool = False, reference: Optional[str] = None) -> Response:
@@ -221,7 +430,17 @@ class RegistryInfo:
             manifest by doing a fat manifest query then getting the correct reference for the architecture. Use the
             method `get_manifest_from_architecture()` for that.
         :return: Response object with status code, raw data and response headers.
+
+        Manifests are kept on disk between calls. Manifests referenced by digest never change, so they are returned
+        without contacting the registry. For tags, the cached copy is revalidated with ``If-None-Match``, so the
+        registry only sends the manifest again if the tag now points somewhere else.
         """
+        reference = reference or self.tag
+        cached = None
+        if self.cache_manifests:
+            cached = await asyncio.to_thread(load_manifest, self.registry, self.repository, reference, fat)
+            if cached is not None and reference.startswith("sha256:"):
+                return Response(200, *cached)
         base_headers = (
             _schema1_mimetype,
             _schema2_mimetype,
@@ -233,10 +452,27 @@ class RegistryInfo:
                 _ociv1_index_mimetype,
             )
         headers = {"Accept": ", ".join(base_headers)}
+        if cached is not None:
+            cached_headers = {k.lower(): v for k, v in cached[1].items()}
+            etag = cached_headers.get("etag") or cached_headers.get("docker-content-digest")
+            if etag:
+                headers["If-None-Match"] = etag if etag.startswith('"') else f'"{etag}"'
         response = await self._request_with_auth(self.manifest_url(reference), method="get", headers=headers)
+        if response.status == 304 and cached is not None:
+            return Response(200, *cached)
+        if response.status == 200 and self.cache_manifests:
+            await asyncio.to_thread(
+                save_manifest, self.registry, self.repository, reference, fat, response.data, response.headers
+            )
         return response
 
     async def get_manifest_from_architecture(self, architecture: Union[str, Platform, None] = None) -> dict:
+        response = await self._get_manifest_response_from_architecture(architecture)
+        return response.json()
+
+    async def _get_manifest_response_from_architecture(
+        self, architecture: Union[str, Platform, None] = None
+    ) -> Response:
         if isinstance(architecture, Platform):
             architecture = architecture.value
         elif isinstance(architecture, str):
@@ -255,15 +491,13 @@ class RegistryInfo:
                     # the short manifest does not contain any layers, that is why we have to then re-query the API
                     # to get the full one, passing the digest as reference name.
                     short_manifest = manifests["manifests"][idx]
-                    full_manifest = await self.get_manifest(reference=short_manifest["digest"])
-                    return full_manifest.json()
+                    return await self.get_manifest(reference=short_manifest["digest"])
             raise ValueError(
                 f"No matching manifest for {architecture} in the manifest list entries at {self}.\n"
                 f"Available architectures: {available_architectures}"
             )
         else:
-            manifest = await self.get_manifest()
-            return manifest.json()
+            return await self.get_manifest()
 
     @alru_cache
     async def get_config(self, architecture: Union[str, Platform] = None) -> Response:
@@ -280,11 +514,361 @@ class RegistryInfo:
         if manifest["mediaType"] in (_ociv1_index_mimetype, _schema2_list_mimetype):
             default_platform = Platform.from_dict(manifest["manifests"][0]["platform"])
             manifest = await self.get_manifest_from_architecture(default_platform)
-        config_digest = manifest["config"]["digest"]
-        response = await self._request_with_auth(
-            f"{self.blobs_url()}/{config_digest}", method="get", headers=self._headers
+        return await self.get_blob(manifest["config"]["digest"])
+
+    async def get_blob(self, digest: str) -> Response:
+        """
+        Downloads a small blob, like an image config, into memory. Redirects to blob storage are followed the same way
+        as for layers, without sending the registry token.
+
+        :param digest: digest of the blob. Looks something like "sha256:1234..."
+        :return: Response object with status code, raw data and response headers.
+        """
+        try:
+            async with self._open_stream_with_auth(f"{self.blobs_url()}/{digest}") as response:
+                return Response(response.status, await response.read(), dict(response.headers))
+        except HTTPResponseError as e:
+            return Response(e.status, str(e).encode(), e.headers)
+
+    async def get_blob_range(self, digest: str, start: int, end: int) -> bytes:
+        """
+        Downloads the bytes ``[start, end)`` of a blob with an HTTP ``Range`` request. Registries that ignore the range
+        send the whole blob, which is then cut to the requested bytes.
+
+        :param digest: digest of the blob. Looks something like "sha256:1234..."
+        :param start: offset of the first byte.
+        :param end: offset after the last byte.
+        :return: the requested bytes of the blob.
+        """
+        chunks = [chunk async for chunk in self._stream_blob_range(digest, start, end)]
+        return b"".join(chunks)
+
+    async def _stream_blob_range(self, digest: str, start: int, end: int) -> AsyncIterator[bytes]:
+        headers = {"Range": f"bytes={start}-{end - 1}"}
+        async with self._open_stream_with_auth(f"{self.blobs_url()}/{digest}", headers) as response:
+            # a 200 response holds the whole blob, so the bytes before the range are skipped
+            offset = 0 if response.status == 206 else start
+            remaining = end - start
+            async for chunk in self._iter_chunks(response):
+                if offset:
+                    skipped = min(offset, len(chunk))
+                    chunk, offset = chunk[skipped:], offset - skipped
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                if chunk:
+                    yield chunk
+                if remaining == 0:
+                    break
+        if remaining:
+            raise HTTPConnectionError(f"Blob {digest} ended before the range {start}-{end - 1} was complete")
+
+    async def get_layer_toc(self, descriptor: dict) -> Optional[LayerToc]:
+        """
+        Gets the table of contents of a seekable (eStargz or zstd:chunked) layer, with a few range requests at the end
+        of the blob. Other layers have no table of contents, and give None.
+
+        :param descriptor: descriptor of the layer in the image manifest, with its digest, size and media type.
+        :return: table of contents of the layer, or None if the layer is not seekable.
+        """
+        position = descriptor.get("annotations", {}).get(ZSTD_CHUNKED_MANIFEST_POSITION)
+        return await self._get_layer_toc(
+            descriptor["digest"], descriptor["size"], descriptor.get("mediaType"), position
         )
-        return response
+
+    @alru_cache
+    async def _get_layer_toc(
+        self, digest: str, size: int, media_type: Optional[str], manifest_position: Optional[str]
+    ) -> Optional[LayerToc]:
+        compression = layer_compression(media_type)
+        if compression == "zstd" and manifest_position is not None:
+            offset, length = (int(value) for value in manifest_position.split(":")[:2])
+            data = await self.get_blob_range(digest, offset, offset + length)
+            try:
+                decompressor = StreamDecompressor("zstd")
+            except DecompressionError as e:
+                raise DecompressionError(f"Cannot read zstd:chunked layer {digest}: {e}") from None
+            toc = json.loads(decompressor.decompress(data) + decompressor.flush())
+            return LayerToc.from_json(digest, "zstd", toc, offset)
+        if compression != "gzip" or size < ESTARGZ_FOOTER_SIZE:
+            return None
+        toc_offset = estargz_toc_offset(await self.get_blob_range(digest, size - ESTARGZ_FOOTER_SIZE, size))
+        if toc_offset is None or toc_offset >= size:
+            return None
+        decompressor = StreamDecompressor("gzip")
+        data = decompressor.decompress(await self.get_blob_range(digest, toc_offset, size)) + decompressor.flush()
+        return LayerToc.from_json(digest, "gzip", read_estargz_toc(data), toc_offset)
+
+    async def _get_layer_toc_or_listing(self, descriptor: dict) -> LayerToc:
+        toc = await self.get_layer_toc(descriptor)
+        if toc is not None:
+            return toc
+        return await self._get_layer_listing(descriptor["digest"], layer_compression(descriptor.get("mediaType")))
+
+    @alru_cache
+    async def _get_layer_listing(self, digest: str, compression: Optional[str]) -> LayerToc:
+        # layers that are not seekable have to be read entirely, so they are only listed once, whatever the number of
+        # lookups in them
+        entries = []
+
+        def _on_member(member: tarfile.TarInfo, f: Optional[BinaryIO]) -> bool:
+            entries.append(TocEntry.from_tarinfo(member))
+            return False
+
+        await self._read_layer_members(digest, compression, _on_member)
+        return LayerToc(digest, {entry.name: entry for entry in entries}, compression)
+
+    async def _get_layer_descriptors(self, architecture: Union[str, Platform, None] = None) -> List[dict]:
+        manifest = await self.get_manifest_from_architecture(architecture)
+        if manifest["mediaType"] in (_ociv1_index_mimetype, _schema2_list_mimetype):
+            manifest = await self.get_manifest_from_architecture(
+                Platform.from_dict(manifest["manifests"][0]["platform"])
+            )
+        return manifest["layers"]
+
+    async def open_file(self, path: str, architecture: Union[str, Platform, None] = None) -> AsyncIterator[bytes]:
+        """
+        Reads a single file of an image, looking it up from the top layer down. Seekable layers (eStargz and
+        zstd:chunked) are read lazily: only their table of contents and the chunks of the file are downloaded, with
+        HTTP ``Range`` requests. Other layers are streamed once to be listed, and the layer holding the file is
+        streamed again up to the file. Symbolic links and whiteout files are honored like in a container.
+
+        >>> async with RegistryInfo.from_url("ghcr.io/stargz-containers/alpine:3.15.3-esgz") as ri:
+        ...     content = b"".join([chunk async for chunk in ri.open_file("/etc/os-release")])
+
+        :param path: absolute path of the file in the image.
+        :param architecture: optional architecture for the image. If not provided, the default registry architecture
+            will be used.
+        :return: the content of the file, in chunks.
+        """
+        layers = await self._get_layer_descriptors(architecture)
+        toc, entry = await resolve_path(path, len(layers), lambda index: self._get_layer_toc_or_listing(layers[index]))
+        hasher = hashlib.sha256()
+        async for chunk in self._read_toc_entry(toc, entry):
+            hasher.update(chunk)
+            yield chunk
+        if entry.digest is not None and entry.digest != f"sha256:{hasher.hexdigest()}":
+            raise DigestMismatchError(
+                f"Content of {path} has digest sha256:{hasher.hexdigest()}, but the layer lists {entry.digest}"
+            )
+
+    async def _read_toc_entry(self, toc: LayerToc, entry: TocEntry) -> AsyncIterator[bytes]:
+        if entry.tarinfo is not None:
+            async for chunk in self._stream_layer_member(toc.digest, toc.compression, entry.name):
+                yield chunk
+            return
+        for toc_chunk in entry.chunks:
+            if toc_chunk.zeros:
+                yield bytes(toc_chunk.size)
+                continue
+            # the compressed data of a chunk can be followed by other entries, which are not decompressed
+            decompressor, remaining = StreamDecompressor(toc.compression), toc_chunk.size
+            async for data in self._stream_blob_range(toc.digest, toc_chunk.offset, toc_chunk.end):
+                data = decompressor.decompress(data)[:remaining]
+                remaining -= len(data)
+                if data:
+                    yield data
+                if remaining == 0:
+                    break
+            if remaining:
+                raise DecompressionError(f"Chunk of {entry.name} at offset {toc_chunk.offset} ended too early")
+
+    async def read_layer_members(
+        self, descriptor: dict, on_member: Callable[[tarfile.TarInfo, Optional[BinaryIO]], bool]
+    ) -> None:
+        """
+        Reads the members of a layer in a single pass, see ``LayerTarReader``. The blob is decompressed and parsed while
+        it is downloaded, without being held in memory or stored in the cache, and the download stops as soon as
+        ``on_member`` returns True. Layers that are already in the cache are read from there.
+
+        :param descriptor: descriptor of the layer in the image manifest, with its digest and media type.
+        :param on_member: called with each member of the layer and a file object for its content, in a worker thread.
+        """
+        await self._read_layer_members(descriptor["digest"], layer_compression(descriptor.get("mediaType")), on_member)
+
+    async def _read_layer_members(
+        self,
+        layer: str,
+        compression: Optional[str],
+        on_member: Callable[[tarfile.TarInfo, Optional[BinaryIO]], bool],
+    ):
+        async with LayerTarReader(on_member, compression, name=layer.split(":")[1][0:12]) as reader:
+            layer_path = await asyncio.to_thread(get_layer_path, layer)
+            if layer_path is not None:
+                self.metrics.inc("crpy_cache_hits_total")
+                with open(layer_path, "rb") as f:
+                    while not reader.done:
+                        chunk = await asyncio.to_thread(f.read, READ_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        await reader.feed(chunk)
+            else:
+                async with self._open_stream_with_auth(f"{self.blobs_url()}/{layer}") as response:
+                    async for chunk in self._iter_chunks(response):
+                        await reader.feed(chunk)
+                        if reader.done:
+                            # closes the connection, rather than downloading the rest of the layer
+                            break
+            await reader.finish()
+
+    async def _stream_layer_member(self, layer: str, compression: Optional[str], name: str) -> AsyncIterator[bytes]:
+        """
+        Streams the content of a single member of a layer, in one pass over the layer. The worker thread of the reader
+        hands the content over through a bounded queue, so that neither the layer nor the member is held in memory.
+        """
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue(MAX_PENDING_CHUNKS)
+        closed = threading.Event()
+
+        def _on_member(member: tarfile.TarInfo, f: Optional[BinaryIO]) -> bool:
+            if f is None or normalize_path(member.name) != name:
+                return False
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+                # an empty chunk tells that the member is complete, and nothing is sent anymore once nobody listens
+                if not chunk or closed.is_set():
+                    return True
+
+        reading = asyncio.ensure_future(self._read_layer_members(layer, compression, _on_member))
+        try:
+            while True:
+                if reading.done() and chunks.empty():
+                    reading.result()
+                    raise FileNotFoundError(f"{name} is not in layer {layer}")
+                if reading.done():
+                    chunk = chunks.get_nowait()
+                else:
+                    getting = asyncio.ensure_future(chunks.get())
+                    await asyncio.wait({getting, reading}, return_when=asyncio.FIRST_COMPLETED)
+                    if not getting.done():
+                        getting.cancel()
+                        continue
+                    chunk = getting.result()
+                if not chunk:
+                    break
+                yield chunk
+            await reading
+        finally:
+            # frees the worker thread, if it waits for room in the queue
+            closed.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+            if not reading.done():
+                await asyncio.gather(reading, return_exceptions=True)
+
+    async def list_layer(self, descriptor: dict) -> List[TocEntry]:
+        """
+        Lists the members of a single layer, including its whiteout files, in the order of the tar-file.
+
+        :param descriptor: descriptor of the layer in the image manifest, with its digest and media type.
+        :return: entries of the layer.
+        """
+        entries = []
+
+        def _on_member(member: tarfile.TarInfo, f: Optional[BinaryIO]) -> bool:
+            entries.append(TocEntry.from_tarinfo(member))
+            return False
+
+        await self.read_layer_members(descriptor, _on_member)
+        return entries
+
+    async def list_files(self, architecture: Union[str, Platform, None] = None) -> List[TocEntry]:
+        """
+        Lists the files of an image as a container sees them: every layer is read, and the entries deleted by the
+        whiteout files of upper layers are left out. The layers are streamed, not downloaded into the cache.
+
+        :param architecture: optional architecture for the image. If not provided, the default registry architecture
+            will be used.
+        :return: entries of the image, sorted by path.
+        """
+        layers = await self._get_layer_descriptors(architecture)
+        listings = await asyncio.gather(*(self.list_layer(descriptor) for descriptor in layers))
+        tocs = [
+            LayerToc(descriptor["digest"], {entry.name: entry for entry in entries})
+            for descriptor, entries in zip(layers, listings)
+        ]
+        files: Dict[str, TocEntry] = {}
+        for index in reversed(range(len(tocs))):
+            for name, entry in tocs[index].entries.items():
+                if not name or name in files or entry.is_whiteout:
+                    continue
+                if not any(toc.hides(name) for toc in tocs[index + 1 :]):
+                    files[name] = entry
+        return sorted(files.values(), key=lambda entry: entry.name)
+
+    async def extract_files(
+        self,
+        paths: List[str],
+        output_dir: Union[str, pathlib.Path] = ".",
+        architecture: Union[str, Platform, None] = None,
+    ) -> Dict[str, pathlib.Path]:
+        """
+        Extracts files of an image, looking them up from the top layer down and honoring whiteout files. Each layer is
+        streamed until all the remaining paths were found in it, so the rest of the layer, and the layers below, are
+        not downloaded at all. Paths are matched as they are stored in the layers: symbolic links are extracted as
+        links, and are not followed.
+
+        :param paths: absolute paths of the files in the image.
+        :param output_dir: directory the files are extracted to, keeping their path in the image.
+        :param architecture: optional architecture for the image. If not provided, the default registry architecture
+            will be used.
+        :return: path each requested file was extracted to.
+        """
+        wanted: Dict[str, str] = {}
+        for path in paths:
+            name = normalize_path(path)
+            if not name or ".." in name.split("/"):
+                raise ValueError(f"Invalid path {path}, expected the absolute path of a file in the image")
+            wanted[name] = path
+        output_dir = pathlib.Path(output_dir)
+        extracted: Dict[str, pathlib.Path] = {}
+        deleted: List[str] = []
+        for descriptor in reversed(await self._get_layer_descriptors(architecture)):
+            if not wanted:
+                break
+            deleted += await self._extract_from_layer(descriptor, wanted, output_dir, extracted)
+        if wanted or deleted:
+            raise FileNotFoundError(f"Not found in the image: {', '.join([*deleted, *wanted.values()])}")
+        return extracted
+
+    async def _extract_from_layer(
+        self, descriptor: dict, wanted: Dict[str, str], output_dir: pathlib.Path, extracted: Dict[str, pathlib.Path]
+    ) -> List[str]:
+        toc = LayerToc(descriptor["digest"], {})
+        # hard links point to a member that came before them, so a second pass reads the targets that were missed
+        hardlinks: Dict[str, List[pathlib.Path]] = {}
+
+        def _on_member(member: tarfile.TarInfo, f: Optional[BinaryIO]) -> bool:
+            entry = TocEntry.from_tarinfo(member)
+            if entry.is_whiteout:
+                toc.entries[entry.name] = entry
+            elif entry.name in wanted:
+                extracted[wanted[entry.name]] = output_path = output_dir / entry.name
+                del wanted[entry.name]
+                if member.islnk():
+                    target = normalize_path(member.linkname)
+                    if target in toc.entries:
+                        _extract_member(toc.entries[target].tarinfo, None, output_path, output_dir, output_dir / target)
+                    else:
+                        hardlinks.setdefault(target, []).append(output_path)
+                else:
+                    _extract_member(member, f, output_path, output_dir)
+                    toc.entries[entry.name] = entry
+            return not wanted and not hardlinks
+
+        def _on_link_target(member: tarfile.TarInfo, f: Optional[BinaryIO]) -> bool:
+            output_paths = hardlinks.pop(normalize_path(member.name), [])
+            for i, output_path in enumerate(output_paths):
+                _extract_member(member, f, output_path, output_dir, output_paths[0] if i else None)
+            return not hardlinks
+
+        await self.read_layer_members(descriptor, _on_member)
+        if hardlinks:
+            await self.read_layer_members(descriptor, _on_link_target)
+        if hardlinks:
+            raise FileNotFoundError(f"Hard links to {', '.join(hardlinks)} point outside of layer {toc.digest}")
+        # paths deleted by this layer cannot come from the layers below
+        return [wanted.pop(name) for name in list(wanted) if toc.hides(name)]
 
     @alru_cache
     async def get_layers(self, architecture: Union[str, Platform, None] = None) -> List[str]:
@@ -299,7 +883,11 @@ class RegistryInfo:
         return layers
 
     async def pull_layer(
-        self, layer: str, file_obj: Optional[io.BytesIO] = None, use_cache: bool = True
+        self,
+        layer: str,
+        file_obj: Optional[io.BytesIO] = None,
+        use_cache: bool = True,
+        verify_cache: bool = False,
     ) -> Optional[bytes]:
         """
         Retrieves a layer from a remote registry.
@@ -307,110 +895,509 @@ class RegistryInfo:
         :param layer: reference for the layer. Looks something like "sha256:1234..."
         :param file_obj: optional file-like object to write the response.
         :param use_cache: enables the local cache, saving layers to ~/.crpy/ folder.
+        :param verify_cache: verifies the digest of the layer if it is read from the cache.
         :return: If a file_obj is provided, the layer is written to that file, otherwise the binary data is returned.
         """
-        content = get_layer_from_cache(layer) if use_cache else None
-
-        if content is not None:
-            print(f"Using cache for layer {layer.split(':')[1][0:12]}")
-            # short-circuit if the content is in the cache
+        if not use_cache:
             if file_obj is None:
-                return content
-            file_obj.write(content)
+                file_obj = io.BytesIO()
+                await self.get_response_content(layer, file_obj)
+                return file_obj.getvalue()
+            await self.get_response_content(layer, file_obj)
             return None
 
-        return await self.get_content_from_remote(layer, file_obj, use_cache)
+        layer_path = await self.download_layer(layer, verify_cache)
+        if file_obj is None:
+            return layer_path.read_bytes()
+        with open(layer_path, "rb") as f:
+            shutil.copyfileobj(f, file_obj)
+        return None
 
-    async def get_content_from_remote(
-        self, layer: str, file_obj: Optional[io.BytesIO], use_cache: bool
-    ) -> Optional[bytes]:
-        content = await self.get_response_content(layer, file_obj)
-        if use_cache:
-            save_layer(layer, content if file_obj is None else file_obj.getvalue())
-        return content
+    async def download_layer(self, layer: str, verify_cache: bool = False) -> pathlib.Path:
+        """
+        Downloads a layer into the local cache, if not already there, and returns the path to the cached file. The
+        blob is streamed to disk in chunks while its digest is computed, so memory usage does not depend on the layer
+        size. The download is only moved into the cache once the digest matches the requested one.
 
-    async def get_response_content(self, layer: str, file_obj: Optional[io.BytesIO]) -> bytes:
-        if file_obj is None:
-            response = await self._request_with_auth(f"{self.blobs_url()}/{layer}", method="get", headers=self._headers)
-            return response.data
-        else:
-            async for chunk in _stream(
-                f"{self.blobs_url()}/{layer}", self._headers, aiohttp_kwargs=self._aiohttp_kwargs
-            ):
-                file_obj.write(chunk)
-            file_obj.seek(0)
-            return file_obj.getvalue()
+        Interrupted downloads are kept in the cache as ``.partial`` files. The download then continues from where it
+        stopped with an HTTP ``Range`` request, either right away (up to ``DOWNLOAD_RESUME_ATTEMPTS`` times) or on the
+        next call for the same layer. Downloads hold a lock on the layer, so if another process is already downloading
+        it, this waits for that download and reuses its result.
+
+        :param layer: reference for the layer. Looks something like "sha256:1234..."
+        :param verify_cache: if a cached layer should have its digest verified before being used. Corrupted layers are
+            downloaded again.
+        :return: path of the layer in the cache.
+        """
+        repository = f"{self.registry}/{self.repository}"
+        downloaded = False
+        layer_path = await hold_layer(layer, verify_cache)
+        while layer_path is None:
+            async with lock_layer(layer):
+                # another process might have downloaded the layer while we were waiting for the lock
+                if get_layer_path(layer) is None:
+                    await self._download_layer_to_cache(layer, repository)
+                    downloaded = True
+            # the layer can only be held once the exclusive lock is released. If it was evicted in between, it is
+            # downloaded again
+            layer_path = await hold_layer(layer)
+        if downloaded:
+            return layer_path
+        print(f"Using cache for layer {layer.split(':')[1][0:12]}")
+        self.metrics.inc("crpy_cache_hits_total")
+        ProgressTracker(self.progress, layer, "download", layer_path.stat().st_size).cached()
+        await asyncio.to_thread(touch_layer, layer, repository)
+        return layer_path
+
+    async def download_uncompressed_layer(
+        self, layer: str, diff_id: str, compression: str = "gzip", verify_cache: bool = False
+    ) -> pathlib.Path:
+        """
+        Downloads a layer and decompresses it into the local cache, if not already there, and returns the path to the
+        uncompressed tar-file. The layer is decompressed in a worker thread while it is downloaded, and the digest of
+        the uncompressed content is verified against the ``diff_id`` before it is moved into the cache. Both the
+        compressed and the uncompressed blob are kept in the cache, and a compressed blob that is already cached is
+        decompressed from there.
+
+        :param layer: reference for the layer. Looks something like "sha256:1234..."
+        :param diff_id: digest of the uncompressed layer, as listed in the ``rootfs`` of the image config.
+        :param compression: compression of the layer, see ``layer_compression()``.
+        :param verify_cache: if cached blobs should have their digest verified before being used.
+        :return: path of the uncompressed layer in the cache.
+        """
+        repository = f"{self.registry}/{self.repository}"
+        decompressed = False
+        layer_path = await hold_layer(diff_id, verify_cache)
+        while layer_path is None:
+            # the uncompressed layer is always locked before the compressed one, so that processes never wait for
+            # each other
+            async with lock_layer(diff_id):
+                if get_layer_path(diff_id) is None:
+                    await self._decompress_layer_to_cache(layer, diff_id, compression, verify_cache, repository)
+                    decompressed = True
+            layer_path = await hold_layer(diff_id)
+        if decompressed:
+            return layer_path
+        print(f"Using cache for layer {layer.split(':')[1][0:12]}")
+        self.metrics.inc("crpy_cache_hits_total")
+        ProgressTracker(self.progress, layer, "download", layer_path.stat().st_size).cached()
+        await asyncio.to_thread(touch_layer, diff_id, repository)
+        return layer_path
+
+    async def _decompress_layer_to_cache(
+        self, layer: str, diff_id: str, compression: str, verify_cache: bool, repository: str
+    ) -> pathlib.Path:
+        compressed_path = await hold_layer(layer, verify_cache)
+        while compressed_path is None:
+            async with lock_layer(layer):
+                if get_layer_path(layer) is None:
+                    async with LayerDecompressor(diff_id, compression, repository) as decompressor:
+                        compressed_path = await self._download_layer_to_cache(layer, repository, decompressor)
+                        layer_path = await decompressor.finish()
+                    # pushing the uncompressed layer can then reuse the blob of the registry, instead of compressing
+                    # it again. The size is read while the lock still protects the blob from eviction
+                    await asyncio.to_thread(record_compressed_layer, diff_id, layer, compressed_path.stat().st_size)
+                    return layer_path
+            # another process downloaded the layer while we were waiting for the lock
+            compressed_path = await hold_layer(layer)
+        print(f"Decompressing cached layer {layer.split(':')[1][0:12]}")
+        self.metrics.inc("crpy_cache_hits_total")
+        await asyncio.to_thread(touch_layer, layer, repository)
+        async with LayerDecompressor(diff_id, compression, repository) as decompressor:
+            await decompressor.feed_file(compressed_path)
+            layer_path = await decompressor.finish()
+        await asyncio.to_thread(record_compressed_layer, diff_id, layer, compressed_path.stat().st_size)
+        return layer_path
+
+    async def _download_layer_to_cache(
+        self, layer: str, repository: str, decompressor: Optional[LayerDecompressor] = None
+    ) -> pathlib.Path:
+        self.metrics.inc("crpy_cache_misses_total")
+        tracker = ProgressTracker(self.progress, layer, "download")
+        # resuming hashes the partial file again, and committing can evict other layers, so both run in a thread
+        with await asyncio.to_thread(LayerWriter, layer, repository) as writer:
+            if decompressor is not None and writer.size:
+                # the part downloaded by an earlier attempt is decompressed before the download continues
+                await decompressor.feed_file(writer.partial_path, writer.size)
+            for attempt in range(DOWNLOAD_RESUME_ATTEMPTS + 1):
+                try:
+                    await self._download_to_writer(layer, writer, tracker, decompressor)
+                    break
+                except HTTPResponseError:
+                    raise
+                except HTTPConnectionError as e:
+                    if attempt == DOWNLOAD_RESUME_ATTEMPTS:
+                        raise
+                    print(f"{layer.split(':')[1][0:12]}: Download interrupted at byte {writer.size}, resuming")
+                    tracker.retry(f"Download interrupted at byte {writer.size}: {e}")
+                    self.metrics.inc("crpy_retries_total", operation="download")
+                    await asyncio.sleep(self.client.retry.backoff_delay(attempt + 1))
+            layer_path = await asyncio.to_thread(writer.commit)
+        tracker.finished()
+        return layer_path
+
+    async def _download_to_writer(
+        self,
+        layer: str,
+        writer: LayerWriter,
+        tracker: Optional[ProgressTracker] = None,
+        decompressor: Optional[LayerDecompressor] = None,
+    ):
+        if tracker is None:
+            tracker = ProgressTracker(None, layer, "download")
+        headers = {}
+        if writer.size:
+            # continue a previous download from the last byte written to the partial file
+            headers["Range"] = f"bytes={writer.size}-"
+        try:
+            async with self._open_stream_with_auth(f"{self.blobs_url()}/{layer}", headers) as response:
+                if writer.size and response.status != 206:
+                    # the registry ignored the range request, so the download starts over
+                    writer.truncate()
+                    if decompressor is not None:
+                        await decompressor.restart()
+                total = writer.size + response.content_length if response.content_length is not None else None
+                tracker.started(writer.size, total)
+                async for chunk in self._iter_chunks(response):
+                    writer.write(chunk)
+                    if decompressor is not None:
+                        await decompressor.feed(chunk)
+                    tracker.advance(len(chunk))
+        except HTTPResponseError as e:
+            # the range starts past the end of the blob, meaning the partial file already has all the content. The
+            # digest is still verified once it is committed.
+            if not (writer.size and e.status == 416):
+                raise
+
+    async def get_response_content(self, layer: str, file_obj: Union[io.BytesIO, LayerWriter]):
+        """
+        Streams a blob from the remote registry into a file-like object, chunk by chunk.
+
+        :param layer: reference for the layer. Looks something like "sha256:1234..."
+        :param file_obj: file-like object (or cache writer) to write the response to.
+        """
+        async for chunk in self._stream_with_auth(f"{self.blobs_url()}/{layer}"):
+            file_obj.write(chunk)
 
     async def pull(
-        self, output_file: Union[str, pathlib.Path, io.BytesIO], architecture: Union[str, Platform, None] = None
+        self,
+        output_file: Union[str, pathlib.Path, io.BytesIO],
+        architecture: Union[str, Platform, None] = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        verify_cache: bool = False,
+        output_format: str = "docker",
+        decompress: bool = True,
     ):
         """
         Pulls an image from a remote repository. The image will be packed into a tar-file and saved to disk (or to a
         file-like object). If you want to use your new image on Docker, use `docker load -i my_image` after pulling,
         and it should be working, with the same tag.
 
-        :param output_file: path or file-like object to save the binary data.
+        Layers are decompressed while they are downloaded, so that the tar-file contains each layer as an uncompressed
+        ``<diff_id>/layer.tar``, as written by ``docker save``, and the digest of each uncompressed layer is checked
+        against the ``diff_ids`` of the image config.
+
+        With ``output_format="oci"``, the image is written as an OCI image layout directory instead. Layers are
+        hardlinked from the cache, so no data is copied when the output is on the same file system as the cache.
+
+        :param output_file: path or file-like object to save the binary data, or directory for the OCI layout.
         :param architecture: architecture to pull the image. If not set, the default registry architecture will be
             used.
+        :param max_concurrency: maximum number of layers downloaded at the same time. The layer order in the resulting
+            image is always the same as in the manifest.
+        :param verify_cache: verifies the digest of the layers read from the cache, downloading them again if they
+            are corrupted.
+        :param output_format: "docker" for a tar-file compatible with ``docker load`` or "oci" for an OCI image layout.
+        :param decompress: if the layers of a "docker" tar-file are decompressed. Otherwise, they are stored as they
+            come from the registry, which ``docker load`` also accepts. OCI layouts always keep the layers compressed.
         :return:
         """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        _check_output_format(output_format, output_file)
         print(f"{self.tag}: Pulling from {self.registry}/{self.repository}")
         image = Image()
-        image.manifest = await self.get_manifest_from_architecture(architecture)
-        raw_config = await self.get_config(architecture)
-        image.config = raw_config.data
-        for layer in await self.get_layers(architecture):
-            layer_without_prefix = layer.split(":")[1]
-            image.layers.append(
-                Blob.from_any(await self.pull_layer(layer, use_cache=True), digest=layer_without_prefix)
-            )
-            print(f"{layer_without_prefix[0:12]}: Pull complete")
-        image.to_disk(output_file, tags=[str(self)])
+        with self.metrics.time("manifest", operation="pull"):
+            # the raw manifest is kept, so that its digest is the same as on the registry
+            image.manifest = (await self._get_manifest_response_from_architecture(architecture)).data
+            raw_config = await self.get_config(architecture)
+            image.config = raw_config.data
+            # the same layer can appear more than once in an image, but it is only downloaded once
+            layers = await self.get_layers(architecture)
+        unique_layers = list(dict.fromkeys(layers))
+        diff_ids = {}
+        if decompress and output_format == "docker":
+            diff_ids = _layer_diff_ids(image.manifest.as_dict(), image.config.as_dict())
+        # the layers are kept from being evicted from the cache until the image is written
+        with pin_layers(unique_layers + [diff_id for diff_id, _ in diff_ids.values()]):
+            with self.metrics.time("download", operation="pull"):
+                blobs = await self._download_layers(unique_layers, max_concurrency, verify_cache, diff_ids)
+            image.layers.extend(blobs[layer] for layer in layers)
+            with self.metrics.time("write", operation="pull"):
+                if output_format == "oci":
+                    image.to_oci_layout(output_file, tags=[str(self)])
+                else:
+                    image.to_disk(output_file, tags=[str(self)])
         print(f"Downloaded image from {self}")
 
-    async def push_layer(self, file_obj: Union[bytes, str, pathlib.Path], force: bool = False) -> Optional[dict]:
+    async def _download_layers(
+        self,
+        layers: List[str],
+        max_concurrency: int,
+        verify_cache: bool,
+        diff_ids: Optional[Dict[str, Tuple[str, str]]] = None,
+    ) -> Dict[str, Blob]:
+        """
+        Downloads layers concurrently. The layers in ``diff_ids``, which maps their digest to their diff_id and
+        compression, are decompressed, and the returned blobs are then the uncompressed layers, named by diff_id.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        diff_ids = diff_ids or {}
+
+        async def _pull_layer_blob(layer: str) -> Blob:
+            async with semaphore:
+                if layer in diff_ids:
+                    digest, compression = diff_ids[layer]
+                    layer_path = await self.download_uncompressed_layer(layer, digest, compression, verify_cache)
+                else:
+                    digest = layer
+                    layer_path = await self.download_layer(layer, verify_cache)
+            print(f"{layer.split(':')[1][0:12]}: Pull complete")
+            return Blob.from_any(layer_path, digest=digest.split(":")[1])
+
+        # gather keeps the results in the same order as the manifest, regardless of which layer finishes first
+        return dict(zip(layers, await asyncio.gather(*(_pull_layer_blob(layer) for layer in layers))))
+
+    async def get_platform_manifests(self, platforms: Optional[List[Union[str, Platform]]] = None) -> Dict[str, dict]:
+        """
+        Gets the manifests of several platforms of a multi-platform image at once. The manifest list is fetched once,
+        and the manifest of each platform is then fetched concurrently. The responses are returned as they came from the
+        registry, so that the raw manifests can be kept.
+
+        :param platforms: platforms to select, like ``linux/amd64``. A platform without variant, like ``linux/arm64``,
+            also matches its variants. If not set, all platforms are selected, except entries that do not describe a
+            platform (such as the build attestations of buildx, tagged ``unknown/unknown``).
+        :return: dictionary of platform to manifest response, in the same order as the manifest list.
+        """
+        index = (await self.get_manifest(fat=True)).json()
+        if "manifests" not in index:
+            raise ValueError(f"{self} is not a multi-platform image, pull it without selecting platforms")
+        entries = {}
+        for entry in index["manifests"]:
+            platform = entry.get("platform", {})
+            if platform.get("os", "unknown") == "unknown" or platform.get("architecture", "unknown") == "unknown":
+                continue
+            entries.setdefault(platform_from_dict(platform), entry)
+        if platforms is not None:
+            selected = {}
+            for platform in platforms:
+                platform = platform.value if isinstance(platform, Platform) else platform
+                matches = [p for p in entries if p == platform or p.startswith(f"{platform}/")]
+                if not matches:
+                    raise ValueError(
+                        f"No matching manifest for {platform} in the manifest list entries at {self}.\n"
+                        f"Available architectures: {list(entries)}"
+                    )
+                selected.update((p, entries[p]) for p in matches)
+            entries = selected
+        manifests = await asyncio.gather(*(self.get_manifest(reference=entry["digest"]) for entry in entries.values()))
+        return dict(zip(entries, manifests))
+
+    async def pull_platforms(
+        self,
+        output_file: Union[str, pathlib.Path, io.BytesIO],
+        platforms: Optional[List[Union[str, Platform]]] = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        verify_cache: bool = False,
+        output_format: str = "docker",
+        decompress: bool = True,
+    ):
         """
-        Pushes a layer to a remote repo.
+        Pulls several platforms of a multi-platform image in a single run, and packs them into one tar-file. Manifests
+        and configs are fetched concurrently, and layers shared between platforms are only downloaded (and stored)
+        once. Each platform is tagged with the platform as suffix, like ``alpine:3.18-linux-arm64-v8``, so that all of
+        them can be loaded side by side with ``docker load``.
 
-        :param file_obj: file or bytes object to be pushed.
+        :param output_file: path or file-like object to save the binary data.
+        :param platforms: platforms to pull, see ``get_platform_manifests()``. If not set, all platforms are pulled.
+        :param max_concurrency: maximum number of layers downloaded at the same time.
+        :param verify_cache: verifies the digest of the layers read from the cache, downloading them again if they
+            are corrupted.
+        :param output_format: "docker" for a tar-file compatible with ``docker load`` or "oci" for an OCI image layout,
+            see ``pull()``.
+        :param decompress: if the layers of a "docker" tar-file are decompressed, see ``pull()``.
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        _check_output_format(output_format, output_file)
+        with self.metrics.time("manifest", operation="pull"):
+            responses = await self.get_platform_manifests(platforms)
+            manifests = {platform: response.json() for platform, response in responses.items()}
+            print(f"{self.tag}: Pulling {', '.join(manifests)} from {self.registry}/{self.repository}")
+            configs = await asyncio.gather(
+                *(self.get_blob(manifest["config"]["digest"]) for manifest in manifests.values())
+            )
+        for platform, config in zip(manifests, configs):
+            assert config.status == 200, f"Could not get config for {platform}: {config.status} {config.data}"
+        layers = list(dict.fromkeys(layer["digest"] for m in manifests.values() for layer in m["layers"]))
+        diff_ids = {}
+        if decompress and output_format == "docker":
+            for manifest, config in zip(manifests.values(), configs):
+                diff_ids.update(_layer_diff_ids(manifest, config.json()))
+        with pin_layers(layers + [diff_id for diff_id, _ in diff_ids.values()]):
+            with self.metrics.time("download", operation="pull"):
+                blobs = await self._download_layers(layers, max_concurrency, verify_cache, diff_ids)
+            images = []
+            for (platform, manifest), config in zip(manifests.items(), configs):
+                image = Image(config=config.data, manifest=responses[platform].data)
+                image.layers.extend(blobs[layer["digest"]] for layer in manifest["layers"])
+                images.append((image, [f"{self}-{platform.replace('/', '-')}"]))
+            with self.metrics.time("write", operation="pull"):
+                if output_format == "oci":
+                    images_to_oci_layout(output_file, images)
+                else:
+                    images_to_disk(output_file, images)
+        print(f"Downloaded {len(images)} platforms from {self}")
+
+    async def push_layer(
+        self,
+        file_obj: Union[bytes, str, pathlib.Path, BinaryIO],
+        force: bool = False,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> Optional[dict]:
+        """
+        Pushes a layer to a remote repo. Files are read from disk in chunks of ``chunk_size`` and uploaded with the
+        chunked upload flow (``POST``, followed by one ``PATCH`` per chunk and a final ``PUT``), so memory usage is
+        bounded by the chunk size. If a chunk fails, the upload resumes from the offset reported by the registry.
+        Blobs smaller than a chunk are uploaded with a single ``PUT``.
+
+        :param file_obj: file, seekable binary file-like object or bytes object to be pushed.
         :param force: will force the upload of the blob even when it's available at the remote. If set to false, it
             skips already pushed layers (default).
+        :param chunk_size: size in bytes of each uploaded chunk.
         :return: dictionary containing the fields {"size": int}, with the blob size, {"digest": str}, with the sha256
             digest and {"existing": bool}, saying if the manifest upload was skipped because it already existed.
         """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
         # load layer and compute its digest
-        if isinstance(file_obj, pathlib.Path) or isinstance(file_obj, str):
-            with open(file_obj, "rb") as f:
-                content = f.read()
-        elif isinstance(file_obj, io.BytesIO):
-            content = file_obj.read()
+        if isinstance(file_obj, (str, pathlib.Path)):
+            file_context = open(file_obj, "rb")
+        elif isinstance(file_obj, bytes):
+            file_context = io.BytesIO(file_obj)
         else:
-            content = file_obj
-        digest = compute_sha256(content)
-        manifest = {
-            "size": len(content),
-            "digest": digest,
-        }
-        # first check if a blob exists with a HEAD request
+            file_context = contextlib.nullcontext(file_obj)
+        with file_context as f:
+            start = f.tell()
+            digest, size = await asyncio.to_thread(compute_sha256_from_file, f)
+            manifest = {
+                "size": size,
+                "digest": digest,
+            }
+            if not force and await self.blob_exists(digest):
+                # layer already exists
+                self.metrics.inc("crpy_blobs_skipped_total")
+                ProgressTracker(self.progress, digest, "upload", size).skipped()
+                manifest["existing"] = True
+                return manifest
+            f.seek(start)
+            await self._upload_blob(f, digest, size, chunk_size)
+        manifest["existing"] = False
+        return manifest
+
+    async def blob_exists(self, digest: str) -> bool:
+        """
+        Checks if a blob is already available at the remote repository, with a HEAD request.
+
+        :param digest: digest of the blob. Looks something like "sha256:1234..."
+        :return: True if the blob exists.
+        """
         response = await self._request_with_auth(f"{self.blobs_url()}/{digest}", method="head", headers=self._headers)
-        if response.status == 200 and not force:
-            # layer already exists
-            manifest["existing"] = True
-            return manifest
+        return response.status == 200
+
+    def _upload_location(self, response: Response) -> str:
+        # the location can be relative to the registry, so we resolve it against the base url
+        return urljoin(self.v2_url(), response.headers["Location"])
+
+    async def _upload_blob(self, f: BinaryIO, digest: str, size: int, chunk_size: int):
+        tracker = ProgressTracker(self.progress, digest, "upload", size)
         # the process for pushing a layer is first making a request to /uploads and getting the location header
         response = await self._request_with_auth(f"{self.blobs_url()}/uploads/", method="post")
-        location_header = response.headers["Location"]
-        # we do a monolith upload with a single PUT requests
-        response = await self._request_with_auth(
-            location_header,
-            params={"digest": digest},
-            method="put",
-            data=content,
-            headers={"Content-Type": "application/octet-stream"},
-        )
+        assert response.status == 202, f"Failed to start upload of blob with digest {digest}: {response.data}"
+        location = self._upload_location(response)
+        start = f.tell()
+        tracker.started()
+        if size <= chunk_size:
+            # we do a monolith upload with a single PUT requests
+            await self._close_upload(
+                location,
+                digest,
+                data=await asyncio.to_thread(f.read),
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            tracker.advance(size)
+            tracker.finished()
+            return
+        offset, failures = 0, 0
+        while offset < size:
+            f.seek(start + offset)
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            try:
+                response = await self._request_with_auth(
+                    location,
+                    method="patch",
+                    data=chunk,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"{offset}-{offset + len(chunk) - 1}",
+                    },
+                )
+            except HTTPConnectionError as e:
+                response = Response(0, str(e).encode())
+            if response.status == 202:
+                location = self._upload_location(response)
+                offset = _upload_offset(response, offset + len(chunk))
+                tracker.advance(offset - tracker.transferred)
+                failures = 0
+                continue
+            failures += 1
+            if failures > UPLOAD_RESUME_ATTEMPTS:
+                raise HTTPConnectionError(
+                    f"Failed to upload chunk at offset {offset} of blob {digest}: {response.status} {response.data}"
+                )
+            # ask the registry how much of the blob it has received and resume from there
+            print(f"{digest.split(':')[1][0:12]}: Resuming upload after failed chunk at offset {offset}")
+            tracker.retry(f"Failed chunk at offset {offset}: {response.status} {response.data}")
+            self.metrics.inc("crpy_retries_total", operation="upload")
+            await asyncio.sleep(self.client.retry.backoff_delay(failures, response.headers))
+            status = await self._request_with_auth(location, method="get", headers=self._headers)
+            assert status.status == 204, f"Failed to resume upload of blob with digest {digest}: {status.data}"
+            location = self._upload_location(status)
+            offset = _upload_offset(status, 0)
+            tracker.restart(offset)
+        # once all chunks are uploaded, the upload is closed with the digest of the blob
+        await self._close_upload(location, digest)
+        tracker.finished()
+
+    async def _close_upload(self, location: str, digest: str, data: Optional[bytes] = None, headers: dict = None):
+        """
+        Closes an upload with the digest of the blob. The request is only sent again if the registry did not process it:
+        once the blob is committed, the upload location is gone, so sending it again would fail even though the blob was
+        uploaded. When the request fails without a clear answer, the registry is asked if it has the blob instead. This
+        includes a ``404`` for the upload, which aiohttp gets when it sends the request again after a dropped
+        connection.
+        """
+        try:
+            response = await self._request_with_auth(
+                location, params={"digest": digest}, method="put", data=data, headers=headers, idempotent=False
+            )
+        except HTTPConnectionError:
+            if await self.blob_exists(digest):
+                return
+            raise
+        if (response.status == 404 or response.status >= 500) and await self.blob_exists(digest):
+            return
         assert response.status == 201, f"Failed to upload blob with digest {digest}: {response.data}"
-        manifest["existing"] = False
-        return manifest
 
     @staticmethod
     def build_manifest(
@@ -439,35 +1426,59 @@ class RegistryInfo:
             "layers": layers,
         }
 
-    async def push_manifest(self, manifest: dict) -> Response:
+    async def push_manifest(
+        self, manifest: Union[dict, bytes], media_type: str = _schema2_mimetype, reference: Optional[str] = None
+    ) -> Response:
         """
         Pushes a manifest to the remote registry. The manifest follow a standard format. Check ``self.build_manifest()``
         for details.
 
-        :param manifest: dictionary containing the manifest.
+        :param manifest: dictionary containing the manifest, or its raw bytes. Raw bytes are pushed unchanged, which
+            keeps the digest of manifests copied from another registry.
+        :param media_type: media type of the manifest, sent as the ``Content-Type``.
+        :param reference: tag or digest to push the manifest to. If not specified, the configured tag is used.
         :return: Response from the remote endpoint.
         """
         # build the manifest here according to
         # containers.gitbook.io/build-containers-the-hard-way/#registry-format-docker-image-manifest-v-2-schema-2
+        data = manifest if isinstance(manifest, bytes) else json.dumps(manifest, indent=3).encode()
         response = await self._request_with_auth(
-            f"{self.manifest_url()}",
+            f"{self.manifest_url(reference)}",
             method="put",
-            data=json.dumps(manifest, indent=3).encode(),
-            headers={"Content-Type": _schema2_mimetype},
+            data=data,
+            headers={"Content-Type": media_type},
         )
-        assert response.status == 201
+        assert response.status == 201, f"Failed to push manifest to {self}: {response.status} {response.data}"
         return response
 
-    async def push(self, input_file: Union[str, pathlib.Path, io.BytesIO]):
+    async def push(
+        self,
+        input_file: Union[str, pathlib.Path, io.BytesIO],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        compress: bool = True,
+    ):
         """
         Pushes an input file to the remote repository. The tag that will be used is the one defined for the object. If
         no tag was provided, the default "latest" will be used. The file must be a tar-file with the config, manifest
-        and gzipped layers. This can be the output from a command line ``crpy pull alpine:3.18.2`` or from the docker
-        cli, for example, ``docker save alpine:3.18.2 -o alpine_3.18.2``.
+        and layers, either gzipped or not. This can be the output from a command line ``crpy pull alpine:3.18.2`` or
+        from the docker cli, for example, ``docker save alpine:3.18.2 -o alpine_3.18.2``.
+
+        The existence of all blobs is checked at once, then the missing ones are uploaded concurrently. The manifest is
+        only pushed after every blob was committed.
+
+        Uncompressed layers are compressed with gzip while they are uploaded, see ``ParallelCompressor``. The compressed
+        digest of each layer is kept in the cache index, so that pushing it again only needs to check if the remote
+        already has it. Layers pulled with crpy are known as well, and are uploaded from the cache as they were pulled.
 
         :param input_file: bytes or path to file to be uploaded.
+        :param chunk_size: size in bytes of each uploaded chunk, see ``push_layer()``.
+        :param max_concurrency: maximum number of blobs uploaded at the same time.
+        :param compress: if uncompressed layers are compressed. Otherwise, they are uploaded as they are.
         :return: None
         """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
         try:
             if isinstance(input_file, io.BytesIO):
                 t = tarfile.TarFile(fileobj=input_file)
@@ -475,57 +1486,308 @@ class RegistryInfo:
                 t = tarfile.TarFile(input_file)
         except tarfile.ReadError:
             raise ValueError(f"Failed to load {input_file}. Is an Docker image?")
-        with tempfile.TemporaryDirectory() as temp_dir:
-            t.extractall(temp_dir)
-            manifest_path = pathlib.Path(temp_dir) / "manifest.json"
-            manifest_content = manifest_path.read_text()
-            manifest = json.loads(manifest_content)[-1]
+        # members are streamed straight from the archive, without extracting it to a temporary folder first
+        with t, contextlib.ExitStack() as stack:
+            manifest = json.load(_open_tar_member(t, "manifest.json"))[-1]
             layers = manifest["Layers"] if "Layers" in manifest else manifest["layers"]
+            config = manifest["Config"] if "Config" in manifest else manifest["config"]
+            # the diff_ids of the config identify the uncompressed layers, without having to hash them
+            diff_ids = json.load(_open_tar_member(t, config)).get("rootfs", {}).get("diff_ids", [])
+            diff_ids = dict(zip(layers, diff_ids)) if len(diff_ids) == len(layers) else {}
 
             print(f"The push refers to repository [{self}]")
 
-            # upload config
-            config = manifest["Config"] if "Config" in manifest else manifest["config"]
-            config_path = pathlib.Path(temp_dir) / config
-            config_manifest = await self.push_layer(config_path)
-            config_manifest.pop("existing")
-            config_manifest["mediaType"] = _media_type_config
-
-            # upload layers
-            layers_manifest = []
-            for layer in layers:
-                layer_path = pathlib.Path(temp_dir) / layer
-                layer_manifest = await self.push_layer(layer_path)
-                if not layer_manifest["existing"]:
-                    print(f"{layer[0:12]}: Pushed")
-                else:
-                    print(f"{layer[0:12]}: Layer already exists")
-                layer_manifest.pop("existing")
-                layer_manifest["mediaType"] = _media_type_layer
-                layers_manifest.append(layer_manifest)
+            # compute the digest of each blob, so that we know which ones are already available at the remote. The
+            # digest of an uncompressed layer is only known once it is compressed, unless it was compressed before.
+            descriptors, media_types, to_compress, compressed_before = {}, {}, {}, set()
+            with self.metrics.time("hash", operation="push"):
+                for name in [config, *layers]:
+                    if name in descriptors or name in to_compress:
+                        continue
+                    compression = detect_compression(_open_tar_member(t, name).read(4))
+                    if name != config and compression is None and compress:
+                        # docker save (and crpy pull) write the layers uncompressed
+                        compression = "gzip"
+                        compressed = get_compressed_layer(diff_ids[name]) if name in diff_ids else None
+                        if compressed is None:
+                            to_compress[name] = diff_ids.get(name)
+                        else:
+                            descriptors[name] = {"size": compressed[1], "digest": compressed[0]}
+                            compressed_before.add(name)
+                    else:
+                        digest, size = await asyncio.to_thread(compute_sha256_from_file, _open_tar_member(t, name))
+                        descriptors[name] = {"size": size, "digest": digest}
+                    media_types[name] = _layer_media_types[compression]
+            names = list(descriptors)
+            existing = await asyncio.gather(*(self.blob_exists(descriptors[name]["digest"]) for name in names))
+            # layers compressed before are uploaded from the cache, if they are still there, or compressed again.
+            # They are kept in the cache until they are uploaded
+            cached = {}
+            reuse = [name for name, exists in zip(names, existing) if name in compressed_before and not exists]
+            stack.enter_context(pin_layers(descriptors[name]["digest"] for name in reuse))
+            for name in reuse:
+                cached[name] = await hold_layer(descriptors[name]["digest"])
+                if cached[name] is None:
+                    to_compress[name] = diff_ids[name]
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def _upload(name: str):
+                async with semaphore:
+                    if name in to_compress:
+                        descriptors[name] = await self._upload_compressed(
+                            _open_tar_member(t, name), to_compress[name] or name, diff_ids.get(name), chunk_size
+                        )
+                    else:
+                        descriptor = descriptors[name]
+                        with open(cached[name], "rb") if cached.get(name) else _open_tar_member(t, name) as f:
+                            await self._upload_blob(f, descriptor["digest"], descriptor["size"], chunk_size)
+                if name != config:
+                    print(f"{name[0:12]}: Pushed")
+
+            for name, exists in zip(names, existing):
+                if exists:
+                    descriptor = descriptors[name]
+                    self.metrics.inc("crpy_blobs_skipped_total")
+                    ProgressTracker(self.progress, descriptor["digest"], "upload", descriptor["size"]).skipped()
+                if exists and name != config:
+                    print(f"{name[0:12]}: Layer already exists")
+            missing = [name for name, exists in zip(names, existing) if not exists]
+            with self.metrics.time("upload", operation="push"):
+                await asyncio.gather(*(_upload(name) for name in dict.fromkeys([*missing, *to_compress])))
+
             # once the blobs are committed, we can push the manifest
+            config_manifest = {**descriptors[config], "mediaType": _media_type_config}
+            layers_manifest = [{**descriptors[layer], "mediaType": media_types[layer]} for layer in layers]
             image_manifest = self.build_manifest(config_manifest, layers_manifest)
-            r = await self.push_manifest(image_manifest)
+            with self.metrics.time("manifest", operation="push"):
+                r = await self.push_manifest(image_manifest)
             # some registries like docker hub return the header in lower case
             image_digest = r.headers.get("Docker-Content-Digest", "") or r.headers.get("docker-content-digest")
             print(f"Pushed {self.tag}: digest: {image_digest}")
 
-    async def _list(self, path: str, last: str = None, n: int = None, lazy: bool = False) -> List[dict]:
+    async def _upload_compressed(self, f: BinaryIO, name: str, diff_id: Optional[str], chunk_size: int) -> dict:
+        """
+        Compresses an uncompressed layer with gzip while it is uploaded, and returns the descriptor of the compressed
+        blob. The digest of the uncompressed layer is computed in the same pass and checked against ``diff_id``, if
+        given.
+        """
+        compressor = ParallelCompressor()
+        digest, size = await self._upload_stream(compressor.compress(f), None, chunk_size, name=name)
+        if diff_id is not None and compressor.diff_id != diff_id:
+            raise DigestMismatchError(f"Layer {name} has digest {compressor.diff_id}, but the config lists {diff_id}")
+        record_compressed_layer(compressor.diff_id, digest, size)
+        return {"size": size, "digest": digest}
+
+    async def _upload_stream(
+        self,
+        stream: AsyncIterator[bytes],
+        digest: Optional[str],
+        chunk_size: int,
+        size: Optional[int] = None,
+        name: Optional[str] = None,
+    ) -> Tuple[str, int]:
+        """
+        Uploads a blob from an async stream of bytes, sending one ``PATCH`` every ``chunk_size`` bytes, so that the
+        blob never has to be fully held in memory or written to disk. Since the stream cannot be rewound, a failed chunk
+        is only resumed from the data of the current chunk.
+
+        If ``digest`` is None, the blob is stored under the digest computed from the stream, for blobs that are
+        produced while they are uploaded. ``name`` is then used to refer to the blob in messages and progress events.
+
+        :return: digest and size of the uploaded blob.
+        """
+        name = name or digest
+        response = await self._request_with_auth(f"{self.blobs_url()}/uploads/", method="post")
+        assert response.status == 202, f"Failed to start upload of blob {name}: {response.data}"
+        location = self._upload_location(response)
+        tracker = ProgressTracker(self.progress, name, "upload", size)
+        tracker.started()
+        blob_hash = hashlib.sha256()
+        offset, failures = 0, 0
+        buffer = bytearray()
+
+        async def _send(chunk: bytes):
+            nonlocal location, offset, failures
+            end = offset + len(chunk)
+            while offset < end:
+                data = chunk[len(chunk) - (end - offset) :]
+                try:
+                    response = await self._request_with_auth(
+                        location,
+                        method="patch",
+                        data=data,
+                        headers={
+                            "Content-Type": "application/octet-stream",
+                            "Content-Range": f"{offset}-{end - 1}",
+                        },
+                    )
+                except HTTPConnectionError as e:
+                    response = Response(0, str(e).encode())
+                if response.status == 202:
+                    location = self._upload_location(response)
+                    offset = _upload_offset(response, end)
+                    tracker.advance(offset - tracker.transferred)
+                    failures = 0
+                    continue
+                failures += 1
+                if failures > UPLOAD_RESUME_ATTEMPTS:
+                    raise HTTPConnectionError(
+                        f"Failed to upload chunk at offset {offset} of blob {name}: {response.status} {response.data}"
+                    )
+                tracker.retry(f"Failed chunk at offset {offset}: {response.status} {response.data}")
+                self.metrics.inc("crpy_retries_total", operation="upload")
+                await asyncio.sleep(self.client.retry.backoff_delay(failures, response.headers))
+                status = await self._request_with_auth(location, method="get", headers=self._headers)
+                assert status.status == 204, f"Failed to resume upload of blob {name}: {status.data}"
+                location = self._upload_location(status)
+                resumed_offset = _upload_offset(status, 0)
+                if not end - len(chunk) <= resumed_offset <= end:
+                    raise HTTPConnectionError(f"Cannot resume upload of blob {name} at offset {resumed_offset}")
+                offset = resumed_offset
+                tracker.restart(offset)
+
+        async for data in stream:
+            blob_hash.update(data)
+            buffer.extend(data)
+            if len(buffer) >= chunk_size:
+                await _send(bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await _send(bytes(buffer))
+        if digest is None:
+            digest = f"sha256:{blob_hash.hexdigest()}"
+        elif f"sha256:{blob_hash.hexdigest()}" != digest:
+            # cancel the upload, so that the registry can discard the data received so far
+            await self._request_with_auth(location, method="delete", headers=self._headers)
+            raise DigestMismatchError(f"Blob {digest} from the source does not match its digest")
+        # once all chunks are uploaded, the upload is closed with the digest of the blob
+        await self._close_upload(location, digest)
+        tracker.finished()
+        return digest, offset
+
+    async def copy_to(
+        self,
+        destination: "RegistryInfo",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    ):
+        """
+        Copies the image to another repository, possibly on another registry. Blobs are streamed from this registry
+        straight into the upload at the destination, without going through the local disk (blobs already in the local
+        cache are uploaded from there instead). Blobs that already exist at the destination are skipped.
+
+        Multi-arch images are copied with all their platforms: each platform manifest is pushed by digest, followed by
+        the manifest list itself. Manifests are pushed byte for byte, so the copy keeps the digests of the source.
+
+        >>> async with RegistryInfo.from_url("staging.local/app:1.0") as src:
+        ...     await src.copy_to(RegistryInfo.from_url("prod.local/app:1.0", client=src.client))
+
+        :param destination: registry to copy the image to. Its tag is used as the target tag.
+        :param chunk_size: size in bytes of each uploaded chunk.
+        :param max_concurrency: maximum number of blobs copied at the same time.
+        """
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+        print(f"Copying {self} to {destination}")
+        root = await self.get_manifest(fat=True)
+        assert root.status == 200, f"Could not find manifest for {self}: {root.status} {root.data}"
+        root_json = root.json()
+        # the list of (raw manifest, media type, digest) to push, platform manifests first
+        manifests = []
+        if root_json.get("mediaType") in (_schema2_list_mimetype, _ociv1_index_mimetype) or "manifests" in root_json:
+            children = await asyncio.gather(
+                *(self.get_manifest(reference=entry["digest"]) for entry in root_json["manifests"])
+            )
+            for entry, child in zip(root_json["manifests"], children):
+                assert child.status == 200, f"Could not find manifest {entry['digest']}: {child.status} {child.data}"
+                manifests.append((child.data, _content_type(child, entry.get("mediaType")), entry["digest"]))
+        manifests.append((root.data, _content_type(root, root_json.get("mediaType")), None))
+
+        blobs = {}
+        for data, _, _ in manifests:
+            manifest = json.loads(data)
+            for descriptor in [manifest.get("config"), *manifest.get("layers", [])]:
+                if descriptor:
+                    blobs.setdefault(descriptor["digest"], descriptor)
+        existing = await asyncio.gather(*(destination.blob_exists(digest) for digest in blobs))
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _copy_blob(digest: str):
+            async with semaphore:
+                layer_path = await hold_layer(digest)
+                if layer_path is not None:
+                    with open(layer_path, "rb") as f:
+                        await destination._upload_blob(f, digest, blobs[digest]["size"], chunk_size)
+                else:
+                    stream = self._stream_with_auth(f"{self.blobs_url()}/{digest}")
+                    try:
+                        await destination._upload_stream(stream, digest, chunk_size, blobs[digest].get("size"))
+                    finally:
+                        # a failed upload stops reading the stream, which still holds the response from the source
+                        await stream.aclose()
+            print(f"{digest.split(':')[1][0:12]}: Copied")
+
+        for digest, exists in zip(blobs, existing):
+            if exists:
+                print(f"{digest.split(':')[1][0:12]}: Blob already exists")
+                destination.metrics.inc("crpy_blobs_skipped_total")
+                # uploads are reported by the destination, so skipped blobs are reported there as well
+                ProgressTracker(destination.progress, digest, "upload", blobs[digest].get("size")).skipped()
+        missing = [digest for digest, exists in zip(blobs, existing) if not exists]
+        # blobs uploaded from the cache are kept there until they are uploaded
+        with self.metrics.time("transfer", operation="copy"), pin_layers(missing):
+            await asyncio.gather(*(_copy_blob(digest) for digest in missing))
+
+        # manifests are only pushed once everything they reference is available at the destination
+        for data, media_type, reference in manifests:
+            r = await destination.push_manifest(data, media_type=media_type, reference=reference)
+        image_digest = r.headers.get("Docker-Content-Digest", "") or r.headers.get("docker-content-digest")
+        print(f"Copied {self} to {destination}: digest: {image_digest}")
+
+    async def _iter_pages(self, path: str, last: str = None, n: int = None, lazy: bool = False) -> AsyncIterator[dict]:
         url = f"{self.v2_url()}/{path}"
         params = {}
         if n is not None:
             params["n"] = n
         if last is not None:
             params["last"] = last
-        response = await self._request_with_auth(url, method="get", params=params, headers=self._headers)
-        ret_value = [response.json()]
-        # use pagination to get further tags, if any
-        if "Link" in response.headers and not lazy:
-            last = re.search(r"last=(\w+)", response.headers["Link"]).group(1)
-            n = re.search(r"n=(\d+)", response.headers["Link"]).group(1)
-            next_response = await self._list(path, last, int(n))
-            ret_value.append(next_response[0])
-        return ret_value
+        while url is not None:
+            response = await self._request_with_auth(url, method="get", params=params, headers=self._headers)
+            if response.status != 200:
+                raise ValueError(f"Could not list {url}: {response.status} {response.data.decode(errors='replace')}")
+            yield response.json()
+            # use pagination to get further pages, if any. The link already contains the query parameters.
+            url = None if lazy else _next_page_url(url, response.headers)
+            params = None
+
+    async def iter_repositories(self, last: str = None, n: int = None) -> AsyncIterator[str]:
+        """
+        Iterates over the repositories of the registry, yielding them as each page arrives. Pages are only requested
+        when the previous one was consumed, so the caller can stop early without fetching the remaining pages.
+
+        >>> async for repository in ri.iter_repositories():
+        ...     print(repository)
+
+        :param last: Last element received on a previous call. ``None`` means from beginning.
+        :param n: Number of elements on each page. ``None`` means default from registry.
+        """
+        async for page in self._iter_pages("_catalog", last, n):
+            for entry in page.get("repositories") or []:
+                yield entry
+
+    async def iter_tags(self, last: str = None, n: int = None) -> AsyncIterator[str]:
+        """
+        Iterates over the tags of the repository, yielding them as each page arrives. Pages are only requested when the
+        previous one was consumed, so the caller can stop early without fetching the remaining pages.
+
+        :param last: Last element received on a previous call. ``None`` means from beginning.
+        :param n: Number of elements on each page. ``None`` means default from registry.
+        """
+        async for page in self._iter_pages(f"{self.repository}/tags/list", last, n):
+            for entry in page.get("tags") or []:
+                yield entry
 
     async def list_repositories(self, last: str = None, n: int = None) -> List[str]:
         """
@@ -538,8 +1800,8 @@ class RegistryInfo:
             the last element of the previous response.
         :return: List of repositories available in the registry.
         """
-        response = await self._list("_catalog", last, n, False if n is None else True)
-        return [entry for page in response for entry in page["repositories"]]
+        pages = self._iter_pages("_catalog", last, n, False if n is None else True)
+        return [entry async for page in pages for entry in page.get("repositories") or []]
 
     async def list_tags(self, last: str = None, n: int = None) -> List[str]:
         """
@@ -552,8 +1814,8 @@ class RegistryInfo:
             the last element of the previous response.
         :return: List of tags available in the repository.
         """
-        response = await self._list(f"{self.repository}/tags/list", last, n, False if n is None else True)
-        return [entry for page in response for entry in page["tags"]]
+        pages = self._iter_pages(f"{self.repository}/tags/list", last, n, False if n is None else True)
+        return [entry async for page in pages for entry in page.get("tags") or []]
 
     async def delete_tag(self) -> Response:
         """
@@ -572,3 +1834,173 @@ class RegistryInfo:
         url = f"{self.v2_url()}/{self.repository}/manifests/{reference}"
         response = await self._request_with_auth(url, headers=self._headers, method="delete")
         return response
+
+
+def _next_page_url(url: str, headers: Optional[dict]) -> Optional[str]:
+    """
+    Returns the url of the next page from a ``Link`` header, resolved against the current url, or None on the last page.
+
+    >>> _next_page_url("https://registry/v2/_catalog?n=2", {"Link": '</v2/_catalog?last=b&n=2>; rel="next"'})
+    'https://registry/v2/_catalog?last=b&n=2'
+    """
+    link = next((v for k, v in (headers or {}).items() if k.lower() == "link"), None)
+    if not link:
+        return None
+    match = re.search(r'<([^>]+)>\s*;\s*rel="?next"?', link)
+    if match is None:
+        return None
+    return urljoin(url, match.group(1))
+
+
+# reads of the members of each archive, which all seek and read the same file
+_archive_locks: "weakref.WeakKeyDictionary[tarfile.TarFile, threading.Lock]" = weakref.WeakKeyDictionary()
+
+
+class _ArchiveMember:
+    """
+    Member of a tar-file opened with ``_open_tar_member()``. Each read seeks the file of the archive before reading
+    from it, so the reads of all members of an archive are serialized, and they can be done in worker threads.
+    """
+
+    def __init__(self, file_obj: BinaryIO, lock: threading.Lock):
+        self._file_obj = file_obj
+        self._lock = lock
+
+    def read(self, size: int = -1) -> bytes:
+        with self._lock:
+            return self._file_obj.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file_obj.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file_obj.tell()
+
+    def close(self):
+        self._file_obj.close()
+
+    def __enter__(self) -> "_ArchiveMember":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _open_tar_member(tar: tarfile.TarFile, name: str) -> BinaryIO:
+    """
+    Opens a member of a tar-file for reading, without extracting it. Archives written by crpy prefix the member names
+    with ``./``, while ``docker save`` does not, so both variants are looked up. Links to other members (as used by
+    newer docker versions to deduplicate layers) are followed. Members can be read from different threads at the same
+    time, see ``_ArchiveMember``.
+    """
+    for candidate in (name, f"./{name}", name[2:] if name.startswith("./") else name):
+        try:
+            member = tar.getmember(candidate)
+        except KeyError:
+            continue
+        file_obj = tar.extractfile(member)
+        if file_obj is not None:
+            return _ArchiveMember(file_obj, _archive_locks.setdefault(tar, threading.Lock()))
+    raise ValueError(f"Could not find file {name} in the image archive {tar.name}")
+
+
+def _extract_member(
+    member: tarfile.TarInfo,
+    f: Optional[BinaryIO],
+    path: pathlib.Path,
+    output_dir: pathlib.Path,
+    link_to: Optional[pathlib.Path] = None,
+):
+    """
+    Writes a member of a layer to ``path``, or links it to ``link_to`` if the same content was already extracted
+    there. Only regular files, directories and symbolic links are extracted. Symbolic links extracted before, like
+    ``etc -> /``, are never followed out of ``output_dir``.
+    """
+    root = output_dir.resolve()
+    for checked in (path.parent, link_to):
+        if checked is not None and not checked.resolve().is_relative_to(root):
+            raise ValueError(f"Cannot extract {member.name}, {checked} is a symbolic link out of {output_dir}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.is_symlink() or (path.exists() and not path.is_dir()):
+        path.unlink()
+    if member.issym():
+        os.symlink(member.linkname, path)
+    elif member.isdir():
+        path.mkdir(exist_ok=True)
+    elif link_to is not None:
+        shutil.copyfile(link_to, path)
+        os.chmod(path, member.mode & 0o777)
+    elif f is not None:
+        with open(path, "wb") as out:
+            shutil.copyfileobj(f, out)
+        os.chmod(path, member.mode & 0o777)
+    else:
+        raise ValueError(f"Cannot extract {member.name}, which is neither a file, a directory nor a symbolic link")
+
+
+def _layer_diff_ids(manifest: dict, config: dict) -> Dict[str, Tuple[str, str]]:
+    """
+    Maps the digest of each compressed layer of an image to its diff_id and compression, for the layers that can be
+    decompressed. Layers that are not compressed already have their diff_id as digest, so they are left out.
+
+    >>> manifest = {"layers": [{"mediaType": "application/vnd.oci.image.layer.v1.tar+gzip", "digest": "sha256:12"}]}
+    >>> _layer_diff_ids(manifest, {"rootfs": {"type": "layers", "diff_ids": ["sha256:34"]}})
+    {'sha256:12': ('sha256:34', 'gzip')}
+    """
+    diff_ids = config.get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(manifest["layers"]):
+        raise DigestMismatchError(
+            f"The image config lists {len(diff_ids)} diff_ids for {len(manifest['layers'])} layers"
+        )
+    layers = {}
+    for descriptor, diff_id in zip(manifest["layers"], diff_ids):
+        compression = layer_compression(descriptor.get("mediaType"))
+        if compression is None:
+            continue
+        if not can_decompress(compression):
+            layer = descriptor["digest"].split(":")[1][0:12]
+            print(
+                f"[yellow]Keeping {compression} layer {layer} compressed, install zstandard to decompress it[/yellow]"
+            )
+            continue
+        layers[descriptor["digest"]] = (diff_id, compression)
+    return layers
+
+
+def _check_output_format(output_format: str, output_file: Union[str, pathlib.Path, io.BytesIO]):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Output format '{output_format}' not recognized. Choose one from {list(OUTPUT_FORMATS)}")
+    if output_format == "oci" and not isinstance(output_file, (str, pathlib.Path)):
+        raise ValueError("The OCI image layout is a directory, so the output must be a directory path, not a file")
+
+
+def _content_type(response: Response, default: Optional[str] = None) -> str:
+    """Returns the media type of a manifest response, without parameters such as the charset."""
+    headers = {k.lower(): v for k, v in (response.headers or {}).items()}
+    content_type = headers.get("content-type", "").split(";")[0].strip()
+    if content_type and content_type not in ("application/json", "application/octet-stream"):
+        return content_type
+    return default or _schema2_mimetype
+
+
+def _upload_offset(response: Response, default: int) -> int:
+    """
+    Returns the next offset of an upload from the ``Range`` header of the response, which reports the range of bytes
+    already received by the registry, in the format ``0-<last byte>``.
+
+    >>> _upload_offset(Response(202, b"", {"Range": "0-1023"}), 0)
+    1024
+    >>> _upload_offset(Response(204, b"", {"Range": "0-0"}), 0)
+    0
+    >>> _upload_offset(Response(202, b"", {"range": "0-1023"}), 0)
+    1024
+    """
+    headers = {k.lower(): v for k, v in (response.headers or {}).items()}
+    upload_range = headers.get("range")
+    if not upload_range:
+        return default
+    last_byte = int(upload_range.split("-")[-1])
+    if last_byte == 0:
+        # registries also report an empty upload as "0-0", which cannot be told apart from a single byte received
+        return min(default, 1)
+    return last_byte + 1
@@ -0,0 +1,177 @@
+"""
+Retry policy for transient registry errors. Every request made through an ``HTTPClient`` is retried according to its
+policy, with exponential backoff and full jitter between attempts:
+
+>>> client = HTTPClient(retry=RetryPolicy(attempts=10, max_delay=60))
+>>> async with RegistryInfo.from_url("alpine:latest", client=client) as ri:
+...     await ri.pull("alpine.tar")
+
+Only requests that can be safely sent again are retried. Idempotent methods are retried after connection errors and
+``408``, ``429``, ``500``, ``502``, ``503`` and ``504`` responses, while ``POST`` is only retried after ``429`` and
+``503``, which mean the registry did not process the request. Upload chunks (``PATCH``) are never replayed here: the
+upload asks the registry how much data it received and resumes from there instead. The ``PUT`` closing an upload is not
+retried after errors that leave it unknown whether it was processed, since the upload is gone once it was committed.
+The registry is asked if it has the blob instead.
+"""
+
+import asyncio
+import datetime
+import email.utils
+import random
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# methods that have the same effect when sent more than once, see RFC 9110, section 9.2.2
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+# statuses that mean the server did not process the request, so that any method can be sent again
+UNPROCESSED_STATUSES = frozenset({429, 503})
+# upload chunks are resumed from the offset reported by the registry, so they are never replayed as they are
+NEVER_RETRIED_METHODS = frozenset({"PATCH"})
+
+
+@dataclass
+class RetryPolicy:
+    """
+    How transient errors are retried.
+
+    :param attempts: total number of attempts of a request, including the first one. ``1`` disables retries.
+    :param backoff: base delay in seconds. The delay before the n-th retry is random between zero and
+        ``backoff * 2 ** (n - 1)``, so that clients that failed together do not retry together.
+    :param max_delay: maximum delay in seconds between attempts. If the registry asks to wait longer than this with
+        ``Retry-After``, the request is not retried.
+    :param statuses: response statuses that are retried for idempotent methods.
+    :param hedge_after: if set, a blob download that did not receive a response after this many seconds is sent a
+        second time, and whichever response arrives first is used.
+    """
+
+    attempts: int = 5
+    backoff: float = 0.5
+    max_delay: float = 30.0
+    statuses: Tuple[int, ...] = (408, 429, 500, 502, 503, 504)
+    hedge_after: Optional[float] = None
+
+    def __post_init__(self):
+        if self.attempts < 1:
+            raise ValueError(f"attempts must be at least 1, got {self.attempts}")
+
+    def should_retry_status(
+        self, method: str, status: int, data: Any = None, idempotent: Optional[bool] = None
+    ) -> bool:
+        method = method.upper()
+        if method in NEVER_RETRIED_METHODS or not _replayable(data):
+            return False
+        if _is_idempotent(method, idempotent):
+            return status in self.statuses
+        return status in UNPROCESSED_STATUSES and status in self.statuses
+
+    def should_retry_error(self, method: str, data: Any = None, idempotent: Optional[bool] = None) -> bool:
+        # after a connection error, there is no way to know whether the request was processed
+        return _is_idempotent(method.upper(), idempotent) and _replayable(data)
+
+    def delay(self, attempt: int, headers: Optional[dict] = None) -> Optional[float]:
+        """
+        Returns how long to wait before the next attempt, or None if the request should not be retried anymore.
+
+        :param attempt: number of attempts made so far, starting at 1.
+        :param headers: headers of the failed response, if any, to honor ``Retry-After``.
+        """
+        if attempt >= self.attempts:
+            return None
+        retry_after = _retry_after(headers)
+        if retry_after is not None and retry_after > self.max_delay:
+            return None
+        return self.backoff_delay(attempt, headers)
+
+    def backoff_delay(self, attempt: int, headers: Optional[dict] = None) -> float:
+        """
+        Returns the delay after ``attempt`` failed attempts, regardless of the number of attempts left. Used by
+        transfers that resume on their own, like interrupted downloads and uploads.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.backoff * 2 ** (attempt - 1)))
+        retry_after = _retry_after(headers)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.max_delay)
+
+    async def call(
+        self,
+        method: str,
+        send: Callable[[], Awaitable[T]],
+        data: Any = None,
+        on_retry: Optional[Callable[[str], None]] = None,
+        is_error: Callable[[BaseException], bool] = lambda e: False,
+        discard: Optional[Callable[[T], None]] = None,
+        idempotent: Optional[bool] = None,
+    ) -> T:
+        """
+        Calls ``send`` until it returns a response that should not be retried, or until the attempts are exhausted.
+        The response of the last attempt is returned, even if it failed, so that the caller can report it.
+
+        :param method: HTTP method of the request.
+        :param send: coroutine function that sends the request and returns a response with ``status`` and ``headers``.
+        :param data: body of the request, to check that it can be sent again.
+        :param on_retry: called with the reason of each retry.
+        :param is_error: tells which exceptions are transient errors that can be retried.
+        :param discard: called with the responses that are retried, to release them.
+        :param idempotent: overrides whether the request can be sent twice, which otherwise depends on ``method``.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await send()
+            except Exception as e:
+                if not (is_error(e) and self.should_retry_error(method, data, idempotent)):
+                    raise
+                delay = self.delay(attempt)
+                if delay is None:
+                    raise
+                reason = str(e) or type(e).__name__
+            else:
+                if not self.should_retry_status(method, response.status, data, idempotent):
+                    return response
+                delay = self.delay(attempt, response.headers)
+                if delay is None:
+                    return response
+                reason = f"status {response.status}"
+                if discard is not None:
+                    discard(response)
+            if on_retry is not None:
+                on_retry(reason)
+            await asyncio.sleep(delay)
+
+
+def _is_idempotent(method: str, idempotent: Optional[bool]) -> bool:
+    return method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+
+
+def _replayable(data: Any) -> bool:
+    # streams and generators are consumed by the first attempt, so only bodies held in memory can be sent again
+    return data is None or isinstance(data, (bytes, bytearray, str, dict))
+
+
+def _retry_after(headers: Optional[dict]) -> Optional[float]:
+    """
+    Parses the ``Retry-After`` header, which can be a number of seconds or a date.
+
+    >>> _retry_after({"Retry-After": "3"})
+    3.0
+    >>> _retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    0.0
+    """
+    if not headers:
+        return None
+    value = next((v for k, v in headers.items() if k.lower() == "retry-after"), None)
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
@@ -0,0 +1,251 @@
+"""
+Random access to the files of seekable layers, without downloading the whole layer. eStargz and zstd:chunked layers
+compress the content of each file (or each chunk of a large file) on its own, and store a table of contents (TOC) with
+the offset of every chunk in the blob. A file can then be read with a few HTTP range requests: one for the TOC (and
+the footer pointing to it) and one for each chunk of the file.
+
+>>> async with RegistryInfo.from_url("ghcr.io/stargz-containers/alpine:3.15.3-esgz") as ri:
+...     async for chunk in ri.open_file("/etc/os-release"):
+...         sys.stdout.buffer.write(chunk)
+
+Both formats are still valid gzip (or zstd) tar-files, so they can be pulled like any other layer.
+"""
+
+import bisect
+import io
+import json
+import re
+import tarfile
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# the eStargz footer is an empty gzip member, whose extra field holds the offset of the TOC
+ESTARGZ_FOOTER_SIZE = 51
+ESTARGZ_TOC_NAME = "stargz.index.json"
+# annotation of zstd:chunked layers with "offset:length:uncompressed length:type" of the TOC
+ZSTD_CHUNKED_MANIFEST_POSITION = "io.github.containers.zstd-chunked.manifest-position"
+# same limit as linux, so that symbolic link loops are detected
+MAX_SYMLINKS = 40
+
+_WHITEOUT_PREFIX = ".wh."
+_OPAQUE_WHITEOUT = ".wh..wh..opq"
+# names of the tar member types, as used by the TOC of eStargz
+_tar_types = {
+    tarfile.REGTYPE: "reg",
+    tarfile.AREGTYPE: "reg",
+    tarfile.CONTTYPE: "reg",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+    tarfile.CHRTYPE: "char",
+    tarfile.BLKTYPE: "block",
+    tarfile.FIFOTYPE: "fifo",
+}
+
+
+@dataclass
+class TocChunk:
+    """
+    Chunk of the content of a file in a seekable layer.
+
+    :param offset: offset in the blob of the compressed data of the chunk.
+    :param end: offset in the blob where the compressed data of the chunk ends, or where the next chunk starts.
+    :param size: uncompressed size of the chunk.
+    :param zeros: if the chunk is a hole of the file, which is not stored in the blob.
+    """
+
+    offset: int
+    end: int
+    size: int
+    zeros: bool = False
+
+
+@dataclass
+class TocEntry:
+    """
+    Entry of the table of contents of a layer.
+
+    :param name: path of the entry in the layer, without leading slash.
+    :param type: "reg", "dir", "symlink", "hardlink" or another tar type, like "char" or "fifo".
+    :param size: size of the content of regular files.
+    :param link_name: target of symbolic links and hard links.
+    :param digest: digest of the content of regular files, if the TOC lists it.
+    :param chunks: chunks of the content of regular files.
+    :param tarinfo: member of the tar-file, for layers listed by reading their content.
+    """
+
+    name: str
+    type: str
+    size: int = 0
+    link_name: str = ""
+    digest: Optional[str] = None
+    chunks: List[TocChunk] = field(default_factory=list)
+    tarinfo: Optional[tarfile.TarInfo] = None
+
+    @classmethod
+    def from_tarinfo(cls, member: tarfile.TarInfo) -> "TocEntry":
+        name = normalize_path(member.name)
+        return cls(name, _tar_types.get(member.type, "other"), member.size, member.linkname, tarinfo=member)
+
+    @property
+    def is_whiteout(self) -> bool:
+        return self.name.rsplit("/", 1)[-1].startswith(_WHITEOUT_PREFIX)
+
+
+@dataclass
+class LayerToc:
+    """
+    Table of contents of a layer. For seekable layers, ``compression`` tells how each chunk is compressed. Layers that
+    are not seekable are listed by reading their members instead, so their entries have no chunks, but a ``tarinfo``.
+    """
+
+    digest: str
+    entries: Dict[str, TocEntry]
+    compression: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, digest: str, compression: str, toc: dict, end: int) -> "LayerToc":
+        """
+        Parses the TOC of an eStargz or zstd:chunked layer. eStargz only lists where each chunk starts, so a chunk
+        ends where the next one (or the TOC, at ``end``) starts.
+        """
+        offsets = sorted({entry["offset"] for entry in toc["entries"] if entry.get("offset")} | {end})
+        entries: Dict[str, TocEntry] = {}
+        for item in toc["entries"]:
+            name = normalize_path(item["name"])
+            if item["type"] != "chunk":
+                entries[name] = TocEntry(
+                    name,
+                    item["type"],
+                    size=item.get("size", 0),
+                    link_name=item.get("linkName", ""),
+                    digest=item.get("digest"),
+                )
+            entry = entries.get(name)
+            if entry is None or entry.type != "reg" or entry.size == 0:
+                continue
+            chunk_offset = item.get("chunkOffset", 0)
+            size = item.get("chunkSize") or entry.size - chunk_offset
+            if item.get("chunkType") == "zeros":
+                entry.chunks.append(TocChunk(0, 0, size, zeros=True))
+                continue
+            offset = item["offset"]
+            chunk_end = item.get("endOffset") or offsets[bisect.bisect_right(offsets, offset)]
+            entry.chunks.append(TocChunk(offset, chunk_end, size))
+        return cls(digest, entries, compression)
+
+    def hides(self, name: str) -> bool:
+        """
+        Tells if this layer deletes ``name`` from the layers below, with a whiteout file for it or one of its parent
+        directories, or by making one of its parent directories opaque.
+        """
+        parts = name.split("/")
+        for i, part in enumerate(parts):
+            parent = "/".join(parts[:i])
+            if _join(parent, f"{_WHITEOUT_PREFIX}{part}") in self.entries:
+                return True
+            if i and _join(parent, _OPAQUE_WHITEOUT) in self.entries:
+                return True
+        return False
+
+    def resolve_hardlink(self, entry: TocEntry) -> TocEntry:
+        if entry.type != "hardlink":
+            return entry
+        target = self.entries.get(normalize_path(entry.link_name))
+        if target is None:
+            raise FileNotFoundError(f"Hard link {entry.name} points to {entry.link_name}, which is not in the layer")
+        return target
+
+
+def normalize_path(path: str) -> str:
+    """
+    Normalizes a path in a layer the way it is stored in the TOC.
+
+    >>> normalize_path("/etc/os-release")
+    'etc/os-release'
+    >>> normalize_path("./usr/bin/")
+    'usr/bin'
+    """
+    return "/".join(part for part in path.split("/") if part not in ("", "."))
+
+
+def estargz_toc_offset(footer: bytes) -> Optional[int]:
+    """
+    Returns the offset of the TOC from the footer of an eStargz layer (or of a legacy stargz layer), or None if the
+    blob does not end with such a footer.
+
+    >>> estargz_toc_offset(b"\\x1a\\x00SG\\x16\\x000000000000001234STARGZ\\x01\\x00\\x00\\xff\\xff" + bytes(8))
+    4660
+    >>> estargz_toc_offset(b"\\x00" * 51) is None
+    True
+    """
+    match = re.search(rb"([0-9a-f]{16})STARGZ", footer)
+    return int(match.group(1), 16) if match else None
+
+
+def read_estargz_toc(data: bytes) -> dict:
+    """Reads the TOC from the decompressed end of an eStargz layer, which is a tar-file with a single JSON member."""
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        member = tar.extractfile(ESTARGZ_TOC_NAME)
+        if member is None:
+            raise ValueError(f"{ESTARGZ_TOC_NAME} is not a file")
+        return json.load(member)
+
+
+async def resolve_path(
+    path: str, n_layers: int, get_toc: Callable[[int], Awaitable[LayerToc]]
+) -> Tuple[LayerToc, TocEntry]:
+    """
+    Finds a file in the layers of an image, from the top layer down, following symbolic links (also in the parent
+    directories of the path) and honoring whiteouts. The TOCs of the layers are only requested when they are needed.
+
+    :param path: path of the file in the image.
+    :param n_layers: number of layers of the image.
+    :param get_toc: returns the TOC of the layer at the given index.
+    :return: TOC of the layer holding the file, and its entry.
+    """
+    parts = normalize_path(path).split("/")
+    resolved: List[str] = []
+    found, links = None, 0
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        name = "/".join(resolved + [part])
+        found = await _lookup(name, n_layers, get_toc)
+        if found is not None and found[1].type == "symlink":
+            links += 1
+            if links > MAX_SYMLINKS:
+                raise FileNotFoundError(f"Too many levels of symbolic links in {path}")
+            if found[1].link_name.startswith("/"):
+                resolved = []
+            parts = [part for part in found[1].link_name.split("/") if part not in ("", ".")] + parts
+            continue
+        # parent directories do not always have an entry of their own, so only the last part has to exist
+        resolved.append(part)
+    if found is None:
+        raise FileNotFoundError(f"{path} does not exist in the image")
+    toc, entry = found
+    entry = toc.resolve_hardlink(entry)
+    if entry.type != "reg":
+        raise FileNotFoundError(f"{path} is not a regular file, but a {entry.type} entry")
+    return toc, entry
+
+
+async def _lookup(
+    name: str, n_layers: int, get_toc: Callable[[int], Awaitable[LayerToc]]
+) -> Optional[Tuple[LayerToc, TocEntry]]:
+    for index in reversed(range(n_layers)):
+        toc = await get_toc(index)
+        entry = toc.entries.get(name)
+        if entry is not None:
+            return toc, entry
+        if toc.hides(name):
+            return None
+    return None
+
+
+def _join(parent: str, name: str) -> str:
+    return f"{parent}/{name}" if parent else name
@@ -1,14 +1,36 @@
+import asyncio
 import base64
+import contextlib
+import copy
+import hashlib
 import json
 import os
 import pathlib
+import sqlite3
 import sys
+import time
 from base64 import b64encode
 from functools import lru_cache
-from typing import Optional, Tuple
+from typing import (
+    AsyncIterator,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 from rich import print
 
+from crpy.common import DigestMismatchError, parse_size
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 
 @lru_cache
 def get_config_dir() -> pathlib.Path:
@@ -29,7 +51,16 @@ def get_config_file() -> pathlib.Path:
     return config_file
 
 
+def get_token_cache_file() -> pathlib.Path:
+    return get_config_dir() / "tokens.json"
+
+
+@lru_cache
 def get_config() -> dict:
+    """
+    Returns the content of the config file. It is parsed once, then cached until it is changed with
+    ``save_credentials()`` or ``remove_credentials()``, so the returned dict must not be modified.
+    """
     config_file = get_config_file()
     try:
         config = json.loads(config_file.read_text())
@@ -52,34 +83,529 @@ def decode_credentials(creds: str) -> Tuple[str, str]:
 
 
 def save_credentials(url: str, username: str, password: str):
-    creds = get_config()
+    creds = copy.deepcopy(get_config())
     token = b64encode(f"{username}:{password}".encode("utf-8")).decode("ascii")
     creds["auths"][url] = {"auth": token}
-    get_config_file().write_text(json.dumps(creds, indent=2))
+    _save_config(creds)
 
 
 def remove_credentials(url: str) -> bool:
-    creds = get_config()
+    creds = copy.deepcopy(get_config())
     removed = creds["auths"].pop(url, None)
-    get_config_file().write_text(json.dumps(creds, indent=2))
+    _save_config(creds)
     return removed is not None
 
 
-def get_layer_path(layer: str) -> Optional[pathlib.Path]:
+def _save_config(config: dict):
+    get_config_file().write_text(json.dumps(config, indent=2))
+    get_config.cache_clear()
+    get_cache_settings.cache_clear()
+
+
+def get_blobs_dir() -> pathlib.Path:
     cache_dir = get_config_dir() / "blobs/"
     os.makedirs(cache_dir, exist_ok=True)
-    layer_path = cache_dir / layer.replace(":", "_")
+    return cache_dir
+
+
+def get_layer_path(layer: str, verify: bool = False) -> Optional[pathlib.Path]:
+    """
+    Returns the path of a layer in the cache, or None if it is not cached.
+
+    :param layer: reference for the layer. Looks something like "sha256:1234..."
+    :param verify: if the content of the cached file should be checked against the digest. Corrupted files are removed
+        from the cache, and None is returned, so that the layer is downloaded again.
+    """
+    layer_path = get_blobs_dir() / layer.replace(":", "_")
+    if not layer_path.is_file():
+        return None
+    if verify:
+        algorithm = layer.split(":")[0] if ":" in layer else "sha256"
+        layer_hash = hashlib.new(algorithm)
+        with open(layer_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                layer_hash.update(chunk)
+        if f"{algorithm}:{layer_hash.hexdigest()}" != layer:
+            print(f"[yellow]Removing corrupted layer {layer} from the cache[/yellow]", file=sys.stderr)
+            remove_layer(layer)
+            return None
+    return layer_path
+
+
+@contextlib.asynccontextmanager
+async def lock_layer(layer: str, poll_interval: float = 0.1) -> AsyncIterator[None]:
+    """
+    Holds an exclusive lock for a layer, shared between all processes using the same cache. It is used around
+    downloads, so that when several processes pull the same layer, one downloads it and the others wait for the result
+    instead of writing to the same partial file. Waiting is done without blocking the event loop.
+
+    On platforms without ``fcntl`` (Windows), the lock does nothing.
+    """
+    if fcntl is None:
+        yield
+        return
+    # the blob is only downloaded again if it is gone, so the shared lock of this process is of no use anymore, and
+    # it would conflict with the exclusive lock, since locks taken through different files conflict in one process
+    _release_layer(layer)
+    # closing the file releases the lock
+    with await _wait_lock(_lock_path(layer), fcntl.LOCK_EX, poll_interval):
+        yield
+
+
+async def hold_layer(layer: str, verify: bool = False, poll_interval: float = 0.1) -> Optional[pathlib.Path]:
+    """
+    Returns the path of a cached layer like ``get_layer_path()``, but also protects a layer pinned with
+    ``pin_layers()`` from being evicted by other processes until it is unpinned. A shared lock is held for that, which
+    ``evict_layers()`` respects. Returns None if the layer is not cached, or was evicted before it could be locked.
+    """
+    layer_path = await asyncio.to_thread(get_layer_path, layer, verify)
+    if layer_path is None or fcntl is None or layer not in _pinned_layers or layer in _held_layers:
+        return layer_path
+    lock_file = await _wait_lock(_lock_path(layer), fcntl.LOCK_SH, poll_interval)
+    if get_layer_path(layer) is None or layer not in _pinned_layers or layer in _held_layers:
+        lock_file.close()
+        return get_layer_path(layer)
+    _held_layers[layer] = lock_file
+    return layer_path
+
+
+def _release_layer(layer: str):
+    lock_file = _held_layers.pop(layer, None)
+    if lock_file is not None:
+        lock_file.close()
+
+
+def get_locks_dir() -> pathlib.Path:
+    locks_dir = get_config_dir() / "locks/"
+    os.makedirs(locks_dir, exist_ok=True)
+    return locks_dir
+
+
+def _lock_path(layer: str) -> pathlib.Path:
+    return get_locks_dir() / f"{layer.replace(':', '_')}.lock"
+
+
+def _try_lock(path: pathlib.Path, operation: int) -> Optional[BinaryIO]:
+    """
+    Locks a lock file without waiting, and returns the open file holding the lock, or None if another process holds a
+    conflicting lock. ``gc_cache()`` removes the lock files nobody holds, so if the file was removed between opening
+    and locking it, the lock is worthless and the file is opened again.
+    """
+    while True:
+        lock_file = open(path, "a+b")
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path)):
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+async def _wait_lock(path: pathlib.Path, operation: int, poll_interval: float) -> BinaryIO:
+    while True:
+        lock_file = _try_lock(path, operation)
+        if lock_file is not None:
+            return lock_file
+        await asyncio.sleep(poll_interval)
+
+
+def _is_locked(path: pathlib.Path) -> bool:
+    if fcntl is None or not path.exists():
+        return False
+    lock_file = _try_lock(path, fcntl.LOCK_EX)
+    if lock_file is None:
+        return True
+    lock_file.close()
+    return False
+
+
+def _remove_lock_file(path: pathlib.Path) -> bool:
+    """Removes a lock file, unless a process holds it. It is removed while locked, see ``_try_lock()``."""
+    if fcntl is None:
+        return False
+    lock_file = _try_lock(path, fcntl.LOCK_EX)
+    if lock_file is None:
+        return False
+    with lock_file:
+        path.unlink(missing_ok=True)
+    return True
+
+
+def remove_layer(layer: str):
+    """Removes a layer from the cache and from the cache index."""
+    layer_path = get_blobs_dir() / layer.replace(":", "_")
     if layer_path.is_file():
+        layer_path.unlink()
+    with _cache_index() as index:
+        index.execute("DELETE FROM blobs WHERE digest = ?", (layer,))
+
+
+class LayerWriter:
+    """
+    Writes a blob into the cache chunk by chunk, so that it never has to be fully loaded in memory. The content goes
+    to a ``.partial`` file in the blobs directory while the digest is computed incrementally. Once ``commit()`` is
+    called, the digest is checked against the expected one and the file is atomically renamed to its final location, so
+    a partially written blob is never visible in the cache.
+
+    If the writer is closed without a commit (for example, because the connection dropped), the partial file is kept.
+    The next writer for the same layer picks it up again, so that the download can continue from ``writer.size``.
+
+    >>> with LayerWriter("sha256:1234...") as writer:
+    ...     for chunk in chunks:
+    ...         writer.write(chunk)
+    ...     layer_path = writer.commit()
+    """
+
+    def __init__(self, layer: str, repository: Optional[str] = None):
+        self.layer = layer
+        self.repository = repository
+        self.size = 0
+        self._algorithm = layer.split(":")[0] if ":" in layer else "sha256"
+        self._hash = hashlib.new(self._algorithm)
+        self.partial_path = get_blobs_dir() / f"{layer.replace(':', '_')}.partial"
+        # writes always go to the end of the file, after any content left by a previous attempt
+        self._file = open(self.partial_path, "a+b")
+        # the hash state cannot be stored, so it is computed again from the content already on disk
+        self._file.seek(0)
+        for chunk in iter(lambda: self._file.read(1024 * 1024), b""):
+            self._hash.update(chunk)
+            self.size += len(chunk)
+
+    @property
+    def digest(self) -> str:
+        return f"{self._hash.name}:{self._hash.hexdigest()}"
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def truncate(self):
+        """Drops any content written so far, to start the blob from the beginning."""
+        self._file.seek(0)
+        self._file.truncate()
+        self._hash = hashlib.new(self._algorithm)
+        self.size = 0
+
+    def commit(self) -> pathlib.Path:
+        """Verifies the digest of the written content and moves it to the final path in the cache."""
+        self._file.close()
+        if self.digest != self.layer:
+            self.discard()
+            raise DigestMismatchError(f"Digest mismatch for layer {self.layer}: content has digest {self.digest}")
+        layer_path = get_blobs_dir() / self.layer.replace(":", "_")
+        os.replace(self.partial_path, layer_path)
+        record_layer(self.layer, self.size, self.repository)
         return layer_path
-    return None
 
+    def discard(self):
+        """Closes the writer and removes the partial file, so that it is not resumed."""
+        self._file.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
 
-def save_layer(layer: str, layer_data: bytes):
-    cache_dir = get_config_dir() / "blobs/"
-    os.makedirs(cache_dir, exist_ok=True)
-    layer_path = cache_dir / layer.replace(":", "_")
-    with open(layer_path, mode="wb") as file:
-        file.write(layer_data)
+    def __enter__(self) -> "LayerWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the partial file is not removed, so that an interrupted download can be resumed later
+        self._file.close()
+
+
+def save_layer(layer: str, layer_data: bytes, repository: Optional[str] = None) -> pathlib.Path:
+    with LayerWriter(layer, repository) as writer:
+        writer.truncate()
+        writer.write(layer_data)
+        return writer.commit()
+
+
+# cache index
+#
+# Every blob in the cache has an entry in a sqlite database, with its size, when it was last used and which repositories
+# it came from. This allows evicting blobs to keep the cache under a maximum size, and showing statistics, without
+# having to list the blobs folder.
+
+CACHE_POLICIES = ("lru", "lfu")
+
+# layers used by an operation in progress in this process, which must not be evicted
+_pinned_layers: Dict[str, int] = {}
+# shared locks on the pinned layers, taken by hold_layer()
+_held_layers: Dict[str, BinaryIO] = {}
+
+
+@contextlib.contextmanager
+def pin_layers(layers: Iterable[str]) -> Iterator[None]:
+    """
+    Protects the given layers from eviction while the context is active, for example while writing an image. Once
+    the context exits, the cache size limit is enforced again, since it could not be enforced on the pinned layers.
+    Pinning only applies to this process. Use ``hold_layer()`` to also protect a pinned layer from other processes.
+    """
+    layers = list(layers)
+    for layer in layers:
+        _pinned_layers[layer] = _pinned_layers.get(layer, 0) + 1
+    try:
+        yield
+    finally:
+        for layer in layers:
+            _pinned_layers[layer] -= 1
+            if not _pinned_layers[layer]:
+                _pinned_layers.pop(layer)
+                _release_layer(layer)
+        enforce_cache_limit()
+
+
+@contextlib.contextmanager
+def _cache_index() -> Iterator[sqlite3.Connection]:
+    # sqlite takes care of locking, so that several processes can share the same cache
+    connection = sqlite3.connect(get_config_dir() / "cache.db", timeout=30)
+    try:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL, "
+            "access_count INTEGER NOT NULL DEFAULT 0, repositories TEXT NOT NULL DEFAULT '[]')"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)")
+        # compressed blob of each uncompressed layer, so that layers do not have to be compressed again to be pushed
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS compressed_layers ("
+            "diff_id TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL)"
+        )
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _add_repository(repositories: str, repository: Optional[str]) -> str:
+    repository_list = json.loads(repositories)
+    if repository and repository not in repository_list:
+        repository_list.append(repository)
+    return json.dumps(repository_list)
+
+
+@lru_cache
+def get_cache_settings() -> Tuple[Optional[int], str]:
+    """
+    Returns the maximum cache size in bytes (``None`` for unlimited) and the eviction policy. They are read from the
+    environment variables ``CRPY_CACHE_MAX_SIZE`` and ``CRPY_CACHE_POLICY`` or, if not set, from the ``cache`` entry of
+    the config file, for example ``{"cache": {"maxSize": "20G", "policy": "lru"}}``. They are only read once, since
+    they are needed each time a layer is cached.
+    """
+    cache_config = get_config().get("cache", {})
+    max_size = os.environ.get("CRPY_CACHE_MAX_SIZE", cache_config.get("maxSize"))
+    policy = os.environ.get("CRPY_CACHE_POLICY", cache_config.get("policy", "lru"))
+    return (parse_size(max_size) if max_size is not None else None), policy
+
+
+def record_layer(layer: str, size: int, repository: Optional[str] = None):
+    """Adds a newly cached layer to the cache index, then evicts old layers if the cache got over its maximum size."""
+    with _cache_index() as index:
+        row = index.execute("SELECT repositories FROM blobs WHERE digest = ?", (layer,)).fetchone()
+        repositories = _add_repository(row[0] if row else "[]", repository)
+        index.execute(
+            "INSERT OR REPLACE INTO blobs (digest, size, last_access, access_count, repositories) "
+            "VALUES (?, ?, ?, 1, ?)",
+            (layer, size, time.time(), repositories),
+        )
+    enforce_cache_limit(keep=(layer,))
+
+
+def enforce_cache_limit(keep: Tuple[str, ...] = ()):
+    """Evicts layers according to the configured maximum size and policy, if any."""
+    max_size, policy = get_cache_settings()
+    if max_size is not None:
+        evict_layers(max_size, policy, keep=keep)
+
+
+def touch_layer(layer: str, repository: Optional[str] = None):
+    """Marks a layer as used, so that it is the last one to be evicted."""
+    with _cache_index() as index:
+        row = index.execute("SELECT repositories FROM blobs WHERE digest = ?", (layer,)).fetchone()
+        if row is None:
+            # blobs cached before the index existed are added on their first use
+            layer_path = get_layer_path(layer)
+            if layer_path is not None:
+                index.execute(
+                    "INSERT INTO blobs (digest, size, last_access, access_count, repositories) VALUES (?, ?, ?, 1, ?)",
+                    (layer, layer_path.stat().st_size, time.time(), _add_repository("[]", repository)),
+                )
+            return
+        index.execute(
+            "UPDATE blobs SET last_access = ?, access_count = access_count + 1, repositories = ? WHERE digest = ?",
+            (time.time(), _add_repository(row[0], repository), layer),
+        )
+
+
+def record_compressed_layer(diff_id: str, digest: str, size: int):
+    """Remembers the compressed blob of an uncompressed layer, pulled from a registry or compressed to push it."""
+    with _cache_index() as index:
+        index.execute(
+            "INSERT OR REPLACE INTO compressed_layers (diff_id, digest, size) VALUES (?, ?, ?)", (diff_id, digest, size)
+        )
+
+
+def get_compressed_layer(diff_id: str) -> Optional[Tuple[str, int]]:
+    """Returns the digest and size of the compressed blob of an uncompressed layer, if known."""
+    with _cache_index() as index:
+        row = index.execute("SELECT digest, size FROM compressed_layers WHERE diff_id = ?", (diff_id,)).fetchone()
+    return tuple(row) if row else None
+
+
+def evict_layers(max_size: int, policy: str = "lru", keep: Tuple[str, ...] = ()) -> List[Tuple[str, int]]:
+    """
+    Removes layers from the cache until its total size is under ``max_size``. Layers are removed either by least
+    recently used (``lru``) or least frequently used (``lfu``). Only the index is read to pick the layers to remove.
+
+    :param max_size: maximum size of the cache, in bytes.
+    :param policy: eviction policy, either ``lru`` or ``lfu``.
+    :param keep: layers that should not be removed, in addition to the ones pinned with ``pin_layers()``.
+    :return: list of removed layers and their sizes.
+
+    Layers locked by any process, because they are being downloaded or read (see ``hold_layer()``), are skipped.
+    """
+    if policy not in CACHE_POLICIES:
+        raise ValueError(f"Unknown cache policy '{policy}'. Choose one from {CACHE_POLICIES}")
+    order = "last_access" if policy == "lru" else "access_count, last_access"
+    evicted = []
+    with _cache_index() as index:
+        total = index.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= max_size:
+            return evicted
+        # sqlite allows deleting the current row while the query is stepped through, so the index is not loaded at once
+        for digest, size in index.execute(f"SELECT digest, size FROM blobs ORDER BY {order}"):
+            if total <= max_size:
+                break
+            if digest in keep or digest in _pinned_layers:
+                continue
+            lock_path = _lock_path(digest)
+            lock_file = _try_lock(lock_path, fcntl.LOCK_EX) if fcntl is not None else contextlib.nullcontext()
+            if lock_file is None:
+                continue
+            with lock_file:
+                layer_path = get_blobs_dir() / digest.replace(":", "_")
+                if layer_path.is_file():
+                    layer_path.unlink()
+                index.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                if fcntl is not None:
+                    lock_path.unlink(missing_ok=True)
+            total -= size
+            evicted.append((digest, size))
+    return evicted
+
+
+def cache_stats() -> dict:
+    """Returns statistics about the cache, read from the cache index."""
+    max_size, policy = get_cache_settings()
+    with _cache_index() as index:
+        count, total, oldest, newest = index.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_access), MAX(last_access) FROM blobs"
+        ).fetchone()
+        repositories = {}
+        for (entry,) in index.execute("SELECT repositories FROM blobs"):
+            for repository in json.loads(entry):
+                repositories[repository] = repositories.get(repository, 0) + 1
+    return {
+        "path": str(get_blobs_dir()),
+        "blobs": count,
+        "size": total,
+        "max_size": max_size,
+        "policy": policy,
+        "oldest_access": oldest,
+        "newest_access": newest,
+        "repositories": repositories,
+    }
+
+
+def gc_cache() -> dict:
+    """
+    Brings the cache index and the blobs folder back in sync: entries whose file is missing are dropped, blob files
+    missing from the index are added, and leftover partial downloads are removed (unless their download is still
+    running), as well as the lock files that no process holds. Unlike the other cache operations, this lists the whole
+    blobs folder.
+
+    :return: dictionary with the number of entries dropped and added, and the partial and lock files removed.
+    """
+    blobs_dir = get_blobs_dir()
+    files = {}
+    removed_partials = removed_locks = 0
+    for path in blobs_dir.iterdir():
+        if path.suffix == ".partial":
+            # partial files of downloads currently running in other processes are left alone
+            if not _is_locked(_lock_path(path.stem.replace("_", ":", 1))):
+                path.unlink()
+                removed_partials += 1
+        elif path.suffix == ".lock":
+            # older versions kept the lock files next to the blobs
+            removed_locks += _remove_lock_file(path)
+        elif path.is_file() and path.suffix == "" and "_" in path.name:
+            files[path.name.replace("_", ":", 1)] = path
+    with _cache_index() as index:
+        indexed = {digest for (digest,) in index.execute("SELECT digest FROM blobs")}
+        dropped = indexed - set(files)
+        index.executemany("DELETE FROM blobs WHERE digest = ?", [(digest,) for digest in dropped])
+        added = set(files) - indexed
+        for digest in added:
+            stat = files[digest].stat()
+            index.execute(
+                "INSERT INTO blobs (digest, size, last_access, access_count) VALUES (?, ?, ?, 0)",
+                (digest, stat.st_size, stat.st_mtime),
+            )
+    for path in get_locks_dir().iterdir():
+        removed_locks += _remove_lock_file(path)
+    return {"dropped": len(dropped), "added": len(added), "partials": removed_partials, "locks": removed_locks}
+
+
+def get_manifests_dir() -> pathlib.Path:
+    manifests_dir = get_config_dir() / "manifests/"
+    os.makedirs(manifests_dir, exist_ok=True)
+    return manifests_dir
+
+
+def _manifest_path(registry: str, repository: str, reference: str, fat: bool) -> pathlib.Path:
+    # manifests referenced by digest are immutable and are the same regardless of the accepted media types
+    if reference.startswith("sha256:"):
+        key = f"{registry}/{repository}@{reference}"
+    else:
+        key = f"{registry}/{repository}:{reference}:{'fat' if fat else 'thin'}"
+    return get_manifests_dir() / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+
+def load_manifest(registry: str, repository: str, reference: str, fat: bool = False) -> Optional[Tuple[bytes, dict]]:
+    """
+    Returns the raw data and response headers of a manifest stored with ``save_manifest()``, or None if it is not
+    cached. Manifests referenced by digest are checked against the digest, so they can be used without asking the
+    registry.
+    """
+    manifest_path = _manifest_path(registry, repository, reference, fat)
+    try:
+        entry = json.loads(manifest_path.read_text())
+        data = base64.b64decode(entry["data"])
+    except (OSError, ValueError, KeyError):
+        return None
+    if reference.startswith("sha256:") and f"sha256:{hashlib.sha256(data).hexdigest()}" != reference:
+        manifest_path.unlink(missing_ok=True)
+        return None
+    return data, entry["headers"]
+
+
+def save_manifest(registry: str, repository: str, reference: str, fat: bool, data: bytes, headers: dict):
+    """Stores a manifest and the headers needed to revalidate it (``ETag`` and ``Docker-Content-Digest``)."""
+    manifest_path = _manifest_path(registry, repository, reference, fat)
+    kept_headers = ("content-type", "docker-content-digest", "etag")
+    entry = {
+        "reference": f"{registry}/{repository}:{reference}",
+        "headers": {k: v for k, v in (headers or {}).items() if k.lower() in kept_headers},
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+    # write to a temporary file first, so that other processes never read a half written manifest
+    tmp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(entry))
+    os.replace(tmp_path, manifest_path)
 
 
 def get_layer_from_cache(layer: str) -> Optional[bytes]:
@@ -0,0 +1,24 @@
+import pytest
+import pytest_asyncio
+
+from crpy import storage
+from tests.fake_registry import FakeRegistry
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "crpy"
+    cache_dir.mkdir()
+    monkeypatch.setattr(storage, "get_config_dir", lambda: cache_dir)
+    # the config of another cache folder could still be cached
+    storage.get_config.cache_clear()
+    storage.get_cache_settings.cache_clear()
+    yield cache_dir
+    storage.get_config.cache_clear()
+    storage.get_cache_settings.cache_clear()
+
+
+@pytest_asyncio.fixture
+async def registry(cache_dir):
+    async with FakeRegistry() as fake_registry:
+        yield fake_registry
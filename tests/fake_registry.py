@@ -0,0 +1,481 @@
+"""
+In-process stand-in for a docker registry v2 API, built on ``aiohttp.web``. It implements the token, manifest, blob,
+upload and catalog endpoints, so that pulls and pushes can be tested (and benchmarked) without network access:
+
+>>> async with FakeRegistry() as registry:
+...     registry.add_image("library/alpine", "latest", n_layers=3)
+...     ri = RegistryInfo.from_url(f"http://{registry.url}/library/alpine:latest")
+
+Latency, bandwidth and failures can be injected with ``FakeRegistryConfig``, and every request is counted in
+``FakeRegistry.requests``.
+"""
+
+import asyncio
+import collections
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import struct
+import tarfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+
+def sha256_digest(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def make_layer(files: Dict[str, bytes], links: Optional[Dict[str, str]] = None) -> bytes:
+    """Creates an uncompressed layer tar-file with the given files, and symbolic links from ``links`` to targets."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        _add_members(tar, files, links)
+    return buffer.getvalue()
+
+
+def make_estargz_layer(
+    files: Dict[str, bytes], links: Optional[Dict[str, str]] = None, chunk_size: Optional[int] = None
+) -> bytes:
+    """
+    Creates an eStargz layer: a gzipped tar-file where the content of each file (split into chunks of ``chunk_size``)
+    starts a new gzip member, followed by the table of contents and the footer pointing to it.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        members = _add_members(tar, files, links)
+        end = tar.offset
+    # the tar-file ends with the table of contents, so the end-of-archive blocks are dropped
+    raw = buffer.getvalue()[:end]
+    entries, splits = [], {}
+    for member in members:
+        entry = {"name": member.name, "type": "symlink" if member.issym() else "reg", "size": member.size}
+        if member.issym():
+            entry["linkName"] = member.linkname
+        else:
+            entry["digest"] = sha256_digest(raw[member.offset_data : member.offset_data + member.size])
+        entries.append(entry)
+        step = chunk_size or max(member.size, 1)
+        for chunk_offset in range(0, member.size, step):
+            chunk = entry if chunk_offset == 0 else {"name": member.name, "type": "chunk"}
+            if chunk_size:
+                chunk.update(chunkOffset=chunk_offset, chunkSize=min(step, member.size - chunk_offset))
+            if chunk is not entry:
+                entries.append(chunk)
+            splits[member.offset_data + chunk_offset] = chunk
+    blob, start = b"", 0
+    for split in sorted(splits):
+        blob += gzip.compress(raw[start:split], mtime=0) if split > start else b""
+        splits[split]["offset"], start = len(blob), split
+    blob += gzip.compress(raw[start:], mtime=0)
+    toc = json.dumps({"version": 1, "entries": entries}).encode()
+    toc_offset = len(blob)
+    blob += gzip.compress(make_layer({"stargz.index.json": toc}), mtime=0)
+    footer = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack("<H", 26) + b"SG" + struct.pack("<H", 22)
+    return blob + footer + b"%016xSTARGZ" % toc_offset + b"\x01\x00\x00\xff\xff" + bytes(8)
+
+
+def _add_members(
+    tar: tarfile.TarFile, files: Dict[str, bytes], links: Optional[Dict[str, str]]
+) -> List[tarfile.TarInfo]:
+    members = []
+    for name, content in files.items():
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+        # addfile() does not record where the content is, it is right before its padding to the block size
+        info.offset_data = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        members.append(info)
+    for name, target in (links or {}).items():
+        info = tarfile.TarInfo(name)
+        info.type, info.linkname = tarfile.SYMTYPE, target
+        tar.addfile(info)
+        members.append(info)
+    return members
+
+
+@dataclass
+class FakeRegistryConfig:
+    """
+    :param latency: delay in seconds added to every request.
+    :param bandwidth: bytes per second at which blobs are sent. ``None`` means unlimited.
+    :param failure_rate: probability of a request failing with ``503 Service Unavailable``.
+    :param fail_after_bytes: breaks the connection of the next blob download after this many bytes (only once).
+    :param drop_upload_commit: breaks the connection of the next upload after the blob was committed, before the
+        client receives the response (only once).
+    :param stall_first_download: delay in seconds before answering the first download of each blob, like a slow
+        replica would.
+    :param require_auth: if requests without a bearer token are rejected with a ``401`` challenge.
+    :param redirect_blobs: if blob downloads are redirected to a fake CDN with signed, expiring urls. The CDN listens
+        on a port of its own, so that it is a different origin than the registry.
+    :param relocate_blobs: if blob downloads are redirected to another url of the registry itself, which still
+        requires the token.
+    :param page_size: default number of entries in each page of the catalog and tag listings.
+    :param token_expires_in: lifetime in seconds of the issued tokens.
+    :param seed: seed for the random failure injection.
+    """
+
+    latency: float = 0.0
+    bandwidth: Optional[int] = None
+    failure_rate: float = 0.0
+    fail_after_bytes: Optional[int] = None
+    drop_upload_commit: bool = False
+    stall_first_download: float = 0.0
+    require_auth: bool = True
+    redirect_blobs: bool = False
+    relocate_blobs: bool = False
+    page_size: int = 100
+    token_expires_in: int = 300
+    seed: int = 0
+
+
+@dataclass
+class FakeRegistry:
+    config: FakeRegistryConfig = field(default_factory=FakeRegistryConfig)
+    blobs: Dict[str, bytes] = field(default_factory=dict)
+    manifests: Dict[str, Dict[str, bytes]] = field(default_factory=lambda: collections.defaultdict(dict))
+    manifest_types: Dict[str, str] = field(default_factory=dict)
+    uploads: Dict[str, bytearray] = field(default_factory=dict)
+    requests: collections.Counter = field(default_factory=collections.Counter)
+    bytes_out: int = 0
+    bytes_in: int = 0
+
+    def __post_init__(self):
+        self._random = random.Random(self.config.seed)
+        self._downloaded = set()
+        self._runner = None
+        self.url = None
+        self.cdn_url = None
+
+    # helpers to populate the registry
+    def add_blob(self, data: bytes) -> str:
+        digest = sha256_digest(data)
+        self.blobs[digest] = data
+        return digest
+
+    def add_manifest(self, repository: str, tag: Optional[str], manifest: dict, media_type: str = None) -> str:
+        data = json.dumps(manifest).encode()
+        digest = sha256_digest(data)
+        self.manifests[repository][digest] = data
+        if tag:
+            self.manifests[repository][tag] = data
+        self.manifest_types[digest] = media_type or manifest.get("mediaType")
+        return digest
+
+    def add_image(
+        self,
+        repository: str,
+        tag: Optional[str],
+        n_layers: int = 3,
+        layer_size: int = 1024,
+        platform: Optional[dict] = None,
+        seed: int = 0,
+        blobs: Optional[List[bytes]] = None,
+    ) -> str:
+        """
+        Adds a synthetic image with ``n_layers`` gzipped layers of random content, each around ``layer_size`` bytes.
+        The layers can also be given as gzipped ``blobs``, like the ones from ``make_estargz_layer()``.
+
+        :return: digest of the manifest.
+        """
+        if blobs is None:
+            blobs = [
+                make_layer({f"layer{i}/file.bin": os.urandom(layer_size), f"etc/file{i}": f"{i} {seed}\n".encode()})
+                for i in range(n_layers)
+            ]
+            blobs = [gzip.compress(raw, mtime=0) for raw in blobs]
+        diff_ids, layers = [], []
+        for compressed in blobs:
+            diff_ids.append(sha256_digest(gzip.decompress(compressed)))
+            layers.append(
+                {
+                    "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                    "size": len(compressed),
+                    "digest": self.add_blob(compressed),
+                }
+            )
+        config = {
+            **(platform or {"os": "linux", "architecture": "amd64"}),
+            "config": {"Cmd": ["/bin/sh"]},
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+            "history": [{"created_by": f"step {i}"} for i in range(len(blobs))],
+        }
+        config_data = json.dumps(config).encode()
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+            "config": {
+                "mediaType": "application/vnd.docker.container.image.v1+json",
+                "size": len(config_data),
+                "digest": self.add_blob(config_data),
+            },
+            "layers": layers,
+        }
+        return self.add_manifest(repository, tag, manifest)
+
+    def add_multiarch(self, repository: str, tag: str, platforms: List[str], **kwargs) -> str:
+        """
+        Adds a multi-platform image, with one synthetic image for each platform (like ``linux/arm64/v8``).
+
+        :return: digest of the manifest list.
+        """
+        entries = []
+        for i, platform in enumerate(platforms):
+            parts = platform.split("/")
+            platform_dict = {"os": parts[0], "architecture": parts[1]}
+            if len(parts) > 2:
+                platform_dict["variant"] = parts[2]
+            digest = self.add_image(repository, None, platform=platform_dict, seed=i, **kwargs)
+            entries.append(
+                {
+                    "mediaType": self.manifest_types[digest],
+                    "size": len(self.manifests[repository][digest]),
+                    "digest": digest,
+                    "platform": platform_dict,
+                }
+            )
+        index = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.docker.distribution.manifest.list.v2+json",
+            "manifests": entries,
+        }
+        return self.add_manifest(repository, tag, index)
+
+    # lifecycle
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(middlewares=[self._middleware], client_max_size=1024**4)
+        app.router.add_get("/token", self._token)
+        app.router.add_get("/v2/", self._base)
+        app.router.add_get("/v2/_catalog", self._catalog)
+        app.router.add_get("/cdn/{digest}", self._cdn)
+        app.router.add_route("*", r"/v2/{name:.+}/tags/list", self._tags)
+        app.router.add_route("*", r"/v2/{name:.+}/manifests/{reference}", self._manifest)
+        app.router.add_post(r"/v2/{name:.+}/blobs/uploads/", self._upload_start)
+        app.router.add_route("*", r"/v2/{name:.+}/blobs/uploads/{uuid}", self._upload)
+        app.router.add_route("*", r"/v2/{name:.+}/blobs/{digest}", self._blob)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        cdn_site = web.TCPSite(self._runner, host, 0)
+        await cdn_site.start()
+        port, cdn_port = (address[1] for address in self._runner.addresses)
+        self.url = f"{host}:{port}"
+        self.cdn_url = f"{host}:{cdn_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    # internals
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        endpoint = re.sub(r"/v2/.+?/(manifests|blobs|tags)/.*|/(cdn)/.*", r"\1\2", request.path)
+        self.requests[(request.method, endpoint)] += 1
+        if self.config.latency:
+            await asyncio.sleep(self.config.latency)
+        if self.config.failure_rate and self._random.random() < self.config.failure_rate:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        if self.config.require_auth and request.path.startswith("/v2/"):
+            auth = request.headers.get("Authorization", "")
+            if not auth.startswith("Bearer fake-token"):
+                name = re.match(r"/v2/(.+?)/(manifests|blobs|tags)", request.path)
+                scope = f',scope="repository:{name.group(1)}:pull,push"' if name else ""
+                realm = f"http://{self.url}/token"
+                return web.Response(
+                    status=401,
+                    headers={"WWW-Authenticate": f'Bearer realm="{realm}",service="fake"{scope}'},
+                )
+        return await handler(request)
+
+    async def _token(self, request: web.Request):
+        return web.json_response(
+            {"token": f"fake-token-{uuid.uuid4().hex}", "expires_in": self.config.token_expires_in}
+        )
+
+    async def _base(self, request: web.Request):
+        return web.json_response({})
+
+    def _paginate(self, request: web.Request, entries: List[str], key: str, extra: dict):
+        n = int(request.query.get("n", self.config.page_size))
+        last = request.query.get("last")
+        entries = sorted(entries)
+        if last is not None:
+            entries = [e for e in entries if e > last]
+        page = entries[:n]
+        headers = {}
+        if len(entries) > n:
+            headers["Link"] = f'<{request.path}?last={page[-1]}&n={n}>; rel="next"'
+        return web.json_response({**extra, key: page}, headers=headers)
+
+    async def _catalog(self, request: web.Request):
+        return self._paginate(request, list(self.manifests), "repositories", {})
+
+    async def _tags(self, request: web.Request):
+        name = request.match_info["name"]
+        tags = [t for t in self.manifests.get(name, {}) if not t.startswith("sha256:")]
+        return self._paginate(request, tags, "tags", {"name": name})
+
+    async def _manifest(self, request: web.Request):
+        name, reference = request.match_info["name"], request.match_info["reference"]
+        if request.method == "PUT":
+            data = await request.read()
+            self.bytes_in += len(data)
+            digest = sha256_digest(data)
+            self.manifests[name][digest] = data
+            if not reference.startswith("sha256:"):
+                self.manifests[name][reference] = data
+            self.manifest_types[digest] = request.headers.get("Content-Type")
+            return web.Response(status=201, headers={"Docker-Content-Digest": digest})
+        data = self.manifests.get(name, {}).get(reference)
+        if data is None:
+            return web.json_response({"errors": [{"code": "MANIFEST_UNKNOWN"}]}, status=404)
+        digest = sha256_digest(data)
+        if request.method == "DELETE":
+            for key in [k for k, v in self.manifests[name].items() if v == data]:
+                self.manifests[name].pop(key)
+            return web.Response(status=202)
+        headers = {
+            "Docker-Content-Digest": digest,
+            "ETag": f'"{digest}"',
+            "Content-Type": self.manifest_types.get(digest) or "application/json",
+        }
+        if request.headers.get("If-None-Match", "").strip('"') == digest:
+            return web.Response(status=304, headers=headers)
+        if request.method == "HEAD":
+            return web.Response(status=200, headers={**headers, "Content-Length": str(len(data))})
+        self.bytes_out += len(data)
+        return web.Response(body=data, headers=headers)
+
+    async def _send_blob(self, request: web.Request, data: bytes):
+        start = 0
+        total = len(data)
+        status = 200
+        headers = {"Content-Type": "application/octet-stream", "Docker-Content-Digest": sha256_digest(data)}
+        range_header = request.headers.get("Range")
+        if range_header:
+            match = re.match(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            if start >= len(data):
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+            data = data[start : end + 1]
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{start + len(data) - 1}/{total}"
+        if request.method == "HEAD":
+            return web.Response(status=200, headers={**headers, "Content-Length": str(len(data))})
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(data)
+        await response.prepare(request)
+        chunk_size = 64 * 1024
+        sent = 0
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset : offset + chunk_size]
+            fail_after = self.config.fail_after_bytes
+            if fail_after is not None and sent + len(chunk) > fail_after:
+                # simulates a broken connection: only one failure is injected
+                self.config.fail_after_bytes = None
+                await response.write(chunk[: fail_after - sent])
+                request.transport.close()
+                return response
+            await response.write(chunk)
+            sent += len(chunk)
+            self.bytes_out += len(chunk)
+            if self.config.bandwidth:
+                await asyncio.sleep(len(chunk) / self.config.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def _blob(self, request: web.Request):
+        digest = request.match_info["digest"]
+        if digest not in self.blobs:
+            return web.json_response({"errors": [{"code": "BLOB_UNKNOWN"}]}, status=404)
+        if request.method == "DELETE":
+            self.blobs.pop(digest)
+            return web.Response(status=202)
+        if self.config.stall_first_download and request.method == "GET" and digest not in self._downloaded:
+            self._downloaded.add(digest)
+            await asyncio.sleep(self.config.stall_first_download)
+        if self.config.redirect_blobs and request.method == "GET":
+            expires = int(time.time()) + 60
+            location = f"http://{self.cdn_url}/cdn/{digest}?Expires={expires}&Signature=fake"
+            return web.Response(status=307, headers={"Location": location})
+        if self.config.relocate_blobs and request.method == "GET" and "relocated" not in request.query:
+            return web.Response(status=307, headers={"Location": f"{request.path}?relocated=1"})
+        return await self._send_blob(request, self.blobs[digest])
+
+    async def _cdn(self, request: web.Request):
+        if "Authorization" in request.headers:
+            return web.Response(status=400, text="Authorization header must not be sent to the CDN")
+        if int(request.query.get("Expires", 0)) < time.time():
+            return web.Response(status=403, text="Signature expired")
+        digest = request.match_info["digest"]
+        if digest not in self.blobs:
+            return web.Response(status=404)
+        return await self._send_blob(request, self.blobs[digest])
+
+    async def _upload_start(self, request: web.Request):
+        name = request.match_info["name"]
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = bytearray()
+        digest = request.query.get("digest")
+        if digest:
+            data = await request.read()
+            self.bytes_in += len(data)
+            if sha256_digest(data) != digest:
+                return web.json_response({"errors": [{"code": "DIGEST_INVALID"}]}, status=400)
+            self.blobs[digest] = data
+            return web.Response(status=201, headers={"Docker-Content-Digest": digest})
+        location = f"/v2/{name}/blobs/uploads/{upload_id}"
+        return web.Response(status=202, headers={"Location": location, "Range": "0-0", "Docker-Upload-UUID": upload_id})
+
+    async def _upload(self, request: web.Request):
+        name, upload_id = request.match_info["name"], request.match_info["uuid"]
+        if upload_id not in self.uploads:
+            return web.json_response({"errors": [{"code": "BLOB_UPLOAD_UNKNOWN"}]}, status=404)
+        buffer = self.uploads[upload_id]
+        location = f"/v2/{name}/blobs/uploads/{upload_id}"
+        if request.method == "GET":
+            return web.Response(status=204, headers={"Location": location, "Range": f"0-{max(len(buffer) - 1, 0)}"})
+        data = await request.read()
+        self.bytes_in += len(data)
+        if request.method == "PATCH":
+            content_range = request.headers.get("Content-Range")
+            if content_range:
+                start = int(content_range.split("-")[0])
+                if start != len(buffer):
+                    return web.Response(status=416, headers={"Location": location, "Range": f"0-{len(buffer) - 1}"})
+            buffer.extend(data)
+            return web.Response(status=202, headers={"Location": location, "Range": f"0-{len(buffer) - 1}"})
+        if request.method == "PUT":
+            buffer.extend(data)
+            digest = request.query.get("digest")
+            if sha256_digest(bytes(buffer)) != digest:
+                return web.json_response({"errors": [{"code": "DIGEST_INVALID"}]}, status=400)
+            self.blobs[digest] = bytes(buffer)
+            self.uploads.pop(upload_id)
+            if self.config.drop_upload_commit:
+                self.config.drop_upload_commit = False
+                request.transport.close()
+            return web.Response(
+                status=201, headers={"Docker-Content-Digest": digest, "Location": f"/v2/{name}/blobs/{digest}"}
+            )
+        if request.method == "DELETE":
+            self.uploads.pop(upload_id)
+            return web.Response(status=204)
+        return web.Response(status=405)
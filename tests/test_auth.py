@@ -1,6 +1,10 @@
+import time
+
 import pytest
 
+from crpy.auth import Token, TokenCache, get_token
 from crpy.registry import RegistryInfo
+from tests.fake_registry import FakeRegistry
 
 
 @pytest.mark.asyncio
@@ -8,3 +12,36 @@ async def test_auth():
     registry = RegistryInfo.from_url("alpine")
     token = await registry.auth()
     assert isinstance(token, str)
+
+
+def test_token_cache(tmp_path):
+    www_auth = 'Bearer realm="https://auth.docker.io/token",service="registry.docker.io",scope="repository:library/alpine:pull"'
+    cache = TokenCache(tmp_path / "tokens.json")
+    token = Token("abc", "https://auth.docker.io/token", "registry.docker.io", "repository:library/alpine:pull")
+    token.expires_at = time.time() + 300
+    token.registry = "index.docker.io"
+    cache.add(token)
+    assert cache.get(www_auth).token == "abc"
+    assert cache.get(www_auth, identity="someone-else") is None
+    assert cache.find("index.docker.io", "library/alpine").token == "abc"
+    assert cache.find("index.docker.io", "library/nginx") is None
+    assert token.www_authenticate == www_auth
+    # tokens are loaded back from disk
+    assert TokenCache(tmp_path / "tokens.json").get(www_auth).token == "abc"
+    # tokens about to expire are not returned
+    token.expires_at = time.time() + 10
+    assert cache.get(www_auth) is None
+    cache.invalidate("abc")
+    assert cache.lookup("abc") is None
+
+
+@pytest.mark.asyncio
+async def test_get_token():
+    async with FakeRegistry() as registry:
+        url = f"http://{registry.url}/token?service=fake&scope=repository:library/alpine:pull"
+        cache = TokenCache()
+        token = await get_token(url, token_cache=cache)
+        assert token.startswith("fake-token")
+        # the cached token is returned, without asking the token server again
+        assert await get_token(url, token_cache=cache) == token
+        assert registry.requests[("GET", "/token")] == 1
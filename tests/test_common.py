@@ -1,4 +1,8 @@
-from crpy.common import Platform
+import asyncio
+
+import pytest
+
+from crpy.common import HTTPClient, Platform
 
 
 def test_platform_properties():
@@ -9,3 +13,25 @@ def test_platform_properties():
 
     p_mac = Platform.from_dict({"architecture": "arm64", "os": "linux", "variant": "v8"})
     assert p_mac.variant == "v8"
+
+
+@pytest.mark.asyncio
+async def test_http_client_reuses_session():
+    async with HTTPClient(limit_per_host=2) as client:
+        session = client.session
+        assert client.session is session
+        assert session.connector.limit_per_host == 2
+    assert session.closed
+    # a closed client can still be used, it lazily opens a new session
+    assert client.session is not session
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_http_client_closes_session_when_collected():
+    client = HTTPClient()
+    session = client.session
+    del client
+    # the session is closed by a task of the running loop, without an "Unclosed client session" warning
+    await asyncio.sleep(0)
+    assert session.closed
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import io
+import os
+
+import pytest
+
+from crpy import storage
+from crpy.common import DigestMismatchError
+from crpy.compression import (
+    DecompressionError,
+    LayerDecompressor,
+    LayerTarReader,
+    ParallelCompressor,
+)
+from tests.fake_registry import make_estargz_layer
+
+
+async def _compress(data: bytes, **kwargs) -> bytes:
+    return b"".join([chunk async for chunk in ParallelCompressor(**kwargs).compress(io.BytesIO(data))])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [0, 1, 1000 * 1000])
+async def test_parallel_compressor(size):
+    data = (b"layer content " * size)[:size] + os.urandom(size // 10)
+    compressor = ParallelCompressor(block_size=64 * 1024, workers=4)
+    compressed = b"".join([chunk async for chunk in compressor.compress(io.BytesIO(data))])
+    assert gzip.decompress(compressed) == data
+    assert compressor.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    # the output does not depend on the number of threads, so the digest of a layer is always the same
+    assert await _compress(data, block_size=64 * 1024, workers=1) == compressed
+
+
+@pytest.mark.asyncio
+async def test_layer_decompressor(cache_dir):
+    data = os.urandom(300 * 1024)
+    compressed = gzip.compress(data[:1000]) + gzip.compress(data[1000:])
+    diff_id = f"sha256:{hashlib.sha256(data).hexdigest()}"
+    async with LayerDecompressor(diff_id, max_pending=2) as decompressor:
+        # the beginning of a download that started over
+        await decompressor.feed(compressed[:5000])
+        await decompressor.restart()
+        for i in range(0, len(compressed), 4096):
+            await decompressor.feed(compressed[i : i + 4096])
+        layer_path = await decompressor.finish()
+    assert layer_path.read_bytes() == data
+    assert storage.get_layer_path(diff_id) == layer_path
+
+    with pytest.raises(DigestMismatchError):
+        async with LayerDecompressor(f"sha256:{'0' * 64}") as decompressor:
+            await decompressor.feed(compressed)
+            await decompressor.finish()
+
+
+@pytest.mark.asyncio
+async def test_layer_tar_reader():
+    files = {f"file{i}": os.urandom(64 * 1024) for i in range(10)}
+    compressed = make_estargz_layer(files, chunk_size=16 * 1024)
+    seen = {}
+
+    def on_member(member, f):
+        seen[member.name] = f.read()
+        return member.name == "file2"
+
+    fed = 0
+    async with LayerTarReader(on_member, max_pending=2) as reader:
+        for i in range(0, len(compressed), 4096):
+            await reader.feed(compressed[i : i + 4096])
+            fed += 4096
+            if reader.done:
+                break
+        await reader.finish()
+    # the members of the tar-file span several gzip members, and the reading stopped after the third file
+    assert seen == {name: files[name] for name in ("file0", "file1", "file2")}
+    assert fed < len(compressed) / 2
+
+    with pytest.raises(DecompressionError):
+        async with LayerTarReader(on_member) as reader:
+            await reader.feed(gzip.compress(b"not a tar-file" * 100))
+            await reader.finish()
@@ -0,0 +1,87 @@
+import io
+import json
+import os
+import tarfile
+
+from crpy.common import compute_sha256
+from crpy.image import Image, images_to_disk
+
+
+def test_image_to_disk(tmp_path):
+    layer_file = tmp_path / "layer"
+    layer_file.write_bytes(b"layer from disk")
+    layers = [layer_file, b"layer in memory", layer_file]
+    config = {"architecture": "amd64", "os": "linux"}
+    config_digest = compute_sha256(json.dumps(config).encode())
+    image = Image(config=config, manifest={"config": {"digest": config_digest}}, layers=layers)
+
+    cwd = os.getcwd()
+    output = io.BytesIO()
+    image.to_disk(output, tags=["alpine:latest"])
+    assert os.getcwd() == cwd
+
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tf:
+        manifest = json.load(tf.extractfile("./manifest.json"))
+        assert manifest[0]["RepoTags"] == ["alpine:latest"]
+        assert manifest[0]["Config"] == f"{config_digest.split(':')[1]}.json"
+        assert json.load(tf.extractfile(f"./{manifest[0]['Config']}")) == config
+        assert len(manifest[0]["Layers"]) == 3
+        for layer_path, layer in zip(manifest[0]["Layers"], layers):
+            expected = layer.read_bytes() if not isinstance(layer, bytes) else layer
+            assert tf.extractfile(f"./{layer_path}").read() == expected
+        # the repeated layer is only stored once
+        assert len([name for name in tf.getnames() if name.endswith("layer.tar")]) == 2
+
+
+def test_images_to_disk_shares_layers():
+    images = []
+    for arch in ("amd64", "arm64"):
+        config = {"architecture": arch, "os": "linux"}
+        config_digest = compute_sha256(json.dumps(config).encode())
+        layers = [b"shared base layer", f"layer for {arch}".encode()]
+        image = Image(config=config, manifest={"config": {"digest": config_digest}}, layers=layers)
+        images.append((image, [f"alpine:latest-linux-{arch}"]))
+
+    output = io.BytesIO()
+    images_to_disk(output, images)
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tf:
+        manifest = json.load(tf.extractfile("./manifest.json"))
+        assert [entry["RepoTags"] for entry in manifest] == [
+            ["alpine:latest-linux-amd64"],
+            ["alpine:latest-linux-arm64"],
+        ]
+        assert manifest[0]["Layers"][0] == manifest[1]["Layers"][0]
+        assert json.load(tf.extractfile(f"./{manifest[1]['Config']}"))["architecture"] == "arm64"
+        assert len([name for name in tf.getnames() if name.endswith("layer.tar")]) == 3
+
+
+def test_image_to_oci_layout(tmp_path):
+    layer_file = tmp_path / "layer"
+    layer_file.write_bytes(b"layer from disk")
+    config = {"architecture": "amd64", "os": "linux"}
+    config_digest = compute_sha256(json.dumps(config).encode())
+    manifest = json.dumps(
+        {"mediaType": "application/vnd.oci.image.manifest.v1+json", "config": {"digest": config_digest}}
+    )
+    image = Image(config=config, manifest=manifest.encode(), layers=[layer_file])
+
+    image.to_oci_layout(tmp_path / "layout", tags=["localhost:5000/alpine:3.18"])
+    assert json.loads((tmp_path / "layout" / "oci-layout").read_text()) == {"imageLayoutVersion": "1.0.0"}
+    index = json.loads((tmp_path / "layout" / "index.json").read_text())
+    assert len(index["manifests"]) == 1
+    entry = index["manifests"][0]
+    assert entry["annotations"] == {"org.opencontainers.image.ref.name": "3.18"}
+    assert entry["platform"] == {"os": "linux", "architecture": "amd64"}
+    assert entry["digest"] == compute_sha256(manifest.encode())
+    blobs_dir = tmp_path / "layout" / "blobs" / "sha256"
+    assert (blobs_dir / entry["digest"].split(":")[1]).read_text() == manifest
+    # layers on disk are linked instead of copied
+    layer_blob = blobs_dir / compute_sha256(b"layer from disk", use_prefix=False)
+    assert layer_blob.read_bytes() == b"layer from disk"
+    assert layer_blob.stat().st_ino == layer_file.stat().st_ino
+
+    # writing the same tag again replaces the entry
+    image.to_oci_layout(tmp_path / "layout", tags=["localhost:5000/alpine:3.18"])
+    assert len(json.loads((tmp_path / "layout" / "index.json").read_text())["manifests"]) == 1
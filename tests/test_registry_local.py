@@ -0,0 +1,408 @@
+import gzip
+import io
+import json
+import os
+import tarfile
+import time
+from typing import Optional
+
+import pytest
+
+from crpy import registry as registry_module
+from crpy import storage
+from crpy.auth import Token, TokenCache
+from crpy.common import HTTPClient, compute_sha256
+from crpy.metrics import Metrics
+from crpy.progress import ProgressKind
+from crpy.registry import RegistryInfo, _media_type_layer
+from crpy.retry import RetryPolicy
+from tests.fake_registry import (
+    FakeRegistry,
+    FakeRegistryConfig,
+    make_estargz_layer,
+    make_layer,
+)
+
+
+def _registry_info(registry: FakeRegistry, image: str, client: Optional[HTTPClient] = None) -> RegistryInfo:
+    ri = RegistryInfo.from_url(f"http://{registry.url}/{image}", client=client)
+    # a separate token cache for each test, so that tokens from other registries are never reused
+    ri.token_cache = TokenCache()
+    return ri
+
+
+@pytest.mark.asyncio
+async def test_pull(registry):
+    registry.add_image("library/alpine", "latest", n_layers=3)
+    file = io.BytesIO()
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        await ri.pull(file)
+    file.seek(0)
+    with tarfile.open(fileobj=file) as tf:
+        image_manifest = json.load(tf.extractfile("./manifest.json"))
+        config = json.load(tf.extractfile(f"./{image_manifest[0]['Config']}"))
+        assert len(image_manifest[0]["Layers"]) == 3
+        # layers are stored uncompressed and named after their diff_id, like docker save does
+        for diff_id, layer_path in zip(config["rootfs"]["diff_ids"], image_manifest[0]["Layers"]):
+            assert layer_path == f"{diff_id.split(':')[1]}/layer.tar"
+            assert compute_sha256(tf.extractfile(f"./{layer_path}").read()) == diff_id
+    # a single token is requested, and each blob is downloaded once
+    assert registry.requests[("GET", "/token")] == 1
+    assert registry.requests[("GET", "blobs")] == 4
+
+
+@pytest.mark.asyncio
+async def test_pull_oci_to_file_object(registry):
+    registry.add_image("library/alpine", "latest")
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        with pytest.raises(ValueError, match="directory path"):
+            await ri.pull(io.BytesIO(), output_format="oci")
+    # the output is rejected before anything is downloaded
+    assert not registry.requests
+
+
+@pytest.mark.asyncio
+async def test_token_of_another_scope_stays_cached(registry):
+    registry.add_image("library/alpine", "latest")
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        # a pull token is attached up front, but the registry asks for a pull and push token
+        pull_token = Token("pull-token", f"http://{registry.url}/token", "fake", "repository:library/alpine:pull")
+        pull_token.expires_at = time.time() + 300
+        pull_token.registry = ri.registry
+        ri.token_cache.add(pull_token)
+        await ri.get_manifest()
+        assert ri.token.startswith("fake-token")
+        assert ri.token_cache.lookup("pull-token") is pull_token
+    assert registry.requests[("GET", "/token")] == 1
+
+
+@pytest.mark.asyncio
+async def test_pull_resumes_interrupted_download(registry):
+    registry.add_image("library/alpine", "latest", n_layers=1, layer_size=1024 * 1024)
+    registry.config.fail_after_bytes = 100 * 1024
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        layer = (await ri.get_layers())[0]
+        layer_path = await ri.download_layer(layer)
+    assert compute_sha256(layer_path) == layer
+    assert registry.config.fail_after_bytes is None
+
+
+@pytest.mark.asyncio
+async def test_push_round_trip(registry):
+    registry.add_image("library/alpine", "latest", n_layers=2, layer_size=256 * 1024)
+    file = io.BytesIO()
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        await ri.pull(file)
+        layers = await ri.get_layers()
+    file.seek(0)
+    async with FakeRegistry() as destination:
+        async with _registry_info(destination, "library/copy:v1") as ri:
+            # small chunks, so that the chunked upload is used
+            await ri.push(file, chunk_size=64 * 1024)
+            assert await ri.get_layers() == layers
+        assert destination.blobs == registry.blobs
+        assert destination.requests[("PATCH", "blobs")] > 2
+
+
+@pytest.mark.asyncio
+async def test_pull_decompresses_cached_layers(registry):
+    manifest_digest = registry.add_image("library/alpine", "latest", n_layers=2)
+    manifest = json.loads(registry.manifests["library/alpine"][manifest_digest])
+    compressed, uncompressed = io.BytesIO(), io.BytesIO()
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        await ri.pull(compressed, decompress=False)
+        await ri.pull(uncompressed)
+    # the second pull decompresses the layers from the cache, without downloading them again
+    assert registry.requests[("GET", "blobs")] == 3
+    compressed.seek(0)
+    uncompressed.seek(0)
+    with tarfile.open(fileobj=compressed) as tf:
+        layer_paths = json.load(tf.extractfile("./manifest.json"))[0]["Layers"]
+        assert layer_paths == [f"{layer['digest'].split(':')[1]}/layer.tar" for layer in manifest["layers"]]
+        layers = [gzip.decompress(tf.extractfile(f"./{layer_path}").read()) for layer_path in layer_paths]
+    with tarfile.open(fileobj=uncompressed) as tf:
+        layer_paths = json.load(tf.extractfile("./manifest.json"))[0]["Layers"]
+        assert [tf.extractfile(f"./{layer_path}").read() for layer_path in layer_paths] == layers
+
+
+@pytest.mark.asyncio
+async def test_push_compresses_layers(registry):
+    registry.add_image("library/alpine", "latest", n_layers=2, layer_size=256 * 1024)
+    file = io.BytesIO()
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        await ri.pull(file)
+        for layer in await ri.get_layers():
+            # without the pulled blobs, the uncompressed layers have to be compressed again
+            storage.remove_layer(layer)
+    async with FakeRegistry() as destination:
+        for _ in range(2):
+            file.seek(0)
+            async with _registry_info(destination, "library/copy:v1") as ri:
+                await ri.push(file, chunk_size=64 * 1024)
+                manifest = await ri.get_manifest_from_architecture()
+                config = (await ri.get_config()).json()
+        # the second push knows the compressed digests, so it does not upload anything
+        assert destination.requests[("POST", "blobs")] == 3
+    assert [layer["mediaType"] for layer in manifest["layers"]] == [_media_type_layer] * 2
+    for layer, diff_id in zip(manifest["layers"], config["rootfs"]["diff_ids"]):
+        assert compute_sha256(gzip.decompress(destination.blobs[layer["digest"]])) == diff_id
+        assert storage.get_compressed_layer(diff_id) == (layer["digest"], layer["size"])
+
+
+@pytest.mark.asyncio
+async def test_open_file_reads_estargz_ranges(registry):
+    big = os.urandom(1024 * 1024)
+    blobs = [
+        make_estargz_layer({"usr/lib/big": big, "etc/os-release": b"ID=fake\n", "gone": b"x"}, chunk_size=64 * 1024),
+        make_estargz_layer({".wh.gone": b"", "usr/lib/small": b"small"}, links={"lib": "usr/lib"}),
+    ]
+    registry.add_image("library/alpine", "latest", blobs=blobs)
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        await ri.get_manifest_from_architecture()
+        start = registry.bytes_out
+        assert b"".join([chunk async for chunk in ri.open_file("/etc/os-release")]) == b"ID=fake\n"
+        # only the footers, the tables of contents and a single chunk were downloaded
+        assert registry.bytes_out - start < 16 * 1024
+        assert b"".join([chunk async for chunk in ri.open_file("/lib/../lib/big")]) == big
+        assert b"".join([chunk async for chunk in ri.open_file("/lib/small")]) == b"small"
+        with pytest.raises(FileNotFoundError):
+            [chunk async for chunk in ri.open_file("/gone")]
+    assert registry.bytes_out - start < sum(map(len, blobs))
+
+
+@pytest.mark.asyncio
+async def test_open_file_from_plain_layers(registry):
+    registry.add_image("library/alpine", "latest", n_layers=3, seed=7)
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        assert b"".join([chunk async for chunk in ri.open_file("/etc/file0")]) == b"0 7\n"
+        assert b"".join([chunk async for chunk in ri.open_file("/layer0/../etc/file1")]) == b"1 7\n"
+        layers = await ri.get_layers()
+    # layers without a table of contents are listed once (a range request for the eStargz footer comes first), and
+    # the layer holding the file is streamed once more, without storing anything in the cache
+    assert registry.requests[("GET", "blobs")] == 3 * 2 + 2
+    assert storage.get_layer_path(layers[0]) is None
+
+
+@pytest.mark.asyncio
+async def test_list_files(registry):
+    blobs = [
+        make_layer({"etc/passwd": b"root", "etc/gone": b"x", "tmp/x": b""}, links={"bin": "usr/bin"}),
+        make_layer({"etc/.wh.gone": b"", "etc/new": b"new"}),
+    ]
+    registry.add_image("library/alpine", "latest", blobs=[gzip.compress(blob, mtime=0) for blob in blobs])
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        entries = await ri.list_files()
+        assert [(entry.name, entry.type, entry.size) for entry in entries] == [
+            ("bin", "symlink", 0),
+            ("etc/new", "reg", 3),
+            ("etc/passwd", "reg", 4),
+            ("tmp/x", "reg", 0),
+        ]
+        layer = (await ri.get_manifest_from_architecture())["layers"][1]
+        assert [entry.name for entry in await ri.list_layer(layer)] == ["etc/.wh.gone", "etc/new"]
+    # the layers were streamed, and not stored in the cache
+    assert storage.get_layer_path(layer["digest"]) is None
+
+
+@pytest.mark.asyncio
+async def test_extract_files_stops_early(cache_dir, tmp_path):
+    big = os.urandom(4 * 1024 * 1024)
+    blobs = [
+        make_layer({"etc/first": b"first", "big.bin": big, "etc/gone": b"x"}),
+        make_layer({"etc/.wh.gone": b"", "etc/top": b"top"}, links={"etc/link": "top"}),
+    ]
+    blobs = [gzip.compress(blob, mtime=0) for blob in blobs]
+    # without a bandwidth limit, the whole layer fits in the socket buffers before the connection is closed
+    async with FakeRegistry(FakeRegistryConfig(bandwidth=16 * 1024 * 1024)) as registry:
+        registry.add_image("library/alpine", "latest", blobs=blobs)
+        async with _registry_info(registry, "library/alpine:latest") as ri:
+            await ri.get_manifest_from_architecture()
+            start = registry.bytes_out
+            extracted = await ri.extract_files(["/etc/top", "/etc/link"], tmp_path)
+            assert extracted == {"/etc/top": tmp_path / "etc/top", "/etc/link": tmp_path / "etc/link"}
+            assert (tmp_path / "etc/link").read_bytes() == b"top"
+            # the file was in the top layer, so the one below was not downloaded
+            assert registry.bytes_out - start == len(blobs[1])
+            start = registry.bytes_out
+            await ri.extract_files(["/etc/first"], tmp_path)
+            assert (tmp_path / "etc/first").read_bytes() == b"first"
+            # only the beginning of the big layer was downloaded, before the connection was closed
+            assert registry.bytes_out - start < len(blobs[0]) / 2
+            with pytest.raises(FileNotFoundError, match="/etc/gone"):
+                await ri.extract_files(["/etc/gone"], tmp_path)
+
+
+@pytest.mark.asyncio
+async def test_extract_files_through_symlink(registry, tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    blobs = [make_layer({"etc/foo": b"foo"}), make_layer({}, links={"etc": str(outside)})]
+    registry.add_image("library/alpine", "latest", blobs=[gzip.compress(blob, mtime=0) for blob in blobs])
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        with pytest.raises(ValueError, match="symbolic link"):
+            await ri.extract_files(["/etc", "/etc/foo"], tmp_path / "output")
+    assert (tmp_path / "output/etc").is_symlink()
+    assert not (outside / "foo").exists()
+
+
+@pytest.mark.asyncio
+async def test_copy_multiarch():
+    async with FakeRegistry() as source, FakeRegistry() as destination:
+        index_digest = source.add_multiarch("library/alpine", "latest", ["linux/amd64", "linux/arm64/v8"])
+        async with _registry_info(source, "library/alpine:latest") as src:
+            await src.copy_to(_registry_info(destination, "mirror/alpine:latest"), chunk_size=512)
+        assert destination.manifests["mirror/alpine"]["latest"] == source.manifests["library/alpine"]["latest"]
+        assert index_digest in destination.manifests["mirror/alpine"]
+        assert destination.blobs == source.blobs
+        # copying again skips every blob, which is reported by the destination like its uploads
+        events = []
+        async with _registry_info(source, "library/alpine:latest") as src, _registry_info(
+            destination, "mirror/alpine:latest"
+        ) as target:
+            target.progress = events.append
+            await src.copy_to(target)
+        assert {event.digest for event in events if event.kind == ProgressKind.SKIPPED} == set(source.blobs)
+
+
+@pytest.mark.asyncio
+async def test_list_tags_follows_pages():
+    async with FakeRegistry(FakeRegistryConfig(page_size=3)) as registry:
+        for i in range(10):
+            registry.add_manifest("library/alpine", f"3.{i}", {"schemaVersion": 2, "tag": i})
+        ri = _registry_info(registry, "library/alpine")
+        assert await ri.list_tags() == sorted(f"3.{i}" for i in range(10))
+        # iterating stops fetching pages as soon as the caller stops
+        registry.requests.clear()
+        async for tag in ri.iter_tags():
+            break
+        assert sum(count for (_, endpoint), count in registry.requests.items() if endpoint == "tags") == 1
+        await ri.close()
+
+
+@pytest.mark.asyncio
+async def test_manifest_revalidation(registry):
+    registry.add_image("library/alpine", "latest")
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        first = await ri.get_manifest()
+    registry.requests.clear()
+    registry.bytes_out = 0
+    # a new object does not share the in-memory cache, so the manifest is revalidated with the registry
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        second = await ri.get_manifest()
+    assert first.data == second.data
+    assert registry.requests[("GET", "manifests")] >= 1
+    assert registry.bytes_out == 0
+
+
+@pytest.mark.asyncio
+async def test_pull_progress_events(registry):
+    registry.add_image("library/alpine", "latest", n_layers=2, layer_size=256 * 1024)
+    events = []
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        ri.progress = events.append
+        await ri.pull(io.BytesIO())
+        await ri.pull(io.BytesIO())
+    layers = await ri.get_layers()
+    for layer in layers:
+        kinds = [event.kind for event in events if event.digest == layer]
+        assert kinds[0] == ProgressKind.STARTED
+        assert kinds[-2:] == [ProgressKind.FINISHED, ProgressKind.CACHED]
+        progress = [event for event in events if event.digest == layer and event.kind == ProgressKind.PROGRESS]
+        assert sum(event.delta for event in progress) == progress[-1].transferred == progress[-1].total
+
+
+@pytest.mark.asyncio
+async def test_pull_metrics(registry, tmp_path):
+    registry.add_image("library/alpine", "latest", n_layers=2, layer_size=64 * 1024)
+    metrics = Metrics()
+    async with _registry_info(registry, "library/alpine:latest") as ri:
+        ri.client.metrics = metrics
+        await ri.pull(io.BytesIO())
+        await ri.pull(io.BytesIO())
+    assert metrics.get("crpy_requests_total", endpoint="blobs", status="200") == 3
+    assert metrics.get("crpy_bytes_received_total", endpoint="blobs") >= 2 * 64 * 1024
+    assert metrics.get("crpy_cache_misses_total") == 2
+    assert metrics.get("crpy_cache_hits_total") == 2
+    phases = {dict(labels)["phase"] for labels in metrics.histograms["crpy_phase_seconds"]}
+    assert phases == {"auth", "manifest", "download", "write"}
+
+    metrics.write(tmp_path / "crpy.prom")
+    prometheus = (tmp_path / "crpy.prom").read_text()
+    assert 'crpy_requests_total{endpoint="blobs",method="GET",status="200"} 3' in prometheus
+    assert 'crpy_phase_seconds_count{operation="pull",phase="download"} 2' in prometheus
+    metrics.write(tmp_path / "crpy.json")
+    assert json.loads((tmp_path / "crpy.json").read_text())["counters"]["crpy_cache_hits_total"][0]["value"] == 2
+
+
+@pytest.mark.asyncio
+async def test_retries_transient_errors(cache_dir, monkeypatch):
+    config = FakeRegistryConfig(failure_rate=0.3, seed=1)
+    # blobs are read in worker threads, so the failures do not hit the same requests on each run. A chunk can then fail
+    # more often in a row than uploads resume by default
+    monkeypatch.setattr(registry_module, "UPLOAD_RESUME_ATTEMPTS", 10)
+    async with FakeRegistry(config) as registry, FakeRegistry(config) as destination:
+        registry.add_image("library/alpine", "latest", n_layers=3, layer_size=128 * 1024)
+        file = io.BytesIO()
+        metrics = Metrics()
+        client = HTTPClient(metrics=metrics, retry=RetryPolicy(attempts=10, backoff=0.001))
+        async with _registry_info(registry, "library/alpine:latest", client) as ri:
+            await ri.pull(file, decompress=False)
+        assert metrics.get("crpy_retries_total", operation="request") > 0
+        file.seek(0)
+        async with _registry_info(destination, "library/copy:latest", client) as ri:
+            await ri.push(file, chunk_size=32 * 1024)
+        assert destination.blobs == registry.blobs
+        # failed upload chunks are resumed from the offset the registry received, so no chunk is sent twice
+        assert destination.requests[("PATCH", "blobs")] > 0
+        assert destination.bytes_in <= sum(len(blob) for blob in registry.blobs.values()) + 4096
+
+
+@pytest.mark.asyncio
+async def test_upload_commit_is_not_replayed():
+    async with FakeRegistry(FakeRegistryConfig(drop_upload_commit=True)) as registry:
+        async with _registry_info(registry, "library/alpine") as ri:
+            manifest = await ri.push_layer(os.urandom(4096), chunk_size=1024)
+    # committing the upload again fails, so the registry is asked for the blob instead
+    assert manifest["digest"] in registry.blobs
+
+
+@pytest.mark.asyncio
+async def test_hedged_blob_download(cache_dir):
+    async with FakeRegistry(FakeRegistryConfig(stall_first_download=1)) as registry:
+        registry.add_image("library/alpine", "latest", n_layers=1)
+        metrics = Metrics()
+        client = HTTPClient(metrics=metrics, retry=RetryPolicy(hedge_after=0.05))
+        async with _registry_info(registry, "library/alpine:latest", client) as ri:
+            layer = (await ri.get_layers())[0]
+            start = time.monotonic()
+            layer_path = await ri.download_layer(layer)
+        assert time.monotonic() - start < 0.5
+        assert compute_sha256(layer_path) == layer
+        assert metrics.get("crpy_hedged_requests_total") == 1
+
+
+@pytest.mark.asyncio
+async def test_pull_redirected_blobs(cache_dir):
+    async with FakeRegistry(FakeRegistryConfig(redirect_blobs=True)) as registry:
+        registry.add_image("library/alpine", "latest", n_layers=2, layer_size=256 * 1024)
+        registry.config.fail_after_bytes = 100 * 1024
+        file = io.BytesIO()
+        async with _registry_info(registry, "library/alpine:latest") as ri:
+            # the fake cdn rejects requests with the registry token
+            await ri.pull(file)
+            assert len(ri.client._redirect_sessions) == 1
+        # the interrupted download is resumed from the cdn directly, without asking the registry again
+        assert registry.requests[("GET", "blobs")] == 3
+        assert registry.requests[("GET", "cdn")] == 4
+
+
+@pytest.mark.asyncio
+async def test_pull_relocated_blobs(cache_dir):
+    async with FakeRegistry(FakeRegistryConfig(relocate_blobs=True)) as registry:
+        registry.add_image("library/alpine", "latest", n_layers=2, layer_size=1024)
+        file = io.BytesIO()
+        async with _registry_info(registry, "library/alpine:latest") as ri:
+            # the redirected url is on the registry itself, so it still gets the token
+            await ri.pull(file)
+            assert not ri.client._redirect_sessions
+        assert registry.requests[("GET", "blobs")] == 6
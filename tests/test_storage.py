@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from crpy import storage
+from crpy.common import DigestMismatchError
+
+
+def test_layer_writer_commits_verified_blob(cache_dir):
+    content = b"some layer content" * 1000
+    digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+    with storage.LayerWriter(digest) as writer:
+        for i in range(0, len(content), 1024):
+            writer.write(content[i : i + 1024])
+        layer_path = writer.commit()
+    assert layer_path.read_bytes() == content
+    assert storage.get_layer_path(digest) == layer_path
+    # only the final blob is left in the cache folder
+    assert list((cache_dir / "blobs").iterdir()) == [layer_path]
+
+
+def test_layer_writer_rejects_wrong_digest(cache_dir):
+    digest = f"sha256:{hashlib.sha256(b'expected').hexdigest()}"
+    with pytest.raises(DigestMismatchError):
+        with storage.LayerWriter(digest) as writer:
+            writer.write(b"something else")
+            writer.commit()
+    assert storage.get_layer_path(digest) is None
+    assert list((cache_dir / "blobs").iterdir()) == []
+
+
+def test_layer_writer_resumes_partial_blob(cache_dir):
+    content = b"0123456789" * 100
+    digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+    # first attempt is interrupted before the commit
+    with storage.LayerWriter(digest) as writer:
+        writer.write(content[:300])
+    assert storage.get_layer_path(digest) is None
+    with storage.LayerWriter(digest) as writer:
+        assert writer.size == 300
+        writer.write(content[300:])
+        layer_path = writer.commit()
+    assert layer_path.read_bytes() == content
+
+
+def test_cache_eviction_lru(cache_dir, monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(storage.time, "time", lambda: next(clock))
+    layers = []
+    for i in range(3):
+        content = bytes([i]) * 100
+        layers.append(f"sha256:{hashlib.sha256(content).hexdigest()}")
+        storage.save_layer(layers[-1], content, repository="index.docker.io/library/alpine")
+    # the first layer is used again, so the second is now the least recently used
+    storage.touch_layer(layers[0])
+    assert storage.evict_layers(250) == [(layers[1], 100)]
+    assert storage.get_layer_path(layers[1]) is None
+    stats = storage.cache_stats()
+    assert stats["blobs"] == 2
+    assert stats["size"] == 200
+    assert stats["repositories"] == {"index.docker.io/library/alpine": 2}
+    # pinned layers are never evicted
+    with storage.pin_layers([layers[2]]):
+        assert storage.evict_layers(0) == [(layers[0], 100)]
+
+
+@pytest.mark.asyncio
+async def test_cache_eviction_skips_held_layers(cache_dir, monkeypatch):
+    fcntl = pytest.importorskip("fcntl")
+    clock = iter(range(100))
+    monkeypatch.setattr(storage.time, "time", lambda: next(clock))
+    layers = []
+    for i in range(3):
+        content = bytes([i]) * 100
+        layers.append(f"sha256:{hashlib.sha256(content).hexdigest()}")
+        storage.save_layer(layers[-1], content)
+    # another process reading the first layer, with its own lock file
+    with storage._try_lock(storage._lock_path(layers[0]), fcntl.LOCK_SH):
+        assert storage.evict_layers(250) == [(layers[1], 100)]
+    assert storage.evict_layers(150) == [(layers[0], 100)]
+    assert not list(storage.get_locks_dir().iterdir())
+    # pinned layers are held until they are unpinned
+    with storage.pin_layers([layers[2]]):
+        assert await storage.hold_layer(layers[2]) == storage.get_layer_path(layers[2])
+        assert storage._is_locked(storage._lock_path(layers[2]))
+    assert not storage._is_locked(storage._lock_path(layers[2]))
+
+
+@pytest.mark.asyncio
+async def test_lock_layer_serializes_access(cache_dir):
+    events = []
+
+    async def hold(name: str):
+        async with storage.lock_layer("sha256:1234", poll_interval=0.01):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            events.append(f"{name} end")
+
+    await asyncio.gather(hold("a"), hold("b"))
+    assert events in (["a start", "a end", "b start", "b end"], ["b start", "b end", "a start", "a end"])
+    # lock files are removed by the garbage collection, but only once nobody holds them
+    async with storage.lock_layer("sha256:5678"):
+        assert storage.gc_cache()["locks"] == 1
+        assert [path.name for path in storage.get_locks_dir().iterdir()] == ["sha256_5678.lock"]
+    assert storage.gc_cache()["locks"] == 1
+    assert not list(storage.get_locks_dir().iterdir())
+
+
+def test_get_layer_path_verify_removes_corrupted_blob(cache_dir):
+    content = b"layer content"
+    digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+    layer_path = storage.save_layer(digest, content)
+    layer_path.write_bytes(b"corrupted")
+    assert storage.get_layer_path(digest) == layer_path
+    assert storage.get_layer_path(digest, verify=True) is None
+    assert not layer_path.exists()
+
+
+def test_credentials(cache_dir):
+    assert storage.get_credentials("ghcr.io") is None
+    # the config is parsed once, and read again after it is changed
+    storage.save_credentials("ghcr.io", "user", "secret")
+    assert storage.decode_credentials(storage.get_credentials("ghcr.io")) == ("user", "secret")
+    assert storage.get_config() is storage.get_config()
+    assert storage.remove_credentials("ghcr.io")
+    assert storage.get_credentials("ghcr.io") is None
+
+
+def test_manifest_cache(cache_dir):
+    manifest = b'{"schemaVersion": 2}'
+    digest = f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+    headers = {"Docker-Content-Digest": digest, "Content-Type": "application/json", "Date": "today"}
+    assert storage.load_manifest("registry", "repo", "latest") is None
+    storage.save_manifest("registry", "repo", "latest", False, manifest, headers)
+    data, cached_headers = storage.load_manifest("registry", "repo", "latest")
+    assert data == manifest
+    assert cached_headers == {"Docker-Content-Digest": digest, "Content-Type": "application/json"}
+    # fat and thin manifests of a tag are kept apart
+    assert storage.load_manifest("registry", "repo", "latest", fat=True) is None
+    # manifests referenced by digest are checked against the digest
+    storage.save_manifest("registry", "repo", digest, False, manifest, headers)
+    assert storage.load_manifest("registry", "repo", digest)[0] == manifest
+    storage.save_manifest("registry", "repo", digest, False, b"tampered", headers)
+    assert storage.load_manifest("registry", "repo", digest) is None